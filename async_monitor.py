@@ -0,0 +1,330 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode
+
+from docker_client import endpoint_of
+from fleet_teardown import NODE_NAME_FILTER
+from fleet_snapshot import EventCache, node_from_summary
+from metrics import emitter
+from vpn_logging import get_logger
+
+log = get_logger("async_monitor")
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+DOCKER_POOL_SIZE = 16  # Keep-alive connections to the daemon shared by every check
+DOCKER_REQUEST_TIMEOUT = 10
+
+MONITOR_INTERVAL = 10  # Seconds between monitor passes; can go down to a few seconds
+CHECK_TIMEOUT = 5  # Seconds one node check may take before it is abandoned for this pass
+MAX_CONCURRENT_CHECKS = 64
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Docker API returned {status}: {message}")
+        self.status = status
+
+
+class AsyncDockerClient:
+    """
+    Minimal asyncio client for the Docker Engine API over the daemon's unix socket,
+    in the style of aiodocker. Requests share a pool of keep-alive HTTP/1.1 connections.
+    """
+
+    def __init__(self, socket_path=DOCKER_SOCKET, pool_size=DOCKER_POOL_SIZE, timeout=DOCKER_REQUEST_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.idle = []  # Idle (reader, writer) connections
+        self.slots = asyncio.Semaphore(pool_size)
+        self.request_count = 0
+        self.request_seconds = 0.0
+
+    async def _connection(self):
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return await asyncio.open_unix_connection(self.socket_path)
+
+    async def _read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("Docker daemon closed the connection")
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b"".join(chunks)
+        else:
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+        return status, headers, body
+
+    async def request(self, method, path, params=None, body=None):
+        """
+        Send one API request and return the decoded JSON body (or None for empty responses).
+        """
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        payload = json.dumps(body).encode() if body is not None else b""
+        request = (f"{method} {path} HTTP/1.1\r\nHost: docker\r\nContent-Type: application/json\r\n"
+                   f"Content-Length: {len(payload)}\r\n\r\n").encode() + payload
+
+        start = time.perf_counter()
+        async with self.slots:
+            reader, writer = await self._connection()
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, headers, data = await asyncio.wait_for(self._read_response(reader), self.timeout)
+            except BaseException:
+                writer.close()
+                raise
+            if headers.get("connection", "").lower() == "close":
+                writer.close()
+            else:
+                self.idle.append((reader, writer))
+        seconds = time.perf_counter() - start
+        self.request_count += 1
+        self.request_seconds += seconds
+        emitter.observe("vpn_docker_api_request_duration_seconds", seconds, {"endpoint": endpoint_of(method, path)})
+
+        decoded = json.loads(data) if data else None
+        if status >= 400:
+            raise DockerAPIError(status, decoded.get("message") if isinstance(decoded, dict) else data[:200])
+        return decoded
+
+    async def containers_list(self, all=True, filters=None):
+        params = {"all": "1" if all else "0"}
+        if filters:
+            params["filters"] = json.dumps({key: value if isinstance(value, list) else [value] for key, value in filters.items()})
+        return await self.request("GET", "/containers/json", params)
+
+    async def container_inspect(self, container_id):
+        return await self.request("GET", f"/containers/{quote(container_id)}/json")
+
+    async def container_restart(self, container_id, timeout=10):
+        return await self.request("POST", f"/containers/{quote(container_id)}/restart", {"t": timeout})
+
+    async def events(self, filters=None, since=None):
+        """
+        Yield decoded events from the daemon's event stream on a dedicated connection.
+        """
+        params = {}
+        if filters:
+            params["filters"] = json.dumps({key: value if isinstance(value, list) else [value] for key, value in filters.items()})
+        if since is not None:
+            params["since"] = str(since)
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            writer.write(f"GET /events?{urlencode(params)} HTTP/1.1\r\nHost: docker\r\n\r\n".encode())
+            await writer.drain()
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass  # Status line and headers; the body is chunked
+            buffer = b""
+            while True:
+                size_line = await reader.readline()
+                if not size_line:
+                    return
+                size = int(size_line.split(b";")[0], 16)
+                if size == 0:
+                    return
+                buffer += await reader.readexactly(size)
+                await reader.readline()
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+        finally:
+            writer.close()
+
+    async def close(self):
+        while self.idle:
+            _, writer = self.idle.pop()
+            writer.close()
+
+
+class AsyncMonitor:
+    """
+    Event-loop driven monitor. Each pass lists the fleet once, then checks every node as its own
+    task; the node's Docker calls have a timeout, so a slow or hung node only loses its own check. Restart counts and start
+    times come from the Docker event stream, so a container is inspected only when first seen.
+    Status reports come from the report inbox (node_reports.py); a new report triggers a check of
+    its node right away instead of waiting for the next pass. Node updates
+    (CSV, cache, supervisor) run on a single worker thread so writes stay ordered and never block the loop.
+    That thread also decides what changed and records it as seen only once `handle_node` succeeded, so a
+    change is never lost to a timeout or an error; it is delivered again on the next check.
+
+    `handle_node(node)` receives {"name", "container_id", "status", "health", "restart_count",
+    "started_at", "public_ip_info", "changed"} for every node on every pass.
+    """
+
+    def __init__(self, handle_node, reports, docker=None, interval=MONITOR_INTERVAL,
+                 check_timeout=CHECK_TIMEOUT, max_concurrent=MAX_CONCURRENT_CHECKS, name_filter=NODE_NAME_FILTER):
+        self.handle_node = handle_node
+        self.reports = reports
+        self.docker = docker
+        self.interval = interval
+        self.check_timeout = check_timeout
+        self.checks = asyncio.Semaphore(max_concurrent)
+        self.name_filter = name_filter
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="monitor-writer")
+        self.report_revisions = {}  # container id -> report revision last handled (writer thread only)
+        self.loop = None
+        self.reported = None  # Queue of container ids with a new report, created in run()
+        self.last_seen = {}  # node name -> (container id, status) last handled (writer thread only)
+        self.pass_count = 0
+        self.events = EventCache()
+
+    async def observe_node(self, summary):
+        """
+        Return (node, report revision) for one container; the Docker side of a check.
+        """
+        if not self.events.known(summary["Id"]):
+            async with self.checks:
+                details = await self.docker.container_inspect(summary["Id"])
+            self.events.seed(summary["Id"], details.get("RestartCount", 0), details.get("State", {}).get("StartedAt"))
+
+        state = node_from_summary(summary, self.events)
+        container_id = state["id"]
+        revision = self.reports.revision_of(container_id)
+        node = {
+            "name": state["name"],
+            "container_id": container_id,
+            "status": state["state"],
+            "health": state["health"],
+            "restart_count": state["restart_count"],
+            "started_at": state["started_at"],
+            "public_ip_info": self.reports.get(container_id),
+        }
+        return node, revision
+
+    def _deliver(self, node, revision):
+        """
+        Writer thread: flag what changed since the last successful delivery, hand the node over,
+        then record it as seen. If handle_node raises, the change is flagged again next time.
+        """
+        name, container_id = node["name"], node["container_id"]
+        seen = (container_id, node["status"])
+        node["changed"] = revision != self.report_revisions.get(container_id, 0) or self.last_seen.get(name) != seen
+        self.handle_node(node)
+        self.last_seen[name] = seen
+        self.report_revisions[container_id] = revision
+
+    async def check_node(self, summary):
+        """
+        Observe a node (Docker calls bounded by check_timeout), then queue it for the writer.
+        The hand-off is not timed out: a backed-up writer delays updates but never drops them.
+        """
+        node, revision = await asyncio.wait_for(self.observe_node(summary), self.check_timeout)
+        await asyncio.get_running_loop().run_in_executor(self.writer, self._deliver, node, revision)
+        return node
+
+    async def watch_events(self):
+        since = int(time.time())
+        while True:
+            try:
+                async for event in self.docker.events({"type": "container"}, since):
+                    since = event.get("time", since)
+                    if self.name_filter in event.get("Actor", {}).get("Attributes", {}).get("name", ""):
+                        self.events.apply(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("Docker event stream failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def _on_report(self, container_id, report):
+        """
+        Report inbox subscriber; runs on the ingest server's threads.
+        """
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.reported.put_nowait, container_id)
+
+    async def watch_reports(self):
+        """
+        Check a node as soon as it posts a report; the pass loop catches anything missed here.
+        """
+        while True:
+            container_id = await self.reported.get()
+            try:
+                containers = await self.docker.containers_list(all=True, filters={"id": container_id, "name": self.name_filter})
+                for summary in containers:
+                    await self.check_node(summary)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("Check of reporting node %s failed: %s", container_id, e, extra={"node": container_id})
+
+    async def run_pass(self):
+        self.pass_count += 1
+        start = time.perf_counter()
+        containers = await self.docker.containers_list(all=True, filters={"name": self.name_filter})
+        tasks = [self.check_node(summary) for summary in containers]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        failures = 0
+        for summary, result in zip(containers, results):
+            if isinstance(result, BaseException):
+                failures += 1
+                reason = "timed out" if isinstance(result, asyncio.TimeoutError) else result
+                node_name = summary['Names'][0].lstrip('/')
+                log.error("Check of %s failed: %s", node_name, reason, extra={"node": node_name})
+        duration = time.perf_counter() - start
+        emitter.observe("vpn_monitor_pass_duration_seconds", duration, {"engine": "async"})
+        log.info("[CHECK %s] Checked %s nodes in %.2f seconds (%s failed, %s Docker API calls so far).",
+                 self.pass_count, len(containers), duration, failures, self.docker.request_count)
+        return results
+
+    async def run(self, passes=None):
+        """
+        Run monitor passes every `interval` seconds (measured start to start) until cancelled.
+        """
+        own_client = self.docker is None
+        if own_client:
+            self.docker = AsyncDockerClient()
+        self.loop = asyncio.get_running_loop()
+        self.reported = asyncio.Queue()
+        self.reports.subscribe(self._on_report)
+        event_task = asyncio.create_task(self.watch_events())
+        report_task = asyncio.create_task(self.watch_reports())
+        try:
+            while passes is None or self.pass_count < passes:
+                started = time.monotonic()
+                try:
+                    await self.run_pass()
+                except Exception as e:
+                    log.exception("Monitor pass failed: %s", e)
+                await asyncio.sleep(max(0, self.interval - (time.monotonic() - started)))
+        finally:
+            event_task.cancel()
+            report_task.cancel()
+            if own_client:
+                await self.docker.close()
+            self.writer.shutdown(wait=True)
+
+
+def run_async_monitor(handle_node, reports, interval=MONITOR_INTERVAL, check_timeout=CHECK_TIMEOUT):
+    """
+    Run the async monitor on a new event loop in the calling thread (blocks until interrupted).
+    """
+    monitor = AsyncMonitor(handle_node, reports, interval=interval, check_timeout=check_timeout)
+    asyncio.run(monitor.run())
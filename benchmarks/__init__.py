@@ -0,0 +1,11 @@
+"""
+Benchmarks for the control plane's hot paths: the monitor pass, the CSV writer, the CSV watcher
+and WebSocket notifier, and the dashboard loader. Everything runs against synthetic fleets, a fake
+Docker client and a temporary working directory, so no daemon, network or credentials are needed.
+
+    python3 -m benchmarks                        # every scenario at 2, 110, 1,000 and 10,000 nodes
+    python3 -m benchmarks --sizes 110 --scenarios csv_update
+    python3 -m benchmarks --compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+
+benchmarks.load_test drives the whole control plane against a simulated daemon (docker_sim.py) instead.
+"""
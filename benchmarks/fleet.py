@@ -0,0 +1,154 @@
+import asyncio
+import csv
+import random
+import time
+
+from update_vpn_info import EXPECTED_HEADERS
+
+REGIONS = ("us_east", "us_west", "ca_toronto", "uk_london", "de_frankfurt", "nl_amsterdam", "jp_tokyo", "au_sydney")
+BASE_OPEN_PORT = 1194
+BASE_SOCKS_PORT = 9090
+
+
+def make_fleet(size, seed=0):
+    """
+    A synthetic fleet of `size` running nodes, odd nodes UDP and even nodes TCP as build_vpn_nodes pairs them.
+    """
+    rng = random.Random(seed)
+    fleet = []
+    for number in range(1, size + 1):
+        vpn_type = "udp" if number % 2 else "tcp"
+        location = f"{REGIONS[(number - 1) // 2 % len(REGIONS)]}{(number - 1) // (2 * len(REGIONS)) or ''}"
+        fleet.append({
+            "name": f"vpn_node_{number}",
+            "container_id": f"{rng.getrandbits(48):012x}",
+            "vpn_type": vpn_type,
+            "vpn_file": f"{location}-{vpn_type}.ovpn",
+            "public_ip": f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+            "open_port": BASE_OPEN_PORT + number,
+            "socks5_port": BASE_SOCKS_PORT + number,
+            "status": "running",
+        })
+    return fleet
+
+
+def csv_row(node, updated_at):
+    return [node["name"], f"127.0.0.{node['name'].rsplit('_', 1)[-1]}", node["vpn_file"], node["public_ip"],
+            node["vpn_type"].upper(), node["status"].capitalize(), "Connected", node["container_id"],
+            str(node["open_port"]), "Connected", str(node["socks5_port"]), str(round(updated_at))]
+
+
+def write_fleet_csv(path, fleet, updated_at=None):
+    updated_at = time.time() if updated_at is None else updated_at
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPECTED_HEADERS)
+        writer.writerows(csv_row(node, updated_at) for node in fleet)
+
+
+def status_report(node):
+    """
+    The report start_vpn.sh posts for a node whose tunnel and proxy came up.
+    """
+    return {"Node": node["container_id"], "Name": node["name"], "VPN File": node["vpn_file"],
+            "VPN_TYPE": node["vpn_type"].upper(), "Public IP": node["public_ip"], "Proxy Info": str(node["socks5_port"])}
+
+
+def container_summary(node):
+    """
+    The node as the Docker list API returns it.
+    """
+    return {"Id": node["container_id"] + "0" * 52, "Names": [f"/{node['name']}"], "State": node["status"],
+            "Status": "Up 5 minutes" if node["status"] == "running" else "Exited (1) 1 minute ago"}
+
+
+def container_details(node):
+    return {"Id": node["container_id"] + "0" * 52, "Name": f"/{node['name']}", "RestartCount": 0,
+            "State": {"Status": node["status"], "StartedAt": "2024-01-01T00:00:00Z"}}
+
+
+class FakeContainer:
+    def __init__(self, node):
+        self.node = node
+        self.id = node["container_id"] + "0" * 52
+        self.name = node["name"]
+
+    @property
+    def status(self):
+        return self.node["status"]
+
+    def reload(self):
+        pass
+
+
+class FakeAPI:
+    """
+    Low-level API subset FleetSnapshot uses, answering from the synthetic fleet.
+    """
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.by_id = {node["container_id"]: node for node in fleet}
+
+    def containers(self, all=True, filters=None):
+        return [container_summary(node) for node in self.fleet]
+
+    def inspect_container(self, container_id):
+        return container_details(self.by_id[container_id[:12]])
+
+
+class FakeContainers:
+    def __init__(self, fleet):
+        self.fleet = fleet
+        self.lookup = {}
+        for node in fleet:
+            self.lookup[node["container_id"]] = self.lookup[node["name"]] = node
+
+    def list(self, all=True, filters=None, sparse=False):
+        return [FakeContainer(node) for node in self.fleet]
+
+    def get(self, key):
+        return FakeContainer(self.lookup[key[:12] if key[:12] in self.lookup else key])
+
+
+class FakeDockerClient:
+    """
+    Stands in for the docker SDK client: the parts of client.api and client.containers the monitor reads.
+    """
+
+    def __init__(self, fleet):
+        self.api = FakeAPI(fleet)
+        self.containers = FakeContainers(fleet)
+
+    def events(self, decode=True, since=None, filters=None):
+        return iter(())
+
+
+class FakeAsyncDocker:
+    """
+    Stands in for async_monitor.AsyncDockerClient, yielding to the event loop on every request like a real socket would.
+    """
+
+    def __init__(self, fleet):
+        self.api = FakeAPI(fleet)
+        self.request_count = 0
+
+    async def containers_list(self, all=True, filters=None):
+        self.request_count += 1
+        await asyncio.sleep(0)
+        summaries = self.api.containers()
+        if filters and "id" in filters:
+            summaries = [summary for summary in summaries if summary["Id"].startswith(filters["id"])]
+        return summaries
+
+    async def container_inspect(self, container_id):
+        self.request_count += 1
+        await asyncio.sleep(0)
+        return self.api.inspect_container(container_id)
+
+    async def events(self, filters=None, since=None):
+        await asyncio.Event().wait()  # A quiet event stream
+        yield {}
+
+    async def close(self):
+        pass
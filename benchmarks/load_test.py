@@ -0,0 +1,187 @@
+"""
+Drive the whole control plane (bring-up, report ingest, async monitor, supervisor, CSV writer)
+against a simulated Docker daemon (docker_sim.py), to find what breaks first at 1,000+ nodes.
+Runs in a temporary working directory, so no daemon, VPN account or existing fleet state is touched.
+
+    python3 -m benchmarks.load_test --nodes 1000 --duration 120
+    python3 -m benchmarks.load_test --nodes 2000 --exit-rate 0.002 --auth-failure-rate 0.05
+    python3 -m benchmarks.load_test --nodes 200 --hosts 3
+
+With --hosts N, every host is its own simulated daemon behind FleetHosts(client_factory=...). The first is
+local; each other host's nodes report to an inbox of their own, and a reporter pushes them to the aggregator.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))  # The project's modules are top-level scripts
+
+from async_monitor import AsyncMonitor, MONITOR_INTERVAL
+from benchmarks.fleet import make_fleet
+from benchmarks.run import summarize
+from benchmarks.scenarios import bench_port_allocator
+from docker_sim import SimDocker, REPORT_DELAY
+from fleet_hosts import FleetHosts, FleetAggregator, HostReporter
+from node_reports import ReportInbox
+import vpn_logging
+
+DEFAULT_NODES = 1000
+DEFAULT_DURATION = 120  # Seconds the monitor and supervisor run after bring-up
+DEFAULT_CONCURRENCY = 64  # Simulated logins cost nothing, so bring-up runs wider than BRINGUP_CONCURRENCY
+DEFAULT_AUTH_RATE = 50.0
+FLEET_TOKEN = "load-test"
+
+
+class TimedMonitor(AsyncMonitor):
+    """
+    AsyncMonitor that keeps the duration of every pass.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pass_seconds = []
+
+    async def run_pass(self):
+        start = time.perf_counter()
+        try:
+            return await super().run_pass()
+        finally:
+            self.pass_seconds.append(time.perf_counter() - start)
+
+
+async def monitor_for(monitor, duration):
+    try:
+        await asyncio.wait_for(monitor.run(), duration)
+    except asyncio.TimeoutError:
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_remote_hosts(manage_vpns, host_list, daemons, interval):
+    """
+    Run the aggregator and, for every host but the first, a reporter monitoring that host's daemon.
+    """
+    port = free_port()
+    FleetAggregator(manage_vpns.handle_remote_observation, port=port, lock=manage_vpns.observation_lock,
+                    token=FLEET_TOKEN, hosts=[host["name"] for host in host_list]).start()
+    for host, daemon in zip(host_list[1:], daemons[1:]):
+        reporter = HostReporter(host["name"], ("127.0.0.1", port), FLEET_TOKEN)
+        monitor = AsyncMonitor(reporter.send, daemon.reports, docker=daemon.async_client(), interval=interval)
+        threading.Thread(target=asyncio.run, args=(monitor.run(),), name=f"reporter-{host['name']}", daemon=True).start()
+
+
+def run_load_test(nodes, duration, concurrency, auth_rate, report_delay, exit_rate, auth_failure_rate,
+                  tunnel_failure_rate, interval, seed, verbose=False, hosts=1):
+    workdir = tempfile.mkdtemp(prefix="vpn-load-")
+    os.chdir(workdir)
+    daemons = [SimDocker(report_delay, exit_rate, auth_failure_rate, tunnel_failure_rate, seed=seed,
+                         reports=ReportInbox() if number else None) for number in range(hosts)]
+    daemon = daemons[0]
+    host_list = [{"name": f"host{number + 1}", "base_url": None if number == 0 else f"tcp://sim-host{number + 1}:2376",
+                  "capacity": -(-nodes // hosts)} for number in range(hosts)]
+    host_clients = {host["base_url"]: sim.client() for host, sim in zip(host_list, daemons)}
+    node_map = [(int(node["name"].rsplit("_", 1)[-1]), node["vpn_type"], Path(node["vpn_file"])) for node in make_fleet(nodes, seed)]
+    if not verbose:
+        os.environ.setdefault(vpn_logging.LOG_LEVEL_ENV, "WARNING")  # Keep child processes quiet
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if verbose else devnull):
+            vpn_logging.setup_logging(stream=None if verbose else devnull, force=True)
+            import docker_client
+            docker_client.register_client(daemon.client())
+            import manage_vpns
+            import build_vpn_nodes
+            from bringup import load_report
+            manage_vpns.port_allocator = bench_port_allocator()
+            manage_vpns.report_inbox.start()
+            manage_vpns.fleet_hosts = FleetHosts(host_list, client_factory=host_clients.get)
+            if hosts > 1:
+                start_remote_hosts(manage_vpns, host_list, daemons, interval)
+
+            start = time.perf_counter()
+            failed = build_vpn_nodes.parallel_build_and_run_with_map(node_map, concurrency, auth_rate, manage_vpns.port_allocator,
+                                                                     manage_vpns.fleet_hosts)
+            bringup_seconds = time.perf_counter() - start
+            bringup = load_report()
+            bringup_starts = sum(sim.stats["starts"] for sim in daemons)
+            placed = manage_vpns.fleet_hosts.load()
+
+            manage_vpns.start_monitoring()
+            handle_node = manage_vpns.handle_fleet_observation if hosts > 1 else manage_vpns.handle_node_observation
+            monitor = TimedMonitor(handle_node, manage_vpns.report_inbox, docker=daemon.async_client(), interval=interval)
+            asyncio.run(monitor_for(monitor, duration))
+            states = {}
+            for entry in list(manage_vpns.supervisor.nodes.values()):
+                states[entry["state"]] = states.get(entry["state"], 0) + 1
+            running = sum(len(sim.list(filters={"status": "running"})) for sim in daemons)
+            simulated = {key: sum(sim.stats[key] for sim in daemons) for key in daemon.stats}
+            vpn_logging.shutdown_logging()
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    ready_seconds = [result["elapsed"] for result in bringup["nodes"].values() if result["status"] == "ready"]
+    return {
+        "nodes": nodes,
+        "bringup": {"seconds": round(bringup_seconds, 1), "ready": nodes - len(failed), "failed": len(failed),
+                    "first_ready_seconds": bringup["first_ready"],
+                    "ready_after_start": {key: value for key, value in summarize(ready_seconds).items() if key.endswith("_ms")}},
+        "monitor": {"passes": len(monitor.pass_seconds), "pass": summarize(monitor.pass_seconds),
+                    "docker_api_calls": monitor.docker.request_count},
+        "supervisor_states": states,
+        "hosts": placed,
+        "running_at_end": running,
+        "restarts": simulated["starts"] - bringup_starts,
+        "simulated": simulated,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "peak_child_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the control plane against a simulated Docker daemon")
+    parser.add_argument("--nodes", type=int, default=DEFAULT_NODES, help="Fleet size")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="Seconds to monitor after bring-up")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Nodes brought up at the same time")
+    parser.add_argument("--auth-rate", type=float, default=DEFAULT_AUTH_RATE, help="Simulated provider logins per second")
+    parser.add_argument("--report-delay", type=float, nargs=2, default=REPORT_DELAY, metavar=("MIN", "MAX"),
+                        help="Seconds from start until a node posts its status report")
+    parser.add_argument("--exit-rate", type=float, default=0.001, help="Chance per second that a running node exits")
+    parser.add_argument("--auth-failure-rate", type=float, default=0.01, help="Chance that a start fails authentication")
+    parser.add_argument("--tunnel-failure-rate", type=float, default=0.01, help="Chance that a start fails to bring the tunnel up")
+    parser.add_argument("--interval", type=float, default=MONITOR_INTERVAL, help="Seconds between monitor passes")
+    parser.add_argument("--hosts", type=int, default=1, help="Simulated Docker hosts the fleet is spread over")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the control plane's own log output")
+    args = parser.parse_args()
+
+    result = run_load_test(args.nodes, args.duration, args.concurrency, args.auth_rate, tuple(args.report_delay), args.exit_rate,
+                           args.auth_failure_rate, args.tunnel_failure_rate, args.interval, args.seed, args.verbose, args.hosts)
+    print(json.dumps(result, indent=2))
+    if args.output:
+        tmp_output = Path(args.output).with_suffix(".tmp")
+        with open(tmp_output, "w") as f:
+            json.dump(result, f, indent=2)
+        os.replace(tmp_output, args.output)
+    sys.stdout.flush()
+    os._exit(0)  # Ingest, restart and simulator threads are not meant to be joined
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))  # The project's modules are top-level scripts
+
+import vpn_logging
+from benchmarks.fleet import make_fleet
+from benchmarks.scenarios import SCENARIOS, ScenarioSkipped
+
+DEFAULT_SIZES = (2, 110, 1000, 10000)
+DEFAULT_MAX_OPS = 200  # Operations measured per scenario and fleet size
+RESULTS_DIR = REPO_DIR / "benchmarks" / "results"
+WORKER_TIMEOUT = 3600  # Seconds one scenario at one fleet size may take
+
+
+def percentile(sorted_values, q):
+    """
+    Linear-interpolated percentile (0-100) of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    total = sum(ordered)
+    return {
+        "ops": len(ordered),
+        "mean_ms": round(total / len(ordered) * 1000, 3) if ordered else None,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3) if ordered else None,
+        "p90_ms": round(percentile(ordered, 90) * 1000, 3) if ordered else None,
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3) if ordered else None,
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else None,
+        "throughput_per_second": round(len(ordered) / total, 2) if total else None,
+    }
+
+
+def run_scenario(name, size, max_ops, seed):
+    """
+    Run one scenario against a fleet of `size` nodes in a fresh temporary working directory.
+    Meant to run in its own process, so peak RSS belongs to this scenario alone.
+    """
+    setup, unit = SCENARIOS[name]
+    workdir = tempfile.mkdtemp(prefix=f"vpn-bench-{name}-")
+    os.chdir(workdir)
+    rng = random.Random(seed)
+    fleet = make_fleet(size, seed)
+    latencies = []
+    os.environ.setdefault(vpn_logging.LOG_LEVEL_ENV, "WARNING")  # Keep child processes quiet
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            vpn_logging.setup_logging(stream=devnull, force=True)
+            spec = setup(fleet, max_ops, rng)
+            prepare = spec.get("prepare")
+            for i in range(spec["count"]):
+                if prepare:
+                    prepare(i)
+                start = time.perf_counter()
+                spec["op"](i)
+                latencies.append(time.perf_counter() - start)
+            vpn_logging.shutdown_logging()
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {"scenario": name, "size": size, "status": "ok", "unit": unit, **summarize(latencies)}
+    if spec.get("ops_per_pass") and latencies:
+        result["estimated_pass_seconds"] = round(sum(latencies) / len(latencies) * spec["ops_per_pass"], 3)
+    result.update(spec.get("extra", {}))
+    result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    result["peak_child_rss_mb"] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    return result
+
+
+def run_worker(name, size, max_ops, seed, result_file):
+    try:
+        result = run_scenario(name, size, max_ops, seed)
+    except ScenarioSkipped as e:
+        result = {"scenario": name, "size": size, "status": "skipped", "reason": str(e)}
+    except Exception as e:
+        traceback.print_exc()
+        result = {"scenario": name, "size": size, "status": "error", "reason": f"{type(e).__name__}: {e}"}
+    with open(result_file, "w") as f:
+        json.dump(result, f)
+    sys.stdout.flush()
+    os._exit(0)  # Monitor and server threads started by the scenario are not meant to be joined
+
+
+def run_in_subprocess(name, size, max_ops, seed):
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        result_file = f.name
+    try:
+        command = [sys.executable, "-m", "benchmarks.run", "--worker", name, str(size),
+                   "--max-ops", str(max_ops), "--seed", str(seed), "--result-file", result_file]
+        subprocess.run(command, cwd=REPO_DIR, timeout=WORKER_TIMEOUT)
+        with open(result_file) as f:
+            return json.load(f)
+    except (subprocess.TimeoutExpired, ValueError, OSError) as e:
+        return {"scenario": name, "size": size, "status": "error", "reason": f"{type(e).__name__}: {e}"}
+    finally:
+        os.unlink(result_file)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_result(result):
+    if result["status"] != "ok":
+        return f"{result['scenario']:<18} {result['size']:>6}  {result['status']}: {result.get('reason')}"
+    line = (f"{result['scenario']:<18} {result['size']:>6}  p50 {result['p50_ms']:>10.3f} ms  p99 {result['p99_ms']:>10.3f} ms  "
+            f"{result['throughput_per_second']:>10.2f} ops/s  peak RSS {result['peak_rss_mb']:>7.1f} MB")
+    if "estimated_pass_seconds" in result:
+        line += f"  ~{result['estimated_pass_seconds']:.1f} s/pass"
+    return line
+
+
+def compare(old_file, new_file):
+    """
+    Print p50, p99 and throughput changes between two result files.
+    """
+    with open(old_file) as f:
+        old = {(r["scenario"], r["size"]): r for r in json.load(f)["results"] if r["status"] == "ok"}
+    with open(new_file) as f:
+        new = {(r["scenario"], r["size"]): r for r in json.load(f)["results"] if r["status"] == "ok"}
+
+    def change(before, after):
+        return f"{(after - before) / before * 100:+7.1f}%" if before else "    n/a"
+
+    for key in sorted(old.keys() & new.keys(), key=lambda key: (key[0], key[1])):
+        a, b = old[key], new[key]
+        print(f"{key[0]:<18} {key[1]:>6}  p50 {change(a['p50_ms'], b['p50_ms'])}  p99 {change(a['p99_ms'], b['p99_ms'])}  "
+              f"throughput {change(a['throughput_per_second'], b['throughput_per_second'])}  "
+              f"peak RSS {change(a['peak_rss_mb'], b['peak_rss_mb'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the monitor, CSV writer, notifier and dashboard loader")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Comma-separated fleet sizes")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--max-ops", type=int, default=DEFAULT_MAX_OPS, help="Operations measured per scenario and size")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic fleets")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two results files and exit")
+    parser.add_argument("--worker", nargs=2, metavar=("SCENARIO", "SIZE"), help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker[0], int(args.worker[1]), args.max_ops, args.seed, args.result_file)
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    names = [name for name in args.scenarios.split(",") if name]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+
+    commit = git_commit()
+    results = []
+    for name in names:
+        for size in sizes:
+            result = run_in_subprocess(name, size, args.max_ops, args.seed)
+            print(format_result(result), flush=True)
+            results.append(result)
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{commit or 'unknown'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tmp_output = output.with_suffix(".tmp")
+    with open(tmp_output, "w") as f:
+        json.dump({"commit": commit, "created_at": time.time(), "python": platform.python_version(),
+                   "platform": platform.platform(), "max_ops": args.max_ops, "seed": args.seed, "results": results}, f, indent=2)
+    os.replace(tmp_output, output)
+    print(f"[INFO] Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
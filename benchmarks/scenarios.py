@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+from pathlib import Path
+
+from port_allocator import PortAllocator
+from sharded_store import ShardedStore, SHARD_DIR
+from benchmarks.fleet import FakeAsyncDocker, FakeDockerClient, csv_row, status_report, write_fleet_csv
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+CSV_FILE = Path("./vpn_nodes_info.csv")  # Relative to the scenario's temporary working directory
+WEBSOCKET_CLIENTS = 20  # Dashboards connected while the notifier is measured
+MONITOR_PASSES = 5  # Steady-state passes measured for the async monitor
+BENCH_SSH_START, BENCH_UDP_START, BENCH_SOCKS5_START = 2000, 20000, 40000
+BENCH_SUBNET = "10.0.0.0/8"
+BENCH_SHARDS = 16  # Hash shards for the sharded CSV writer
+
+# name -> (setup function, what one operation is)
+SCENARIOS = {}
+
+
+class ScenarioSkipped(Exception):
+    """
+    The scenario cannot run here, e.g. an optional dependency is not installed.
+    """
+
+
+def scenario(name, unit):
+    def register(setup):
+        SCENARIOS[name] = (setup, unit)
+        return setup
+    return register
+
+
+def import_or_skip(module_name):
+    try:
+        return __import__(module_name)
+    except ImportError as e:
+        raise ScenarioSkipped(f"{module_name} needs {e.name}, which is not installed")
+
+
+def bench_port_allocator():
+    """
+    The default port ranges hold 1,010 nodes; synthetic fleets get wide enough ranges for 10,000+.
+    """
+    return PortAllocator(udp_start=BENCH_UDP_START, socks5_start=BENCH_SOCKS5_START, ssh_start=BENCH_SSH_START, subnet=BENCH_SUBNET)
+
+
+def load_manage_vpns(fleet):
+    """
+    Import manage_vpns against the fake Docker client, with every node's status report already posted.
+    """
+    import docker_client
+    docker_client.register_client(FakeDockerClient(fleet))
+    import manage_vpns
+    manage_vpns.port_allocator = bench_port_allocator()
+    manage_vpns.port_allocator.lease_many(node["name"] for node in fleet)
+    for node in fleet:
+        manage_vpns.report_inbox.put(status_report(node))
+    return manage_vpns
+
+
+@scenario("csv_update", "one update_vpn_info.update_csv call")
+def csv_update(fleet, max_ops, rng):
+    import update_vpn_info
+    write_fleet_csv(update_vpn_info.csv_file, fleet)
+
+    def op(i):
+        node = rng.choice(fleet)
+        update_vpn_info.update_csv(node["name"], node["vpn_file"], node["public_ip"], node["vpn_type"].upper(),
+                                   "exited" if i % 2 else "running", "Connected", node["container_id"],
+                                   str(node["open_port"]), "Connected", str(node["socks5_port"]))
+
+    return {"op": op, "count": max_ops}
+
+
+@scenario("csv_update_sharded", f"one update_vpn_info.update_csv call with VPN_CSV_SHARDS=hash:{BENCH_SHARDS}")
+def csv_update_sharded(fleet, max_ops, rng):
+    import update_vpn_info
+    store = update_vpn_info.store = ShardedStore("hash", SHARD_DIR, BENCH_SHARDS, update_vpn_info.EXPECTED_HEADERS)
+    updated_at = time.time()
+    shards = {}
+    for node in fleet:
+        shards.setdefault(store.shard_for(node["name"]), []).append(csv_row(node, updated_at))
+    for shard, rows in shards.items():
+        store.modify(shard, lambda existing, rows=rows: existing + rows)
+
+    def op(i):
+        node = rng.choice(fleet)
+        update_vpn_info.update_csv(node["name"], node["vpn_file"], node["public_ip"], node["vpn_type"].upper(),
+                                   "exited" if i % 2 else "running", "Connected", node["container_id"],
+                                   str(node["open_port"]), "Connected", str(node["socks5_port"]))
+
+    return {"op": op, "count": max_ops, "extra": {"shards": len(shards)}}
+
+
+@scenario("monitor_threaded", "one node checked by the threaded monitor (manage_vpns.collect_public_ips_and_ports)")
+def monitor_threaded(fleet, max_ops, rng):
+    manage_vpns = load_manage_vpns(fleet)
+    start = time.perf_counter()
+    manage_vpns.fleet_snapshot.refresh()
+    refresh_seconds = time.perf_counter() - start
+    sample = rng.sample(fleet, min(max_ops, len(fleet)))
+
+    def op(i):
+        node = sample[i]
+        manage_vpns.process_container_status(node["container_id"], node["name"], node["open_port"], node["socks5_port"], {})
+
+    # Every node is checked on every pass, so a pass costs about one list call plus a check per node
+    return {"op": op, "count": len(sample), "ops_per_pass": len(fleet), "extra": {"snapshot_refresh_seconds": refresh_seconds}}
+
+
+@scenario("monitor_async", "one steady-state async monitor pass over the fleet")
+def monitor_async(fleet, max_ops, rng):
+    manage_vpns = load_manage_vpns(fleet)
+    from async_monitor import AsyncMonitor
+
+    docker = FakeAsyncDocker(fleet)
+    monitor = AsyncMonitor(lambda node: None, manage_vpns.report_inbox, docker=docker)
+    loop = asyncio.new_event_loop()
+    start = time.perf_counter()
+    loop.run_until_complete(monitor.run_pass())  # First sighting: one inspect per node
+    first_pass = time.perf_counter() - start
+    monitor.handle_node = manage_vpns.handle_node_observation
+
+    def op(i):
+        loop.run_until_complete(monitor.run_pass())
+
+    return {"op": op, "count": min(max_ops, MONITOR_PASSES), "extra": {"first_pass_seconds": first_pass}}
+
+
+class FakeWebSocket:
+    def __init__(self, delivered):
+        self.delivered = delivered
+
+    async def send_text(self, message):
+        self.delivered.release()
+
+
+@scenario("csv_notifier", "one CSV change handled by websocket_server.CSVHandler, up to every client notified")
+def csv_notifier(fleet, max_ops, rng):
+    websocket_server = import_or_skip("websocket_server")
+    write_fleet_csv(CSV_FILE, fleet)
+    handler = websocket_server.CSVHandler(CSV_FILE)
+    delivered = threading.Semaphore(0)
+    websocket_server.clients[:] = [FakeWebSocket(delivered) for _ in range(WEBSOCKET_CLIENTS)]
+
+    def prepare(i):
+        node = rng.choice(fleet)
+        node["status"] = "exited" if node["status"] == "running" else "running"
+        write_fleet_csv(CSV_FILE, fleet)
+
+    def op(i):
+        handler.process_file_event()
+        for _ in range(WEBSOCKET_CLIENTS):
+            delivered.acquire()
+
+    return {"op": op, "prepare": prepare, "count": max_ops}
+
+
+@scenario("dashboard_load", "one csv_dashboard.load_csv_data call")
+def dashboard_load(fleet, max_ops, rng):
+    csv_dashboard = import_or_skip("csv_dashboard")
+    write_fleet_csv(CSV_FILE, fleet)
+
+    def op(i):
+        csv_dashboard.load_csv_data(CSV_FILE)
+
+    return {"op": op, "count": max_ops}
@@ -0,0 +1,179 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import docker
+
+from tracing import tracer
+from vpn_logging import get_logger
+
+log = get_logger("bringup")
+
+BRINGUP_CONCURRENCY = 8  # Nodes building/connecting at the same time
+AUTH_RATE = 1.0  # Provider logins started per second across the fleet
+AUTH_BURST = 4  # Logins allowed back to back before the rate limit applies
+
+READY_TIMEOUT = 120  # Seconds a node gets to post its status report
+READY_POLL_INTERVAL = 5  # Seconds between container status checks while waiting; a report ends the wait at once
+RETRY_WAVES = 2  # Extra waves that relaunch only the nodes that failed
+RETRY_WAVE_DELAY = 10  # Seconds between waves
+
+REPORT_FILE = Path("./bringup_report.json")
+BRINGUP_FAILED_EXIT = 3  # build_vpn_nodes.py exit code when only some nodes became ready
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. acquire() blocks until a token is available.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def wait_until_ready(container, reports, timeout=READY_TIMEOUT, poll_interval=READY_POLL_INTERVAL):
+    """
+    Gate one node on its own readiness signal: the status report start_vpn.sh posts once the
+    tunnel and proxy are up (or have failed). Returns (ready, reason); gives up early if the container exits.
+    `reports` is the report inbox (node_reports.py) or a client for it; the wait wakes as soon as the report arrives.
+    """
+    start = time.time()
+    ready, reason = _wait_for_report(container, reports, timeout, poll_interval)
+    tracer.record("tunnel_up", container.name, start, time.time(), ready=ready, reason=reason)
+    return ready, reason
+
+
+def _wait_for_report(container, reports, timeout, poll_interval):
+    container_id = container.id[:12]
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = reports.wait_for(container_id, min(poll_interval, max(0, deadline - time.time())))
+        if info:
+            public_ip = info.get("Public IP", "")
+            if "Auth Failed" in public_ip:
+                return False, "Auth Failed"
+            if public_ip and info.get("Proxy Info") and "failed" not in public_ip.lower():
+                return True, public_ip
+            return False, public_ip or "no public IP reported"  # start_vpn.sh only reports without a proxy on failure
+
+        try:
+            container.reload()
+        except docker.errors.NotFound:
+            return False, "container removed"
+        if container.status in ("exited", "dead"):
+            return False, f"container {container.status}"
+    return False, f"not ready after {timeout}s"
+
+
+class BringupScheduler:
+    """
+    Launch nodes in parallel under a concurrency cap and a provider-login rate limit,
+    gating each node on its own readiness. Failed nodes are retried in later waves; nodes that
+    are ready are never touched again. Nodes are launched in the order given, so the first
+    entries (the fastest locations) are usable first.
+
+    `launch(node)` starts a node and returns its container (or None on failure).
+    `ready(node, container)` returns (ready, reason).
+    """
+
+    def __init__(self, launch, ready, concurrency=BRINGUP_CONCURRENCY, auth_rate=AUTH_RATE, auth_burst=AUTH_BURST,
+                 retry_waves=RETRY_WAVES, retry_delay=RETRY_WAVE_DELAY, report_file=REPORT_FILE):
+        self.launch = launch
+        self.ready = ready
+        self.concurrency = concurrency
+        self.auth_bucket = TokenBucket(auth_rate, auth_burst)
+        self.retry_waves = retry_waves
+        self.retry_delay = retry_delay
+        self.report_file = Path(report_file)
+        self.results = {}
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.first_ready = None
+
+    def _bring_up(self, node):
+        node_name = node["name"]
+        self.auth_bucket.acquire()  # Every launch is a provider login
+        try:
+            container = self.launch(node)
+            if container is None:
+                ok, reason = False, "launch failed"
+            else:
+                ok, reason = self.ready(node, container)
+        except Exception as e:
+            log.exception("Bring-up of %s failed: %s", node_name, e)
+            ok, reason = False, str(e)
+
+        elapsed = time.time() - self.start_time
+        with self.lock:
+            result = self.results.setdefault(node_name, {"attempts": 0})
+            result.update(status="ready" if ok else "failed", reason=reason, elapsed=round(elapsed, 1))
+            result["attempts"] += 1
+            if ok and self.first_ready is None:
+                self.first_ready = elapsed
+                log.info("First proxy (%s) ready after %.1f seconds.", node_name, elapsed)
+        log.info("%s: %s (%s) after %.1f seconds.", node_name, 'ready' if ok else 'failed', reason, elapsed)
+        return ok, reason
+
+    def run(self, nodes):
+        """
+        Bring up `nodes` (dicts with at least "name") and return {node_name: result}.
+        """
+        self.start_time = time.time()
+        pending = list(nodes)
+
+        for wave in range(self.retry_waves + 1):
+            if not pending:
+                break
+            if wave:
+                log.info("Retry wave %s: relaunching %s failed nodes in %s seconds...", wave, len(pending), self.retry_delay)
+                time.sleep(self.retry_delay)
+
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                outcomes = list(executor.map(self._bring_up, pending))
+            # Auth failures will not fix themselves; retrying them only burns provider logins
+            pending = [node for node, (ok, reason) in zip(pending, outcomes) if not ok and reason != "Auth Failed"]
+
+        ready = sum(1 for result in self.results.values() if result["status"] == "ready")
+        log.info("Bring-up finished: %s/%s nodes ready in %.1f seconds.", ready, len(self.results), time.time() - self.start_time)
+        self.save_report()
+        return self.results
+
+    def failed(self):
+        return sorted(name for name, result in self.results.items() if result["status"] != "ready")
+
+    def save_report(self):
+        tmp_path = self.report_file.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"first_ready": self.first_ready, "nodes": self.results}, f, indent=2)
+            os.replace(tmp_path, self.report_file)
+        except Exception as e:
+            log.error("Failed to save bring-up report: %s", e)
+
+
+def load_report(report_file=REPORT_FILE):
+    try:
+        with open(report_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"first_ready": None, "nodes": {}}
@@ -1,80 +1,109 @@
 #!/home/idontloveyou/miniconda/bin/python3.11
 #this is build vpn nodes it is ran by manage_vpns.py
 import argparse
+import sys
 import docker
 import multiprocessing
 import time
 from pathlib import Path
 import random
 from concurrent.futures import ThreadPoolExecutor, as_completed
-# Initialize Docker client
-client = docker.from_env()
-
-import traceback
-
-def build_and_run_container(tag, ovpn_file, udp_port, socks_port=9090, vpn_type="udp"):
+from squid_logs import SQUID_LOGS_DIR
+from port_allocator import PortAllocator
+from fleet_teardown import FLEET_LABELS, teardown_fleet
+from ovpn_catalog import load_catalog
+from server_selection import ServerSelector, MAX_PER_REGION
+from bringup import BringupScheduler, wait_until_ready, BRINGUP_CONCURRENCY, AUTH_RATE, BRINGUP_FAILED_EXIT
+from docker_client import get_client, exec_in_container, format_api_stats
+from fleet_hosts import FleetHosts
+from node_reports import open_reports, REPORTS_DIR, REPORT_SOCKET, CONTAINER_REPORTS_DIR
+from tracing import tracer
+from vpn_logging import get_logger
+
+log = get_logger("build_vpn_nodes")
+
+# Shared, connection-pooled Docker client
+client = get_client()
+
+def build_and_run_container(tag, ovpn_file, udp_port, socks_port=9090, vpn_type="udp", host_client=None):
     """
     Build and run a Docker container for a VPN node, mapping the correct UDP or TCP port.
     Set up SSH to run inside the container and expose the correct SOCKS proxy.
     Ensure the base image is used locally.
+    `host_client` selects the Docker host (the local daemon by default); other hosts need this
+    checkout at the same path, since the bind mounts below are host paths.
+    Returns the started container, or None if the build or run failed.
     """
+    client = host_client or get_client()
     try:
         # Cleanup old containers
-        cleanup_container(tag)
+        cleanup_container(tag, client)
         
         # Get absolute paths for the credentials and ovpn files using pathlib, converted to strings
         vpn_creds_path = str(Path("./vpn_creds.txt").resolve())
         ovpn_files_path = str(Path("./ovpn_files").resolve())
-        public_ips_path = str(Path("/home/idontloveyou/Desktop/LinuxServer1/freedomdata/storage/docker/public_ips").resolve())
+        reports_path = str(REPORTS_DIR.resolve())  # Holds the report ingest socket (node_reports.py)
         ovpn_file_str = str(Path(ovpn_file).name)  # Get only the filename (not the full path)
 
+        # Per-node Squid log directory so the monitor can tail access.log from the host
+        squid_logs_path = SQUID_LOGS_DIR / tag
+        squid_logs_path.mkdir(parents=True, exist_ok=True)
+        squid_logs_path.chmod(0o777)  # Squid drops privileges to the proxy user before writing
+
         # Get the absolute path for SSL certificates directory
         ssl_certs_path = str(Path("/etc/ssl/certs").resolve())
 
         # Check if the base image is available locally
         try:
             client.images.get("ubuntu:22.04")
-            print("Base image 'ubuntu:22.04' is already available locally.")
+            log.debug("Base image 'ubuntu:22.04' is already available locally.")
         except docker.errors.ImageNotFound:
-            print("Base image 'ubuntu:22.04' not found locally. Pulling from Docker Hub...")
+            log.info("Base image 'ubuntu:22.04' not found locally. Pulling from Docker Hub...")
             client.images.pull("ubuntu:22.04")
 
         # Log port information
-        print(f"Attempting to build container {tag} with VPN file {ovpn_file_str} on {vpn_type.upper()} port {udp_port} and SOCKS5 proxy on port {socks_port} (TCP)...")
+        log.debug("Attempting to build container %s with VPN file %s on %s port %s and SOCKS5 proxy on port %s (TCP)...",
+                  tag, ovpn_file_str, vpn_type.upper(), udp_port, socks_port)
 
         # Build the Docker image with the tag
-        image, build_logs = client.images.build(path=".", tag=tag, buildargs={"OVPN_FILE": ovpn_file_str})
-        print(f"Container image {tag} built successfully.")
+        with tracer.span("image_build", tag, vpn_file=ovpn_file_str):
+            image, build_logs = client.images.build(path=".", tag=tag, buildargs={"OVPN_FILE": ovpn_file_str}, labels=FLEET_LABELS)
+        log.debug("Container image %s built successfully.", tag)
 
         # Run the Docker container using the tagged image
-        container = client.containers.run(
-            image.id,  # Use the image ID instead of the tag directly
-            detach=True,
-            name=tag,
-            environment={
-                "VPN_FILE": ovpn_file_str,
-                "VPN_TYPE": vpn_type,  # Pass the VPN type as an environment variable
-                "SOCKS_PORT": str(socks_port)  # Pass the SOCKS5 port as an environment variable
-            },
-            volumes={
-                vpn_creds_path: {"bind": "/etc/openvpn/vpn_creds.txt", "mode": "ro"},  # Bind the VPN credentials
-                ovpn_files_path: {"bind": "/etc/openvpn/ovpn_files", "mode": "ro"},  # Bind the OVPN files directory
-                public_ips_path: {"bind": "/home/idontloveyou/Desktop/LinuxServer1/freedomdata/storage/docker/public_ips", "mode": "rw"},
-                ssl_certs_path: {"bind": "/etc/ssl/certs", "mode": "ro"}  # Mount SSL certificates directory
-            },
-            ports={f'{udp_port}/udp': udp_port, f'{socks_port}/tcp': socks_port},  # Expose both UDP and SOCKS5 ports
-            cap_add=["NET_ADMIN"],  # Allow NET_ADMIN capability
-            devices=["/dev/net/tun"],  # Enable access to /dev/net/tun device
-            privileged=True  # Ensure the container can modify network settings
-        )
-        print(f"Container {tag} is running on {vpn_type.upper()} port {udp_port} and SOCKS5 proxy on TCP port {socks_port}.")
+        with tracer.span("container_create", tag, vpn_type=vpn_type):
+            container = client.containers.run(
+                image.id,  # Use the image ID instead of the tag directly
+                detach=True,
+                name=tag,
+                labels=FLEET_LABELS,  # Lets cleanup select fleet containers without touching anything else
+                environment={
+                    "VPN_FILE": ovpn_file_str,
+                    "VPN_TYPE": vpn_type,  # Pass the VPN type as an environment variable
+                    "SOCKS_PORT": str(socks_port),  # Pass the SOCKS5 port as an environment variable
+                    "NODE_NAME": tag,
+                    "REPORT_SOCKET": f"{CONTAINER_REPORTS_DIR}/{REPORT_SOCKET.name}"  # start_vpn.sh posts its status report here
+                },
+                volumes={
+                    vpn_creds_path: {"bind": "/etc/openvpn/vpn_creds.txt", "mode": "ro"},  # Bind the VPN credentials
+                    ovpn_files_path: {"bind": "/etc/openvpn/ovpn_files", "mode": "ro"},  # Bind the OVPN files directory
+                    reports_path: {"bind": CONTAINER_REPORTS_DIR, "mode": "rw"},  # Report ingest socket
+                    ssl_certs_path: {"bind": "/etc/ssl/certs", "mode": "ro"},  # Mount SSL certificates directory
+                    str(squid_logs_path): {"bind": "/var/log/squid", "mode": "rw"}  # Squid access.log for traffic metrics
+                },
+                ports={f'{udp_port}/udp': udp_port, f'{socks_port}/tcp': socks_port},  # Expose both UDP and SOCKS5 ports
+                cap_add=["NET_ADMIN"],  # Allow NET_ADMIN capability
+                devices=["/dev/net/tun"],  # Enable access to /dev/net/tun device
+                privileged=True  # Ensure the container can modify network settings
+            )
+        log.info("Container %s is running on %s port %s and SOCKS5 proxy on TCP port %s.", tag, vpn_type.upper(), udp_port, socks_port)
+        return container
 
     except docker.errors.BuildError as e:
-        print(f"Failed to build container {tag}: {e}")
-        traceback.print_exc()  # Print full stack trace for better debugging
+        log.exception("Failed to build container %s: %s", tag, e)
     except Exception as e:
-        print(f"Error while building/running container {tag}: {e}")
-        traceback.print_exc()  # Print full stack trace for better debugging
+        log.exception("Error while building/running container %s: %s", tag, e)
+    return None
 
 
 
@@ -99,45 +128,50 @@ def map_nodes(pairs):
 
 
 
-def sequential_build_and_run_with_map(node_map):
+def parallel_build_and_run_with_map(node_map, concurrency=BRINGUP_CONCURRENCY, auth_rate=AUTH_RATE, allocator=None, hosts=None):
     """
-    Build and run VPN nodes sequentially using the node map.
-    Ensures each container is fully built before moving to the next.
+    Build and run VPN nodes in parallel through the bring-up scheduler.
+    At most `concurrency` nodes connect at once and provider logins are rate limited.
+    Each node is gated on its own status report; only nodes that fail are relaunched.
+    Nodes are spread over the Docker hosts in fleet_hosts.json (or `hosts`, a FleetHosts) by capacity.
+    Returns the names of the nodes that never became ready.
     """
-    def run_container(node_name, vpn_type, ovpn_file, port, socks_port):
-        build_and_run_container(node_name, ovpn_file, port, socks_port, vpn_type)
-
-    # Define port ranges: UDP on odd nodes, TCP on even nodes
-    udp_ports = range(8080, 8080 + len(node_map), 2)  # UDP ports start from 8080, assigned to odd nodes
-    tcp_ports = range(8081, 8081 + len(node_map), 2)  # TCP ports start from 8081, assigned to even nodes
-    socks_ports = range(9090, 9090 + len(node_map))  # SOCKS5 proxy ports (9090, 9091, ...)
-
-    udp_port_index = 0  # UDP port index
-    tcp_port_index = 0  # TCP port index
-
+    # Ports come from the shared lease table so build, compose and the monitor agree
+    allocator = allocator or PortAllocator()
+    allocator.lease_many(f"vpn_node_{node_num}" for node_num, _, _ in node_map)
+
+    hosts = hosts or FleetHosts()
+    reports = open_reports()  # manage_vpns' inbox when it runs this script; remote nodes' reports reach it through the aggregator
+    placements = hosts.place([f"vpn_node_{node_num}" for node_num, _, _ in node_map])
+    if not hosts.single_host:
+        for host_name, count in hosts.load().items():
+            log.info("%s nodes placed on host %s (capacity %s).", count, host_name, hosts.capacity(host_name))
+
+    # One scan of the kernel socket tables covers every local node's ports
+    for node_name, ports in allocator.conflicts().items():
+        if hosts.is_local(placements.get(node_name, hosts.host_of(node_name))):
+            log.warning("Ports %s leased to %s are already bound on this host.", ports, node_name)
+
+    nodes = []
     for node_num, vpn_type, ovpn_file in node_map:
         node_name = f"vpn_node_{node_num}"
+        lease = allocator.lease(node_name)
+        nodes.append({"name": node_name, "vpn_type": vpn_type, "ovpn_file": ovpn_file,
+                      "port": lease["open_port"], "socks_port": lease["socks5_port"]})
 
-        # Assign ports based on whether it's UDP or TCP, use the node number for SOCKS5 port assignment
-        if vpn_type == "udp":
-            port = udp_ports[udp_port_index]
-            socks_port = socks_ports[node_num - 1]  # SOCKS5 port is based on node_num
-            print(f"Building and running UDP container {node_name} on port {port} and SOCKS5 {socks_port}...")
-            run_container(node_name, vpn_type, ovpn_file, port, socks_port)
-            udp_port_index += 1
-        else:
-            port = tcp_ports[tcp_port_index]
-            socks_port = socks_ports[node_num - 1]  # SOCKS5 port is based on node_num
-            print(f"Building and running TCP container {node_name} on port {port} and SOCKS5 {socks_port}...")
-            run_container(node_name, vpn_type, ovpn_file, port, socks_port)
-            tcp_port_index += 1
-
-        # Ensure container is fully built and running before proceeding
-        print(f"Container {node_name} started successfully.")
-
-
+    def launch(node):
+        host_name = hosts.host_of(node["name"])
+        log.info("Building and running %s container %s on host %s, port %s and SOCKS5 %s...",
+                 node['vpn_type'].upper(), node['name'], host_name, node['port'], node['socks_port'])
+        return build_and_run_container(node["name"], node["ovpn_file"], node["port"], node["socks_port"], node["vpn_type"],
+                                       hosts.client(host_name))
 
+    def ready(node, container):
+        return wait_until_ready(container, reports)
 
+    scheduler = BringupScheduler(launch, ready, concurrency=concurrency, auth_rate=auth_rate)
+    scheduler.run(nodes)
+    return scheduler.failed()
 
 
 def setup_proxy_in_container(container_id, socks_port=9090):
@@ -145,32 +179,32 @@ def setup_proxy_in_container(container_id, socks_port=9090):
     Set up a SOCKS proxy inside the running container using SSH.
     """
     try:
-        # Use Docker exec to run the SOCKS proxy setup inside the container on the specified SOCKS5 port
+        # Run the SOCKS proxy through the exec API; ssh -N never exits, so it is detached
         command = f"ssh -D 0.0.0.0:{socks_port} -q -C -N root@localhost"
-        print(f"Setting up SOCKS proxy in container {container_id} on port {socks_port} with command: {command}")
-        subprocess.run(["docker", "exec", container_id, "/bin/bash", "-c", command], check=True)
-        print(f"Proxy successfully set up on port {socks_port} for container {container_id}")
+        log.debug("Setting up SOCKS proxy in container %s on port %s with command: %s", container_id, socks_port, command)
+        exec_in_container(container_id, command, detach=True, client=client)
+        log.info("Proxy successfully set up on port %s for container %s", socks_port, container_id)
 
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to set up proxy in container {container_id}: {e}")
+    except docker.errors.APIError as e:
+        log.error("Failed to set up proxy in container %s: %s", container_id, e)
 
 
 
 
-def cleanup_container(tag):
+def cleanup_container(tag, client=client):
     """
     Stop and remove a Docker container if it exists.
     """
     try:
-        print(f"Cleaning up container {tag}...")
+        log.debug("Cleaning up container %s...", tag)
         container = client.containers.get(tag)
         container.stop()
         container.remove()
-        print(f"Container {tag} cleaned up.")
+        log.info("Container %s cleaned up.", tag)
     except docker.errors.NotFound:
-        print(f"Container {tag} not found. Skipping cleanup.")
+        log.debug("Container %s not found. Skipping cleanup.", tag)
     except Exception as e:
-        print(f"Error during cleanup of {tag}: {e}")
+        log.error("Error during cleanup of %s: %s", tag, e)
 
 
 def cleanup_existing_containers():
@@ -178,62 +212,30 @@ def cleanup_existing_containers():
     Stop and remove all existing VPN containers before starting the new setup.
     """
     try:
-        # Get a list of all running containers with the prefix 'vpn_node'
-        containers = client.containers.list(all=True, filters={"name": "vpn_node"})
-
-        if containers:
-            print("Cleaning up existing VPN node containers...")
-            for container in containers:
-                try:
-                    print(f"Cleaning up container {container.name} (ID: {container.id})...")
-                    container.stop()
-                    container.remove()
-                    print(f"Container {container.name} (ID: {container.id}) stopped and removed.")
-                except Exception as e:
-                    print(f"[ERROR] Error cleaning up container {container.name} (ID: {container.id}): {e}")
-        else:
-            print("No existing VPN containers found.")
-        
-        # Optionally prune system to remove any unused images, containers, volumes
-        print("Docker system prune to remove unused images and volumes...")
-        client.containers.prune()
-        client.images.prune()
+        # Parallel, label-scoped teardown on every fleet host; unrelated containers and images are left alone
+        for host_name, host_client in FleetHosts().clients():
+            if not teardown_fleet(host_client):
+                log.info("No existing VPN containers found on host %s.", host_name)
 
     except Exception as e:
-        print(f"[ERROR] Error during container cleanup: {e}")
+        log.error("Error during container cleanup: %s", e)
 
 
 
 
-def get_matching_ovpn_files(udp_directory, tcp_directory, udp_node_count, tcp_node_count):
+def get_matching_ovpn_files(selector, udp_node_count, tcp_node_count, max_per_region=MAX_PER_REGION):
     """
-    Get a specified number of UDP .ovpn files and find matching TCP files from both directories.
-    Ensure that UDP and TCP files from the same server are paired and assigned sequentially.
+    Get a specified number of UDP .ovpn files and their matching TCP files from the catalog,
+    fastest server locations first. UDP and TCP files are paired by the server location parsed from each file.
     """
-    udp_ovpn_files = list(Path(udp_directory).glob("*.ovpn"))
-    tcp_ovpn_files = list(Path(tcp_directory).glob("*.ovpn"))
-
-    # Create a mapping of server names to their respective TCP and UDP files
-    udp_files_dict = {udp_file.stem.replace('-udp', ''): udp_file for udp_file in udp_ovpn_files}
-    tcp_files_dict = {tcp_file.stem.replace('-tcp', ''): tcp_file for tcp_file in tcp_ovpn_files}
-
-    selected_pairs = []
-
-    # Match UDP and TCP by location
-    for server_name, udp_file in udp_files_dict.items():
-        if server_name in tcp_files_dict:
-            tcp_file = tcp_files_dict[server_name]
-            selected_pairs.append((udp_file, tcp_file))  # Pair UDP and TCP files in sequence
-
-        # Stop when we've reached the requested number of UDP and TCP pairs
-        if len(selected_pairs) >= min(udp_node_count, tcp_node_count):
-            break
+    selected_pairs = [(Path(udp_entry["path"]), Path(tcp_entry["path"]))
+                      for udp_entry, tcp_entry in selector.select_pairs(min(udp_node_count, tcp_node_count), max_per_region)]
 
     # Ensure we have enough pairs of matching files
     if len(selected_pairs) < udp_node_count:
         raise ValueError(f"Not enough matching UDP and TCP .ovpn files found. Found {len(selected_pairs)}.")
 
-    print(f"Selected {len(selected_pairs)} UDP and TCP pairs in sequence.")
+    log.info("Selected %s UDP and TCP pairs by latency.", len(selected_pairs))
     
     return selected_pairs
 
@@ -242,29 +244,33 @@ def main():
     parser = argparse.ArgumentParser(description="VPN Node Manager")
     parser.add_argument("udp_node_count", type=int, help="Number of UDP nodes to create")
     parser.add_argument("tcp_node_count", type=int, help="Number of TCP nodes to create")
+    parser.add_argument("--concurrency", type=int, default=BRINGUP_CONCURRENCY, help="Nodes brought up at the same time")
+    parser.add_argument("--auth-rate", type=float, default=AUTH_RATE, help="Provider logins per second across the fleet")
+    parser.add_argument("--max-per-region", type=int, default=MAX_PER_REGION, help="Take at most this many locations per region before repeating a region")
     args = parser.parse_args()
 
     udp_node_count = args.udp_node_count
     tcp_node_count = args.tcp_node_count
 
-    udp_directory = './ovpn_files/udp'
-    tcp_directory = './ovpn_files/tcp'
-
     # Step 1: Cleanup existing containers
     cleanup_existing_containers()
 
     # Step 2: Get matching pairs of UDP and TCP .ovpn files
-    pairs = get_matching_ovpn_files(udp_directory, tcp_directory, udp_node_count, tcp_node_count)
+    pairs = get_matching_ovpn_files(ServerSelector(load_catalog()), udp_node_count, tcp_node_count, args.max_per_region)
 
     # Step 3: Create a map of nodes where the first is UDP, second is TCP, etc.
     node_map = map_nodes(pairs)
 
-    # Step 4: Build containers sequentially to avoid race conditions
+    # Step 4: Bring nodes up in parallel, fastest locations first, gated on each node's readiness
     start_time = time.time()
-    sequential_build_and_run_with_map(node_map)
+    failed_nodes = parallel_build_and_run_with_map(node_map, args.concurrency, args.auth_rate)
     end_time = time.time()
 
-    print(f"Completed {udp_node_count + tcp_node_count} VPN nodes setup in {end_time - start_time} seconds.")
+    log.info("Completed %s VPN nodes setup in %.2f seconds.", udp_node_count + tcp_node_count, end_time - start_time)
+    log.info("Docker API usage during bring-up:\n%s", format_api_stats())
+    if failed_nodes:
+        log.error("Nodes that never became ready: %s", ', '.join(failed_nodes))
+        sys.exit(BRINGUP_FAILED_EXIT)
 
 if __name__ == "__main__":
     main()
@@ -2,6 +2,7 @@
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import os
 import time
 import traceback
@@ -11,6 +12,11 @@ import threading
 from io import StringIO
 from pathlib import Path
 from streamlit_autorefresh import st_autorefresh
+from node_state import NodeStateStore, traffic_summary, TRAFFIC_WINDOW
+from node_history import NodeHistory, ROLLUP_FLUSH_INTERVAL
+from sharded_store import ShardedStore
+
+HISTORY_DAYS = 7  # Range of the uptime and fleet health charts
 
 # Set Streamlit to wide mode by default
 st.set_page_config(layout="wide")
@@ -65,7 +71,11 @@ def on_open(ws):
 
 
 # Function to scan for CSV file in the current working directory (CWD)
+# With VPN_CSV_SHARDS set, the sharded store stands in for the file and is read as one merged table
 def find_csv_file():
+    store = ShardedStore.from_env()
+    if store is not None:
+        return store
     for file in os.listdir(os.getcwd()):
         if file.endswith(".csv"):
             return Path(file)
@@ -78,12 +88,13 @@ def load_csv_data(csv_file):
         log_message(f"[INFO] Attempting to load CSV file: {csv_file}")
         
         # Use pandas for loading and processing the CSV file
-        df = pd.read_csv(csv_file, na_values=["N/A", "n/a", "NA", "n/a"])
+        source = StringIO(csv_file.merged_csv_text()) if isinstance(csv_file, ShardedStore) else csv_file
+        df = pd.read_csv(source, na_values=["N/A", "n/a", "NA", "n/a"])
 
         log_message(f"[INFO] CSV loaded successfully. Columns: {df.columns.tolist()}")
 
         # Ensure numeric columns are treated as numbers
-        numeric_columns = ['Open Port']
+        numeric_columns = ['Open Port', 'Last Updated']  # 'Last Updated' is epoch seconds
         for col in numeric_columns:
             df[col] = pd.to_numeric(df[col], errors='coerce')  # Safely handle errors for numeric columns
 
@@ -101,10 +112,89 @@ def load_csv_data(csv_file):
         st.error(error_message)
         return None
 
+# Load the per-node state written by the monitor (traffic counters from the Squid access logs)
+def load_node_state():
+    return NodeStateStore.load().snapshot()
+
+
+# Chart data comes from the minute/hour rollups kept by node_history.py, read at most once per flush
+@st.cache_data(ttl=ROLLUP_FLUSH_INTERVAL)
+def load_history(days=HISTORY_DAYS):
+    history = NodeHistory()
+    now = time.time()
+    return (history.node_uptime_series(now - days * 86400),
+            history.fleet_healthy_series(now - days * 86400),
+            history.fleet_healthy_series(now - 86400, resolution="minute"))
+
+
+def create_history_charts():
+    """
+    Fleet healthy-count charts, per-node uptime sparklines and a connectivity timeline for one node.
+    """
+    uptime, fleet_hourly, fleet_minutely = load_history()
+    if not fleet_hourly:
+        st.info("No node history recorded yet.")
+        return
+
+    st.markdown("### Fleet Health History")
+    hourly_tab, minutely_tab = st.tabs([f"Last {HISTORY_DAYS} days (hourly)", "Last 24 hours (per minute)"])
+    for tab, points in ((hourly_tab, fleet_hourly), (minutely_tab, fleet_minutely)):
+        fleet = pd.DataFrame(points, columns=["Time", "Healthy Nodes", "Observed Nodes"])
+        fleet["Time"] = pd.to_datetime(fleet["Time"], unit="s")
+        tab.line_chart(fleet.set_index("Time"))
+
+    st.markdown(f"### Node Uptime (last {HISTORY_DAYS} days)")
+    uptime_table = pd.DataFrame({
+        "Node Name": list(uptime),
+        "Uptime %": [round(100 * sum(fraction for _, fraction in series) / len(series), 1) for series in uptime.values()],
+        "Hourly Uptime %": [[round(100 * fraction, 1) for _, fraction in series] for series in uptime.values()],
+    })
+    st.dataframe(uptime_table, hide_index=True, use_container_width=True, column_config={
+        "Hourly Uptime %": st.column_config.LineChartColumn("Hourly Uptime %", y_min=0, y_max=100),
+    })
+
+    st.markdown("### Connectivity Timeline")
+    node_name = st.selectbox("Node", list(uptime), key="timeline_node")
+    if node_name:
+        timeline = pd.DataFrame(uptime[node_name], columns=["Time", "Connected %"])
+        timeline["Time"] = pd.to_datetime(timeline["Time"], unit="s")
+        timeline["Connected %"] *= 100
+        st.area_chart(timeline.set_index("Time"))
+
+
+def format_ages(last_updated, now=None):
+    """
+    Turn a column of epoch timestamps into "x seconds/minutes/hours/days ago" in one vectorized pass.
+    """
+    now = time.time() if now is None else now
+    seconds = (now - pd.to_numeric(last_updated, errors='coerce')).clip(lower=0)
+    conditions = [seconds < 60, seconds < 3600, seconds < 86400]
+    amounts = np.select(conditions, [seconds, seconds // 60, seconds // 3600], seconds // 86400)
+    units = np.select(conditions, ["seconds", "minutes", "hours"], "days")
+    ages = pd.Series(np.nan_to_num(amounts).astype(int).astype(str), index=last_updated.index) + " " + units + " ago"
+    return ages.where(seconds.notna(), "N/A")
+
+
+def add_traffic_columns(data, node_state):
+    """
+    Add requests/sec, bytes and error rate columns from the node state store to the node table.
+    """
+    summaries = {node_name: traffic_summary(state) for node_name, state in node_state.items()}
+    empty = {"requests_per_sec": 0.0, "bytes": 0, "error_rate": 0.0}
+    rows = [summaries.get(node_name, empty) for node_name in data['Node Name']]
+
+    data = data.copy()
+    data['Req/s'] = [round(row["requests_per_sec"], 2) for row in rows]
+    data[f'Bytes ({TRAFFIC_WINDOW}s)'] = [row["bytes"] for row in rows]
+    data['Error %'] = [round(row["error_rate"] * 100, 1) for row in rows]
+    return data
+
+
 # Detect if the CSV file has been updated based on its last modification time
 def check_csv_update(csv_file_path):
     try:
-        current_mod_time = os.path.getmtime(csv_file_path)
+        # Shard writers replace files in the store's directory, which updates the directory's own mtime
+        current_mod_time = os.path.getmtime(csv_file_path.directory if isinstance(csv_file_path, ShardedStore) else csv_file_path)
         if 'last_mod_time' not in st.session_state or st.session_state.last_mod_time != current_mod_time:
             st.session_state.last_mod_time = current_mod_time
             log_message(f"[INFO] Detected changes in CSV file: {csv_file_path}")
@@ -131,11 +221,14 @@ def check_auto_refresh():
         # Trigger the page refresh at the specified interval
         st_autorefresh(interval=st.session_state.refresh_interval * 1000, key="auto_refresh")
 
-def create_dashboard(data):
+def create_dashboard(data, node_state=None):
     if data is None:
         st.error("No valid data found to display")
         return
 
+    if node_state is None:
+        node_state = load_node_state()
+
     # Set the title once
     st.title("VPN Nodes Information - Real-Time Dashboard")
 
@@ -195,11 +288,26 @@ def create_dashboard(data):
         else:
             col1.markdown(f"🔴 **{row.get('Node Name', 'Unknown Node')}** - No Status Found")
 
-    # Render the dynamic table using HTML
+    # Fleet-wide traffic from the Squid access logs
+    data = add_traffic_columns(data, node_state)
+    st.markdown("### Proxy Traffic")
+    traffic_col1, traffic_col2, traffic_col3 = st.columns(3)
+    total_requests = data['Req/s'].sum()
+    traffic_col1.metric("Requests/sec", f"{total_requests:.2f}")
+    traffic_col2.metric(f"Bytes (last {TRAFFIC_WINDOW}s)", f"{data[f'Bytes ({TRAFFIC_WINDOW}s)'].sum():,}")
+    weighted_errors = (data['Req/s'] * data['Error %']).sum()
+    traffic_col3.metric("Error Rate", f"{weighted_errors / total_requests if total_requests else 0.0:.1f}%")
+
+    # Render the dynamic table using HTML; ages are computed now, not when the row was written
     st.markdown("### Node Data Table")
+    if 'Last Updated' in data:
+        data['Last Updated'] = format_ages(data['Last Updated'])
     table_html = data.to_html(index=False)
     st.markdown(f'<div>{table_html}</div>', unsafe_allow_html=True)
 
+    # Uptime and fleet health over time
+    create_history_charts()
+
 
 
 
@@ -0,0 +1,152 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import re
+import threading
+import time
+
+import docker
+
+from fleet_teardown import NODE_NAME_FILTER
+from metrics import emitter
+from vpn_logging import get_logger
+
+log = get_logger("docker_client")
+
+DOCKER_POOL_SIZE = 32  # Keep-alive connections per process; covers the bring-up and restart pools
+DOCKER_TIMEOUT = 60
+
+# /v1.43/containers/<id>/json -> /containers/{id}/json
+API_VERSION_PREFIX = re.compile(r"^/v\d+\.\d+")
+RESOURCE_PATH = re.compile(r"^/(containers|images|networks|volumes|exec|plugins)/(?!json$|create$|prune$|load$|search$)[^/]+")
+
+_clients = {}  # base URL (None for the environment's daemon) -> client
+_client_lock = threading.Lock()
+
+
+class APIStats:
+    """
+    Count and time every Docker API request, grouped by method and path template.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # "GET /containers/{id}/json" -> [count, total seconds, max seconds]
+
+    def record(self, endpoint, seconds):
+        with self.lock:
+            stats = self.calls.setdefault(endpoint, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    @staticmethod
+    def _as_dict(calls):
+        return {endpoint: {"count": count, "seconds": total, "max_seconds": longest}
+                for endpoint, (count, total, longest) in calls.items()}
+
+    def snapshot(self):
+        with self.lock:
+            return self._as_dict(self.calls)
+
+    def reset(self):
+        """
+        Return the stats collected so far and start counting from zero.
+        """
+        with self.lock:
+            calls, self.calls = self.calls, {}
+        return self._as_dict(calls)
+
+    def totals(self):
+        with self.lock:
+            return sum(stats[0] for stats in self.calls.values()), sum(stats[1] for stats in self.calls.values())
+
+
+api_stats = APIStats()
+
+
+def endpoint_of(method, url):
+    path = url.split("://", 1)[-1]
+    path = path[path.find("/"):] if "/" in path else "/"
+    path = API_VERSION_PREFIX.sub("", path.split("?", 1)[0])
+    return f"{method} {RESOURCE_PATH.sub(lambda match: f'/{match.group(1)}/{{id}}', path)}"
+
+
+class InstrumentedAPIClient(docker.APIClient):
+    """
+    Low-level client that records the latency of every HTTP request it sends.
+    Streaming responses are timed up to their headers.
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().request(method, url, *args, **kwargs)
+        finally:
+            endpoint, seconds = endpoint_of(method, url), time.perf_counter() - start
+            api_stats.record(endpoint, seconds)
+            emitter.observe("vpn_docker_api_request_duration_seconds", seconds, {"endpoint": endpoint})
+
+
+class InstrumentedDockerClient(docker.DockerClient):
+    def __init__(self, *args, **kwargs):
+        self.api = InstrumentedAPIClient(*args, **kwargs)
+
+
+def get_client(base_url=None):
+    """
+    Return the process-wide Docker client for a daemon, created on first use with a pool sized for
+    parallel work. Without `base_url` the daemon comes from the environment (DOCKER_HOST or the local socket).
+    """
+    client = _clients.get(base_url)
+    if client is None:
+        with _client_lock:
+            client = _clients.get(base_url)
+            if client is None:
+                if base_url is None:
+                    client = InstrumentedDockerClient.from_env(max_pool_size=DOCKER_POOL_SIZE, timeout=DOCKER_TIMEOUT)
+                else:
+                    client = InstrumentedDockerClient(base_url=base_url, max_pool_size=DOCKER_POOL_SIZE, timeout=DOCKER_TIMEOUT)
+                _clients[base_url] = client
+    return client
+
+
+def register_client(client, base_url=None):
+    """
+    Make get_client(base_url) return `client`, e.g. a stand-in daemon for benchmarks and load tests.
+    Must run before the modules that create their client at import time are imported.
+    """
+    with _client_lock:
+        _clients[base_url] = client
+
+
+def format_api_stats(stats=None):
+    """
+    One line per endpoint, busiest first, for the end-of-pass log.
+    """
+    stats = api_stats.snapshot() if stats is None else stats
+    lines = []
+    for endpoint, entry in sorted(stats.items(), key=lambda item: -item[1]["seconds"]):
+        average_ms = 1000 * entry["seconds"] / entry["count"]
+        lines.append(f"{endpoint}: {entry['count']} calls, {entry['seconds']:.2f}s total, "
+                     f"{average_ms:.1f}ms avg, {1000 * entry['max_seconds']:.1f}ms max")
+    return "\n".join(lines)
+
+
+def get_container_ids(name_filter=NODE_NAME_FILTER, client=None):
+    """
+    IDs (12 characters, newest first) of all containers whose name matches, without running `docker ps`.
+    """
+    client = client or get_client()
+    containers = client.containers.list(all=True, filters={"name": name_filter}, sparse=True)
+    return [container.id[:12] for container in containers]
+
+
+def exec_in_container(container_id, command, detach=False, client=None):
+    """
+    Run a shell command in a container through the exec API instead of `docker exec`.
+    Returns (exit code, output); the exit code is None for detached commands.
+    """
+    client = client or get_client()
+    container = client.containers.get(container_id)
+    result = container.exec_run(["/bin/bash", "-c", command], detach=detach)
+    output = result.output.decode(errors="replace") if isinstance(result.output, bytes) else result.output
+    return result.exit_code, output
@@ -0,0 +1,571 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import asyncio
+import hashlib
+import heapq
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+import docker
+from docker.models.containers import ExecResult
+
+from async_monitor import DockerAPIError
+from node_reports import ReportClient, CONTAINER_REPORTS_DIR, REPORT_SOCKET
+from vpn_logging import get_logger
+
+log = get_logger("docker_sim")
+
+# A stand-in Docker daemon for load testing the control plane without real containers or VPN logins.
+# Simulated nodes start, post their status report after a random delay, and exit or fail
+# authentication at configurable rates, like start_vpn.sh does in a real node.
+REPORT_DELAY = (2.0, 10.0)  # Seconds from start until a node posts its status report (uniform)
+EXIT_RATE = 0.0  # Chance per second that a running node's tunnel dies and the container exits
+AUTH_FAILURE_RATE = 0.0  # Chance that a start ends in "Auth Failed" instead of a working tunnel
+TUNNEL_FAILURE_RATE = 0.0  # Chance that a start reports "VPN failed to start" and exits
+REPORT_WORKERS = 16  # Threads posting reports to the ingest socket; posting never blocks the lifecycle thread
+EVENT_HISTORY = 10000  # Events kept for late event-stream readers
+EVENT_POLL_INTERVAL = 0.1  # Seconds between event-log checks in the async event stream
+TICK = 0.05  # Longest the lifecycle thread sleeps before rechecking its schedule
+
+
+def _timestamp(seconds):
+    if seconds is None:
+        return "0001-01-01T00:00:00Z"
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _age(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds} seconds"
+    if seconds < 3600:
+        return f"{seconds // 60} minutes"
+    return f"{seconds // 3600} hours"
+
+
+def _values(value):
+    return value if isinstance(value, (list, tuple)) else [value]
+
+
+def _not_found(kind, key):
+    return docker.errors.NotFound(f"No such {kind}: {key}")
+
+
+class SimNode:
+    """
+    One simulated container. `run` counts starts, so work scheduled for an earlier run is dropped.
+    """
+
+    def __init__(self, container_id, name, image, labels, environment, volumes):
+        self.id = container_id
+        self.name = name
+        self.image = image
+        self.labels = dict(labels or {})
+        self.environment = dict(environment or {})
+        self.volumes = dict(volumes or {})
+        self.created = time.time()
+        self.status = "created"
+        self.run = 0
+        self.restart_count = -1  # The first start is not a restart
+        self.started_at = None
+        self.finished_at = None
+        self.exit_code = 0
+        self.removed = False
+
+    @property
+    def report_socket(self):
+        """
+        Host path of the ingest socket the node posts to, from the volume bound at CONTAINER_REPORTS_DIR.
+        """
+        for host_path, bind in self.volumes.items():
+            if isinstance(bind, dict) and bind.get("bind") == CONTAINER_REPORTS_DIR:
+                return Path(host_path) / REPORT_SOCKET.name
+        return None
+
+    def status_text(self, now):
+        if self.status == "running":
+            return f"Up {_age(now - self.started_at)}"
+        if self.status == "exited":
+            return f"Exited ({self.exit_code}) {_age(now - self.finished_at)} ago"
+        return self.status.capitalize()
+
+    def summary(self, now):
+        return {
+            "Id": self.id, "Names": [f"/{self.name}"], "Image": self.image, "Created": int(self.created),
+            "State": self.status, "Status": self.status_text(now), "Labels": dict(self.labels),
+        }
+
+    def details(self):
+        return {
+            "Id": self.id, "Name": f"/{self.name}", "Image": self.image, "Created": _timestamp(self.created),
+            "RestartCount": max(0, self.restart_count),
+            "State": {"Status": self.status, "Running": self.status == "running", "ExitCode": self.exit_code,
+                      "StartedAt": _timestamp(self.started_at), "FinishedAt": _timestamp(self.finished_at)},
+            "Config": {"Image": self.image, "Labels": dict(self.labels),
+                       "Env": [f"{key}={value}" for key, value in self.environment.items()]},
+            "HostConfig": {"Binds": [f"{host}:{bind['bind']}:{bind.get('mode', 'rw')}" for host, bind in self.volumes.items()
+                                     if isinstance(bind, dict)]},
+        }
+
+
+class SimDocker:
+    """
+    The simulated daemon behind SimClient and SimAsyncDocker: containers, images, the event log
+    and a lifecycle thread that plays each running node's script (report, then maybe exit).
+    Reports go to the socket mounted at CONTAINER_REPORTS_DIR, or to `reports` (anything with put()) if given.
+    """
+
+    def __init__(self, report_delay=REPORT_DELAY, exit_rate=EXIT_RATE, auth_failure_rate=AUTH_FAILURE_RATE,
+                 tunnel_failure_rate=TUNNEL_FAILURE_RATE, reports=None, seed=None, report_workers=REPORT_WORKERS):
+        self.report_delay = report_delay
+        self.exit_rate = exit_rate
+        self.auth_failure_rate = auth_failure_rate
+        self.tunnel_failure_rate = tunnel_failure_rate
+        self.reports = reports
+        self.rng = random.Random(seed)
+        self.lock = threading.Condition()
+        self.nodes = {}  # full container id -> SimNode
+        self.names = {}  # container name -> SimNode
+        self.short_ids = {}  # 12 character id -> SimNode
+        self.images = {}  # tag or id -> image id
+        self.schedule = []  # heap of (due, sequence, action, container id, run)
+        self.sequence = 0
+        self.event_log = []
+        self.event_offset = 0  # Sequence number of event_log[0]
+        self.stats = {"starts": 0, "reports": 0, "report_errors": 0, "auth_failures": 0, "tunnel_failures": 0, "exits": 0}
+        self.poster = ThreadPoolExecutor(max_workers=report_workers, thread_name_prefix="sim-report")
+        self.stopped = threading.Event()
+        threading.Thread(target=self._run_lifecycle, name="sim-lifecycle", daemon=True).start()
+
+    def client(self):
+        return SimClient(self)
+
+    def async_client(self):
+        return SimAsyncDocker(self)
+
+    # Containers
+
+    def _new_id(self):
+        return f"{self.rng.getrandbits(256):064x}"
+
+    def find(self, key):
+        """
+        Look a container up by name, full ID or ID prefix, like the daemon does. Raises NotFound.
+        """
+        with self.lock:
+            node = self.nodes.get(key) or self.names.get(key.lstrip("/")) or self.short_ids.get(key)
+            if node is None and len(key) >= 4:
+                node = next((candidate for candidate in self.nodes.values() if candidate.id.startswith(key)), None)
+        if node is None:
+            raise _not_found("container", key)
+        return node
+
+    def create(self, image, name=None, labels=None, environment=None, volumes=None, container_id=None):
+        with self.lock:
+            container_id = container_id.ljust(64, "0") if container_id else self._new_id()
+            name = name or f"sim_{container_id[:12]}"
+            if name in self.names:
+                raise docker.errors.APIError(f'Conflict. The container name "/{name}" is already in use')
+            node = SimNode(container_id, name, image, labels, environment, volumes)
+            self.nodes[container_id] = self.names[name] = self.short_ids[container_id[:12]] = node
+            self._emit(node, "create")
+        return node
+
+    def start(self, node):
+        with self.lock:
+            if node.status == "running":
+                return
+            now = time.time()
+            node.status = "running"
+            node.run += 1
+            node.restart_count += 1
+            node.started_at = now
+            node.exit_code = 0
+            self.stats["starts"] += 1
+            self._emit(node, "start")
+            self._schedule(self.rng.uniform(*self.report_delay), "report", node)
+            if self.exit_rate > 0:
+                self._schedule(self.rng.expovariate(self.exit_rate), "exit", node)
+
+    def stop(self, node, exit_code=143):
+        with self.lock:
+            if node.status != "running":
+                return
+            node.status = "exited"
+            node.exit_code = exit_code
+            node.finished_at = time.time()
+            self._emit(node, "die", exitCode=str(exit_code))
+
+    def restart(self, node):
+        self.stop(node)
+        self.start(node)
+        with self.lock:
+            self._emit(node, "restart")
+
+    def remove(self, node, force=False):
+        with self.lock:
+            if node.status == "running":
+                if not force:
+                    raise docker.errors.APIError(f"You cannot remove a running container {node.id}. Stop the container before attempting removal or force remove")
+                self.stop(node, 137)
+            node.removed = True
+            self.nodes.pop(node.id, None)
+            self.names.pop(node.name, None)
+            self.short_ids.pop(node.id[:12], None)
+            self._emit(node, "destroy")
+
+    def rename(self, node, name):
+        with self.lock:
+            if self.names.get(name, node) is not node:
+                raise docker.errors.APIError(f'Conflict. The container name "/{name}" is already in use')
+            self.names.pop(node.name, None)
+            node.name = name
+            self.names[name] = node
+            self._emit(node, "rename")
+
+    def list(self, all=False, filters=None):
+        """
+        Containers matching the list API's filters (name, label, status, id), newest first.
+        """
+        filters = filters or {}
+        with self.lock:
+            nodes = sorted(self.nodes.values(), key=lambda node: node.created, reverse=True)
+        if not all and "status" not in filters:
+            nodes = [node for node in nodes if node.status == "running"]
+        for name in _values(filters.get("name", [])):
+            nodes = [node for node in nodes if re.search(name, node.name)]
+        for label in _values(filters.get("label", [])):
+            key, has_value, value = label.partition("=")
+            nodes = [node for node in nodes if key in node.labels and (not has_value or node.labels[key] == value)]
+        if "status" in filters:
+            statuses = set(_values(filters["status"]))
+            nodes = [node for node in nodes if node.status in statuses]
+        if "id" in filters:
+            prefixes = _values(filters["id"])
+            nodes = [node for node in nodes if any(node.id.startswith(prefix) for prefix in prefixes)]
+        return nodes
+
+    # Images
+
+    def image_id(self, tag):
+        with self.lock:
+            image_id = self.images.get(tag)
+        if image_id is None:
+            raise docker.errors.ImageNotFound(f"No such image: {tag}")
+        return image_id
+
+    def add_image(self, tag):
+        image_id = f"sha256:{hashlib.sha256(tag.encode()).hexdigest()}"
+        with self.lock:
+            self.images[tag] = self.images[image_id] = image_id
+        return image_id
+
+    # Events
+
+    def _emit(self, node, action, **attributes):
+        """
+        Append a container event in the daemon's format. Called with the lock held.
+        """
+        now = time.time()
+        self.event_log.append({
+            "Type": "container", "Action": action, "status": action, "id": node.id, "from": node.image,
+            "Actor": {"ID": node.id, "Attributes": {"name": node.name, "image": node.image, **node.labels, **attributes}},
+            "scope": "local", "time": int(now), "timeNano": int(now * 1e9),
+        })
+        if len(self.event_log) > 2 * EVENT_HISTORY:
+            del self.event_log[:EVENT_HISTORY]
+            self.event_offset += EVENT_HISTORY
+        self.lock.notify_all()
+
+    def events_from(self, cursor, since=None):
+        """
+        (events after `cursor`, new cursor). A cursor of None starts at the first event at or after `since`.
+        """
+        with self.lock:
+            if cursor is None:
+                cursor = self.event_offset + len(self.event_log)
+                if since is not None:
+                    cursor = self.event_offset + next((i for i, event in enumerate(self.event_log) if event["time"] >= int(since)),
+                                                      len(self.event_log))
+            start = max(0, cursor - self.event_offset)
+            events = self.event_log[start:]
+            return events, self.event_offset + len(self.event_log)
+
+    def wait_for_events(self, cursor, timeout):
+        with self.lock:
+            self.lock.wait_for(lambda: self.event_offset + len(self.event_log) > cursor or self.stopped.is_set(), timeout)
+
+    # Node lifecycle
+
+    def _schedule(self, delay, action, node):
+        self.sequence += 1
+        heapq.heappush(self.schedule, (time.monotonic() + delay, self.sequence, action, node.id, node.run))
+        self.lock.notify_all()
+
+    def _run_lifecycle(self):
+        while not self.stopped.is_set():
+            with self.lock:
+                now = time.monotonic()
+                due = []
+                while self.schedule and self.schedule[0][0] <= now:
+                    due.append(heapq.heappop(self.schedule))
+                if not due:
+                    timeout = min(TICK, self.schedule[0][0] - now) if self.schedule else TICK
+                    self.lock.wait(timeout)
+                    continue
+            for _, _, action, container_id, run in due:
+                try:
+                    self._play(action, container_id, run)
+                except Exception as e:
+                    log.exception("Simulated %s of %s failed: %s", action, container_id[:12], e)
+
+    def _play(self, action, container_id, run):
+        with self.lock:
+            node = self.nodes.get(container_id)
+            if node is None or node.run != run or node.status != "running":
+                return  # Stopped, restarted or removed since this was scheduled
+            if action == "exit":
+                self.stats["exits"] += 1
+                self.stop(node, 1)
+                return
+            roll = self.rng.random()
+            if roll < self.auth_failure_rate:
+                self.stats["auth_failures"] += 1
+                public_ip, proxy = "Auth Failed", ""
+            elif roll < self.auth_failure_rate + self.tunnel_failure_rate:
+                self.stats["tunnel_failures"] += 1
+                public_ip, proxy = "VPN failed to start", ""
+            else:
+                public_ip = f"{self.rng.randint(1, 223)}.{self.rng.randint(0, 255)}.{self.rng.randint(0, 255)}.{self.rng.randint(1, 254)}"
+                proxy = node.environment.get("SOCKS_PORT", "9090")
+            report = {"Node": node.id[:12], "Name": node.environment.get("NODE_NAME", node.name),
+                      "VPN File": node.environment.get("VPN_FILE", ""), "VPN_TYPE": node.environment.get("VPN_TYPE", "").upper(),
+                      "Public IP": public_ip, "Proxy Info": proxy}
+            if not proxy:
+                self.stop(node, 1)  # start_vpn.sh exits after reporting a failed start
+            self.poster.submit(self._post, node, report)
+
+    def _post(self, node, report):
+        target = self.reports
+        if target is None:
+            socket_path = node.report_socket
+            if socket_path is None:
+                return  # Not mounted: the node has nowhere to report
+            target = ReportClient(socket_path)
+        try:
+            target.put(report)
+            with self.lock:
+                self.stats["reports"] += 1
+        except Exception as e:
+            with self.lock:
+                self.stats["report_errors"] += 1
+            log.error("Simulated node %s could not post its report: %s", node.name, e)
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            self.lock.notify_all()
+        self.poster.shutdown(wait=False)
+
+
+class SimImage:
+    def __init__(self, image_id, tags):
+        self.id = image_id
+        self.short_id = image_id[:19]
+        self.tags = tags
+
+
+class SimImages:
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def get(self, name):
+        return SimImage(self.daemon.image_id(name), [name])
+
+    def pull(self, repository, tag=None, **kwargs):
+        name = f"{repository}:{tag}" if tag else repository
+        return SimImage(self.daemon.add_image(name), [name])
+
+    def build(self, path=None, tag=None, buildargs=None, labels=None, **kwargs):
+        tag = tag or f"sim_build_{time.time_ns()}"
+        image = SimImage(self.daemon.add_image(tag), [tag])
+        return image, iter([{"stream": f"Successfully tagged {tag}\n"}])
+
+    def prune(self, filters=None):
+        return {"ImagesDeleted": [], "SpaceReclaimed": 0}
+
+
+class SimContainer:
+    """
+    docker-py Container subset. Like docker-py, `status` and `attrs` are a snapshot refreshed by reload().
+    """
+
+    def __init__(self, daemon, node):
+        self.daemon = daemon
+        self.node = node
+        self.id = node.id
+        self.short_id = node.id[:12]
+        self.attrs = node.details()
+
+    @property
+    def name(self):
+        return self.attrs["Name"].lstrip("/")
+
+    @property
+    def status(self):
+        return self.attrs["State"]["Status"]
+
+    @property
+    def labels(self):
+        return self.attrs["Config"]["Labels"]
+
+    def _live(self):
+        if self.node.removed:
+            raise _not_found("container", self.id)
+        return self.node
+
+    def reload(self):
+        self.attrs = self._live().details()
+
+    def start(self, **kwargs):
+        self.daemon.start(self._live())
+
+    def stop(self, timeout=None):
+        self.daemon.stop(self._live())
+
+    def kill(self, signal=None):
+        node = self._live()
+        if node.status != "running":
+            raise docker.errors.APIError(f"Container {node.id} is not running")
+        self.daemon.stop(node, 143 if signal in ("SIGTERM", 15) else 137)
+
+    def restart(self, timeout=None):
+        self.daemon.restart(self._live())
+
+    def remove(self, v=False, force=False, link=False):
+        self.daemon.remove(self._live(), force)
+
+    def rename(self, name):
+        self.daemon.rename(self._live(), name)
+
+    def exec_run(self, cmd, detach=False, **kwargs):
+        if self._live().status != "running":
+            raise docker.errors.APIError(f"Container {self.id} is not running")
+        return ExecResult(None if detach else 0, None if detach else b"")
+
+
+class SimContainers:
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def run(self, image, command=None, detach=False, name=None, labels=None, environment=None, volumes=None, **kwargs):
+        node = self.daemon.create(image, name, labels, environment, volumes)
+        self.daemon.start(node)
+        return SimContainer(self.daemon, node)
+
+    def create(self, image, command=None, name=None, labels=None, environment=None, volumes=None, **kwargs):
+        return SimContainer(self.daemon, self.daemon.create(image, name, labels, environment, volumes))
+
+    def get(self, container_id):
+        return SimContainer(self.daemon, self.daemon.find(container_id))
+
+    def list(self, all=False, filters=None, sparse=False, **kwargs):
+        return [SimContainer(self.daemon, node) for node in self.daemon.list(all, filters)]
+
+
+class SimAPI:
+    """
+    Low-level APIClient subset (client.api) FleetSnapshot uses.
+    """
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def containers(self, all=False, filters=None, **kwargs):
+        now = time.time()
+        return [node.summary(now) for node in self.daemon.list(all, filters)]
+
+    def inspect_container(self, container):
+        return self.daemon.find(container).details()
+
+
+class SimPrunable:
+    def __init__(self, deleted_key):
+        self.deleted_key = deleted_key
+
+    def prune(self, filters=None):
+        return {self.deleted_key: [], "SpaceReclaimed": 0}
+
+
+class SimClient:
+    """
+    Stands in for docker.DockerClient: the parts of containers, images, networks, volumes,
+    api and events the fleet tools use. Register it with docker_client.register_client().
+    """
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.api = SimAPI(daemon)
+        self.containers = SimContainers(daemon)
+        self.images = SimImages(daemon)
+        self.networks = SimPrunable("NetworksDeleted")
+        self.volumes = SimPrunable("VolumesDeleted")
+
+    def events(self, decode=True, since=None, filters=None):
+        cursor = None
+        while not self.daemon.stopped.is_set():
+            events, cursor_after = self.daemon.events_from(cursor, since)
+            for event in events:
+                if not filters or event["Type"] in _values(filters.get("type", event["Type"])):
+                    yield event
+            cursor = cursor_after
+            self.daemon.wait_for_events(cursor, 1)
+
+    def close(self):
+        pass
+
+
+class SimAsyncDocker:
+    """
+    Stands in for async_monitor.AsyncDockerClient, yielding to the event loop on every request like a real socket would.
+    """
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.api = SimAPI(daemon)
+        self.request_count = 0
+
+    async def containers_list(self, all=True, filters=None):
+        self.request_count += 1
+        await asyncio.sleep(0)
+        return self.api.containers(all, filters)
+
+    async def container_inspect(self, container_id):
+        self.request_count += 1
+        await asyncio.sleep(0)
+        try:
+            return self.api.inspect_container(container_id)
+        except docker.errors.NotFound as e:
+            raise DockerAPIError(404, str(e))
+
+    async def container_restart(self, container_id, timeout=10):
+        self.request_count += 1
+        await asyncio.sleep(0)
+        self.daemon.restart(self.daemon.find(container_id))
+
+    async def events(self, filters=None, since=None):
+        cursor = None
+        while True:
+            events, cursor_after = self.daemon.events_from(cursor, since)
+            for event in events:
+                if not filters or event["Type"] in _values(filters.get("type", event["Type"])):
+                    yield event
+            cursor = cursor_after
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+    async def close(self):
+        pass
@@ -0,0 +1,322 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import argparse
+import asyncio
+import hmac
+import json
+import math
+import os
+import socket
+import threading
+import time
+from pathlib import Path
+
+from async_monitor import AsyncMonitor, MONITOR_INTERVAL
+from docker_client import get_client
+from node_reports import ReportInbox, REPORT_SOCKET
+from vpn_logging import get_logger
+
+log = get_logger("fleet_hosts")
+
+# Docker hosts the fleet runs on. Without this file the fleet uses the local daemon only.
+# [{"name": "box1", "base_url": "tcp://10.0.0.5:2376", "capacity": 40}, ...]
+FLEET_HOSTS_FILE = Path("./fleet_hosts.json")
+PLACEMENTS_FILE = Path("./host_placements.json")  # Node name -> host name
+DEFAULT_HOST_CAPACITY = 50  # Nodes per host when the hosts file does not say; a lone host has no limit
+
+# Reporters on each host push node observations to the aggregator as newline-delimited JSON over TCP.
+# The aggregator listens on loopback unless VPN_AGGREGATOR_HOST names the interface other hosts reach,
+# and every connection must open with the fleet's shared token.
+AGGREGATOR_HOST_ENV = "VPN_AGGREGATOR_HOST"
+AGGREGATOR_HOST = os.environ.get(AGGREGATOR_HOST_ENV, "127.0.0.1")
+AGGREGATOR_PORT = 4023
+FLEET_TOKEN_ENV = "VPN_FLEET_TOKEN"
+FLEET_TOKEN_FILE = Path("./fleet_token.txt")  # Used when VPN_FLEET_TOKEN is not set; same checkout on every host
+HANDSHAKE_TIMEOUT = 5  # Seconds a new connection has to send its token
+REPORTER_RECONNECT_DELAY = 5
+REPORTER_CONNECT_TIMEOUT = 5
+HOST_STALE_AFTER = 60  # Seconds without a report before a host is listed as stale
+
+
+def load_token(path=FLEET_TOKEN_FILE):
+    """
+    The shared secret reporters present to the aggregator, or None if none is configured.
+    """
+    token = os.environ.get(FLEET_TOKEN_ENV)
+    if token is None:
+        try:
+            token = Path(path).read_text()
+        except FileNotFoundError:
+            return None
+    return token.strip() or None
+
+
+def load_hosts(path=FLEET_HOSTS_FILE):
+    try:
+        with open(path) as f:
+            hosts = json.load(f)
+    except FileNotFoundError:
+        return [{"name": "local", "base_url": None}]
+    for host in hosts:
+        host.setdefault("base_url", None)
+    return hosts
+
+
+class FleetHosts:
+    """
+    The Docker hosts of the fleet and which node runs on which host.
+    Nodes are placed on the host with the lowest load relative to its capacity, and placements
+    are persisted so the build, the monitor and restarts agree on where a node lives.
+    `client_factory(base_url)` returns a Docker client; tests can pass fake or stand-in daemons.
+    """
+
+    def __init__(self, hosts=None, client_factory=get_client, placements_file=PLACEMENTS_FILE):
+        hosts = load_hosts() if hosts is None else hosts
+        self.hosts = {host["name"]: host for host in hosts}
+        self.order = [host["name"] for host in hosts]
+        self.client_factory = client_factory
+        self.placements_file = Path(placements_file)
+        self.lock = threading.Lock()
+        self.placements = {}
+        try:
+            with open(self.placements_file) as f:
+                self.placements = {node: host for node, host in json.load(f).items() if host in self.hosts}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.error("Failed to load host placements from %s: %s", self.placements_file, e)
+
+    @property
+    def single_host(self):
+        return len(self.hosts) == 1
+
+    def is_local(self, host_name):
+        base_url = self.hosts[host_name].get("base_url")
+        return base_url is None or base_url.startswith("unix://")
+
+    def client(self, host_name):
+        return self.client_factory(self.hosts[host_name].get("base_url"))
+
+    def clients(self):
+        return [(host_name, self.client(host_name)) for host_name in self.order]
+
+    def capacity(self, host_name):
+        return self.hosts[host_name].get("capacity") or (math.inf if self.single_host else DEFAULT_HOST_CAPACITY)
+
+    def host_of(self, node_name):
+        """
+        Name of the host a node is placed on. Unplaced nodes belong to the first host.
+        """
+        return self.placements.get(node_name, self.order[0])
+
+    def client_for(self, node_name):
+        return self.client(self.host_of(node_name))
+
+    def load(self):
+        with self.lock:
+            counts = {host_name: 0 for host_name in self.order}
+            for host_name in self.placements.values():
+                counts[host_name] += 1
+            return counts
+
+    def place(self, node_names):
+        """
+        Place every node that is not placed yet. Raises ValueError when the hosts are full.
+        """
+        counts = self.load()
+        with self.lock:
+            for node_name in node_names:
+                if node_name in self.placements:
+                    continue
+                candidates = [host_name for host_name in self.order if counts[host_name] < self.capacity(host_name)]
+                if not candidates:
+                    raise ValueError(f"No host has capacity left for {node_name}.")
+                host_name = min(candidates, key=lambda name: counts[name] / self.capacity(name))
+                self.placements[node_name] = host_name
+                counts[host_name] += 1
+            self._save()
+        return {node_name: self.placements[node_name] for node_name in node_names}
+
+    def release(self, node_name):
+        with self.lock:
+            if self.placements.pop(node_name, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp_path = self.placements_file.with_suffix(self.placements_file.suffix + ".tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.placements, f, indent=2)
+            os.replace(tmp_path, self.placements_file)
+        except Exception as e:
+            log.error("Failed to save host placements to %s: %s", self.placements_file, e)
+
+
+class HostReporter:
+    """
+    Pushes one host's node observations to the aggregator. A connection opens with a {"token"} line,
+    then each observation is one JSON line {"host", "node"}; the latest observation per node is kept
+    while disconnected and resent on reconnect.
+    """
+
+    def __init__(self, host_name, address, token):
+        self.host_name = host_name
+        self.address = address
+        self.handshake = (json.dumps({"token": token}) + "\n").encode()
+        self.lock = threading.Lock()
+        self.sock = None
+        self.latest = {}  # node name -> encoded line
+        self.retry_at = 0
+
+    def _connect(self):
+        if time.time() < self.retry_at:
+            return False
+        try:
+            self.sock = socket.create_connection(self.address, timeout=REPORTER_CONNECT_TIMEOUT)
+            log.info("Reporter for %s connected to aggregator %s:%s.", self.host_name, self.address[0], self.address[1])
+            self.sock.sendall(self.handshake + b"".join(self.latest.values()))
+            return True
+        except OSError as e:
+            log.warning("Aggregator %s:%s unreachable: %s. Retrying in %s seconds.", self.address[0], self.address[1], e, REPORTER_RECONNECT_DELAY)
+            self._disconnect()
+            return False
+
+    def _disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.retry_at = time.time() + REPORTER_RECONNECT_DELAY
+
+    def send(self, node):
+        line = (json.dumps({"host": self.host_name, "node": node}, separators=(",", ":")) + "\n").encode()
+        with self.lock:
+            self.latest[node["name"]] = line
+            if self.sock is None:
+                self._connect()  # Sends every latest line, including this one
+                return
+            try:
+                self.sock.sendall(line)
+            except OSError as e:
+                log.warning("Lost connection to the aggregator: %s", e)
+                self._disconnect()
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+
+def run_reporter(host_name, address, report_socket=REPORT_SOCKET, interval=MONITOR_INTERVAL):
+    """
+    Monitor this host's nodes and push every observation to the aggregator (blocks until interrupted).
+    The host's nodes post their status reports to an inbox served here, next to them.
+    """
+    token = load_token()
+    if token is None:
+        log.error("No fleet token configured. Set %s or write %s, the same as on the manager.", FLEET_TOKEN_ENV, FLEET_TOKEN_FILE)
+        return
+    reporter = HostReporter(host_name, address, token)
+    reports = ReportInbox()
+    reports.start(report_socket)
+    monitor = AsyncMonitor(reporter.send, reports, interval=interval)
+    try:
+        asyncio.run(monitor.run())
+    finally:
+        reporter.close()
+
+
+class FleetAggregator:
+    """
+    Receives node observations from every host's reporter and hands them to `handle_node`
+    one at a time, tagged with the host they came from. Connections that do not open with the
+    fleet token are dropped, and so are observations from hosts not in `hosts` (when given).
+    """
+
+    def __init__(self, handle_node, host=AGGREGATOR_HOST, port=AGGREGATOR_PORT, lock=None, token=None, hosts=None):
+        self.handle_node = handle_node
+        self.address = (host, port)
+        self.token = token if token is not None else load_token()
+        self.hosts = set(hosts) if hosts is not None else None
+        self.lock = lock or threading.Lock()  # Serializes handle_node across reporter connections
+        self.last_report = {}  # host name -> time of its last observation
+        self.server = None
+
+    def _authenticate(self, conn, lines, peer):
+        try:
+            token = json.loads(lines.readline())["token"]
+        except (OSError, ValueError, KeyError, TypeError):
+            token = None
+        if not isinstance(token, str) or not hmac.compare_digest(token.encode(), self.token.encode()):
+            log.warning("Rejected reporter connection from %s:%s: missing or wrong fleet token.", peer[0], peer[1])
+            return False
+        conn.settimeout(None)
+        return True
+
+    def _handle_connection(self, conn, peer):
+        with conn, conn.makefile("rb") as lines:
+            if not self._authenticate(conn, lines, peer):
+                return
+            for line in lines:
+                try:
+                    message = json.loads(line)
+                    node = dict(message["node"], host=message["host"])
+                    if self.hosts is not None and message["host"] not in self.hosts:
+                        raise ValueError(f"unknown host {message['host']!r}")
+                except (ValueError, KeyError, TypeError) as e:
+                    log.error("Bad report from %s: %s", peer[0], e)
+                    continue
+                self.last_report[message["host"]] = time.time()
+                try:
+                    with self.lock:
+                        self.handle_node(node)
+                except Exception as e:
+                    log.exception("Failed to apply report for %s from %s: %s", node.get('name'), message['host'], e)
+        log.info("Reporter at %s:%s disconnected.", peer[0], peer[1])
+
+    def serve(self, stop_event=None):
+        if self.token is None:
+            log.error("No fleet token configured (set %s or write %s); not accepting remote reports.", FLEET_TOKEN_ENV, FLEET_TOKEN_FILE)
+            return
+        self.server = socket.create_server(self.address)
+        self.server.settimeout(1)
+        log.info("Fleet aggregator listening on %s:%s", self.address[0], self.address[1])
+        while stop_event is None or not stop_event.is_set():
+            try:
+                conn, peer = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            conn.settimeout(HANDSHAKE_TIMEOUT)
+            threading.Thread(target=self._handle_connection, args=(conn, peer), name=f"report-{peer[0]}", daemon=True).start()
+        self.server.close()
+
+    def start(self, stop_event=None):
+        thread = threading.Thread(target=self.serve, args=(stop_event,), name="fleet-aggregator", daemon=True)
+        thread.start()
+        return thread
+
+    def stale_hosts(self, hosts, now=None):
+        """
+        Hosts that have not reported within HOST_STALE_AFTER seconds.
+        """
+        now = time.time() if now is None else now
+        return [host_name for host_name in hosts if now - self.last_report.get(host_name, 0) > HOST_STALE_AFTER]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fleet host tools")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    report = subcommands.add_parser("report", help="Push this host's node states to the aggregator")
+    report.add_argument("--host-name", required=True, help="This host's name in fleet_hosts.json")
+    report.add_argument("--aggregator", required=True, help="Aggregator address as host:port")
+    report.add_argument("--report-socket", default=str(REPORT_SOCKET), help="Unix socket this host's nodes post their reports to")
+    report.add_argument("--interval", type=float, default=MONITOR_INTERVAL, help="Seconds between monitor passes")
+    args = parser.parse_args()
+
+    host, _, port = args.aggregator.rpartition(":")
+    run_reporter(args.host_name, (host, int(port)), args.report_socket, args.interval)
+
+
+if __name__ == "__main__":
+    main()
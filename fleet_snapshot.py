@@ -0,0 +1,187 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import re
+import threading
+import time
+from datetime import datetime
+
+from fleet_teardown import NODE_NAME_FILTER
+from vpn_logging import get_logger
+
+log = get_logger("fleet_snapshot")
+
+# "Up 5 minutes (healthy)", "Up 3 seconds (health: starting)"
+HEALTH_PATTERN = re.compile(r"\((healthy|unhealthy|health: starting)\)")
+# "2024-01-01T12:00:00.123456789Z": inspect reports nanoseconds, fromisoformat takes at most microseconds
+TIMESTAMP_PATTERN = re.compile(r"^([^.Z+]+)(?:\.(\d+))?(.*)$")
+EVENT_RECONNECT_DELAY = 5
+
+
+def parse_health(status_text):
+    """
+    Health status from the list API's human readable Status column, or None without a healthcheck.
+    """
+    match = HEALTH_PATTERN.search(status_text or "")
+    if not match:
+        return None
+    return "starting" if match.group(1) == "health: starting" else match.group(1)
+
+
+def parse_docker_time(timestamp):
+    """
+    Epoch seconds from an inspect timestamp, or None for Docker's zero time (never started/finished).
+    """
+    match = TIMESTAMP_PATTERN.match(timestamp or "")
+    if not match or timestamp.startswith("0001-"):
+        return None
+    seconds, fraction, zone = match.groups()
+    try:
+        parsed = datetime.fromisoformat(seconds + (zone if zone not in ("", "Z") else "+00:00"))
+    except ValueError:
+        return None
+    return parsed.timestamp() + (int(fraction) / 10 ** len(fraction) if fraction else 0.0)
+
+
+def event_time(event):
+    """
+    Epoch seconds of a Docker event, to the nanosecond when the daemon sends it.
+    """
+    if event.get("timeNano"):
+        return event["timeNano"] / 1e9
+    return float(event["time"]) if event.get("time") is not None else None
+
+
+class EventCache:
+    """
+    Restart count, start/finish time (epoch seconds) and exit code per container, kept current from the
+    Docker event stream so no per-container inspect is needed once a container is known.
+    A container is known only once it has been seeded from an inspect; events that arrive
+    before that are kept, but do not stand in for Docker's own restart count.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.containers = {}  # 12 character ID -> state
+
+    def known(self, container_id):
+        with self.lock:
+            entry = self.containers.get(container_id[:12])
+            return entry is not None and entry["seeded"]
+
+    def seed(self, container_id, restart_count, started_at):
+        """
+        Record a container seen before the event stream (one inspect on first sighting).
+        `started_at` is the inspect timestamp. Inspect is authoritative for the restart count;
+        a later start already received from the event stream is kept.
+        """
+        started_at = parse_docker_time(started_at)
+        with self.lock:
+            entry = self.containers.setdefault(container_id[:12], {
+                "restart_count": 0, "started_at": None, "finished_at": None, "exit_code": None, "seeded": False,
+            })
+            if entry["seeded"]:
+                return
+            entry["seeded"] = True
+            entry["restart_count"] = restart_count
+            if started_at is not None and (entry["started_at"] is None or started_at > entry["started_at"]):
+                entry["started_at"] = started_at
+
+    def apply(self, event):
+        action = event.get("Action") or event.get("status") or ""
+        container_id = (event.get("id") or event.get("Actor", {}).get("ID") or "")[:12]
+        if not container_id:
+            return
+        timestamp = event_time(event)
+        with self.lock:
+            if action == "destroy":
+                self.containers.pop(container_id, None)
+                return
+            entry = self.containers.setdefault(container_id, {
+                "restart_count": 0, "started_at": None, "finished_at": None, "exit_code": None, "seeded": False,
+            })
+            if action == "start":
+                if entry["started_at"] is not None:
+                    entry["restart_count"] += 1  # Every start after the first is a restart
+                entry["started_at"] = timestamp
+            elif action == "die":
+                entry["finished_at"] = timestamp
+                exit_code = event.get("Actor", {}).get("Attributes", {}).get("exitCode")
+                entry["exit_code"] = int(exit_code) if exit_code is not None else None
+
+    def get(self, container_id):
+        with self.lock:
+            entry = self.containers.get(container_id[:12])
+            return dict(entry) if entry else None
+
+
+def node_from_summary(summary, events):
+    """
+    Merge one list API entry with the cached event state into a node record.
+    """
+    container_id = summary["Id"][:12]
+    cached = events.get(container_id) or {}
+    return {
+        "id": container_id,
+        "name": summary["Names"][0].lstrip("/") if summary.get("Names") else container_id,
+        "state": summary.get("State"),
+        "status_text": summary.get("Status"),
+        "health": parse_health(summary.get("Status")),
+        "restart_count": cached.get("restart_count", 0),
+        "started_at": cached.get("started_at"),
+        "exit_code": cached.get("exit_code"),
+    }
+
+
+class FleetSnapshot:
+    """
+    State of every node from a single containers list call per refresh. Restart count and
+    start time come from the event cache, so a monitor pass costs one API call however many
+    nodes there are. Look nodes up by name or ID with get().
+    """
+
+    def __init__(self, client, name_filter=NODE_NAME_FILTER, watch_events=True):
+        self.client = client
+        self.name_filter = name_filter
+        self.events = EventCache()
+        self.nodes = {}  # name and 12 character ID -> node record
+        self.order = []  # IDs, newest first, as the daemon lists them
+        self.refreshed_at = None
+        if watch_events:
+            threading.Thread(target=self._watch_events, name="docker-events", daemon=True).start()
+
+    def refresh(self):
+        summaries = self.client.api.containers(all=True, filters={"name": self.name_filter})
+        for summary in summaries:
+            if not self.events.known(summary["Id"]):
+                # First sighting: one inspect to learn what happened before the event stream started
+                details = self.client.api.inspect_container(summary["Id"])
+                started_at = details.get("State", {}).get("StartedAt")
+                self.events.seed(summary["Id"], details.get("RestartCount", 0), started_at)
+
+        nodes, order = {}, []
+        for summary in summaries:
+            node = node_from_summary(summary, self.events)
+            nodes[node["id"]] = node
+            nodes[node["name"]] = node
+            order.append(node["id"])
+        self.nodes, self.order = nodes, order
+        self.refreshed_at = time.time()
+        return self
+
+    def get(self, key):
+        return self.nodes.get(key if key in self.nodes else key[:12])
+
+    def container_ids(self):
+        return list(self.order)
+
+    def _watch_events(self):
+        since = int(time.time())
+        while True:
+            try:
+                for event in self.client.events(decode=True, since=since, filters={"type": "container"}):
+                    since = event.get("time", since)
+                    name = event.get("Actor", {}).get("Attributes", {}).get("name", "")
+                    if self.name_filter in name:
+                        self.events.apply(event)
+            except Exception as e:
+                log.exception("Docker event stream failed: %s. Reconnecting in %s seconds.", e, EVENT_RECONNECT_DELAY)
+            time.sleep(EVENT_RECONNECT_DELAY)
@@ -0,0 +1,110 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+
+from vpn_logging import get_logger
+
+log = get_logger("fleet_teardown")
+
+# Every container, image, network and volume the fleet creates carries this label,
+# so teardown never touches unrelated Docker resources
+FLEET_LABEL = "vpn_fleet"
+FLEET_LABEL_VALUE = "vpn_node"
+FLEET_LABELS = {FLEET_LABEL: FLEET_LABEL_VALUE}
+FLEET_LABEL_FILTER = f"{FLEET_LABEL}={FLEET_LABEL_VALUE}"
+NODE_NAME_FILTER = "vpn_node_"  # Containers created before labels were added
+
+STOP_TIMEOUT = 10  # Seconds a node gets to exit after SIGTERM before it is killed
+TEARDOWN_WORKERS = 16  # Concurrent Docker API calls during teardown
+STOP_POLL_INTERVAL = 0.5
+
+
+def list_fleet_containers(client):
+    """
+    Return every fleet container (running or not), selected by label plus the legacy name prefix.
+    """
+    containers = {}
+    for filters in ({"label": FLEET_LABEL_FILTER}, {"name": NODE_NAME_FILTER}):
+        for container in client.containers.list(all=True, filters=filters):
+            containers[container.id] = container
+    return list(containers.values())
+
+
+def _signal(container):
+    try:
+        container.kill(signal="SIGTERM")
+    except docker.errors.APIError:
+        pass  # Already stopped or gone
+
+
+def _remove(container):
+    try:
+        container.remove(v=True, force=True)  # Also removes the container's anonymous volumes
+        log.debug("Removed container %s (ID: %s).", container.name, container.short_id)
+        return container.id
+    except docker.errors.NotFound:
+        return container.id
+    except Exception as e:
+        log.error("Failed to remove container %s (ID: %s): %s", container.name, container.short_id, e)
+        return None
+
+
+def _wait_for_exit(client, container_ids, stop_timeout):
+    """
+    Wait until none of `container_ids` is running, checking the whole fleet with one list call per poll.
+    """
+    deadline = time.time() + stop_timeout
+    while time.time() < deadline:
+        running = {container.id for container in client.containers.list(filters={"label": FLEET_LABEL_FILTER, "status": "running"})}
+        running |= {container.id for container in client.containers.list(filters={"name": NODE_NAME_FILTER, "status": "running"})}
+        if not running & container_ids:
+            return set()
+        time.sleep(STOP_POLL_INTERVAL)
+    return container_ids
+
+
+def teardown_fleet(client, stop_timeout=STOP_TIMEOUT, max_workers=TEARDOWN_WORKERS, containers=None):
+    """
+    Stop and remove every fleet container in parallel, then prune only fleet-labelled networks and volumes.
+    All nodes get SIGTERM at once and share a single stop timeout, so teardown takes about one
+    timeout regardless of fleet size. Returns the IDs of the removed containers.
+    """
+    if containers is None:
+        containers = list_fleet_containers(client)
+    if not containers:
+        log.debug("No fleet containers to tear down.")
+        return []
+
+    log.info("Tearing down %s fleet containers (stop timeout %ss)...", len(containers), stop_timeout)
+    start_time = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Ask every node to stop at once, then wait for all of them together
+        list(executor.map(_signal, containers))
+        try:
+            _wait_for_exit(client, {container.id for container in containers}, stop_timeout)
+        except Exception as e:
+            log.error("Failed while waiting for fleet containers to stop: %s", e)
+
+        # Force-remove whatever is left; anything still running is killed
+        removed = [container_id for container_id in executor.map(_remove, containers) if container_id]
+
+    prune_fleet_resources(client)
+    log.info("Removed %s fleet containers in %.1f seconds.", len(removed), time.time() - start_time)
+    return removed
+
+
+def prune_fleet_resources(client):
+    """
+    Prune unused networks, volumes and dangling images that carry the fleet label.
+    Unrelated resources and the build cache are left alone.
+    """
+    label_filter = {"label": FLEET_LABEL_FILTER}
+    try:
+        client.networks.prune(filters=label_filter)
+        client.volumes.prune(filters=label_filter)
+        client.images.prune(filters={**label_filter, "dangling": True})
+    except Exception as e:
+        log.exception("Failed to prune fleet resources: %s", e)
@@ -1,89 +1,196 @@
 import argparse
+import os
+from functools import lru_cache
 from pathlib import Path
+from string import Formatter
+from port_allocator import PortAllocator, shard_network
+from fleet_teardown import FLEET_LABEL_FILTER
+from node_reports import REPORTS_DIR, REPORT_SOCKET, CONTAINER_REPORTS_DIR
+from ovpn_catalog import load_catalog
+from server_selection import ServerSelector, MAX_PER_REGION
 
-def generate_vpn_node_config(node_number, udp_port, tcp_port, socks_port, ip_address, public_ips_dir):
-    """
-    Generates the configuration for a single VPN node, using the pre-built image for faster startup.
-    Adds a health check for monitoring the container's health.
-    """
-    return f"""
+# Service block for one VPN node. Compiled once into literal fragments, then filled per node.
+NODE_TEMPLATE = """
   vpn_node_{node_number}:
     image: vpn_node_image  # Use the pre-built Docker image
     container_name: vpn_node_{node_number}
+    labels:
+      - {fleet_label}
     environment:
       - VPN_FILE=${{VPN_FILE_{node_number}}}
       - VPN_TYPE=${{VPN_TYPE_{node_number}}}
+      - SOCKS_PORT=9090
+      - NODE_NAME=vpn_node_{node_number}
+      - REPORT_SOCKET={report_socket}
     volumes:
       - ./vpn_creds.txt:/vpn_creds.txt
       - ./ovpn_files:/ovpn_files
-      - {public_ips_dir}:/shared/public_ips
+      - {reports_dir}:{container_reports_dir}
+      - {squid_logs_dir}/vpn_node_{node_number}:/var/log/squid
     ports:
       - "{udp_port}:8080/udp"
       - "{tcp_port}:22/tcp"
       - "{socks_port}:9090/tcp"
     networks:
-      vpn_network:
+      {network_name}:
         ipv4_address: {ip_address}
     stdin_open: true
     tty: true
     healthcheck:
-      test: ["CMD-SHELL", "curl -f http://{ip_address}:8080 || exit 1"]  # Check if the service is running on the dynamically generated IP and port
+      test: ["CMD-SHELL", "ip link show tun0 >/dev/null 2>&1 && lsof -i :9090 >/dev/null || exit 1"]  # Tunnel is up and Squid is listening
       interval: 1m
       timeout: 10s
       retries: 3
       start_period: 30s
+"""
+
+NETWORK_TEMPLATE = """
+networks:
+  {network_name}:
+    driver: bridge
+    labels:
+      - {fleet_label}
+    ipam:
+      config:
+        - subnet: {subnet}
+"""
+
+
+@lru_cache(maxsize=None)
+def compile_template(template, **static_fields):
     """
+    Split a template into (literal, field name) pairs once, filling in the fields that are the
+    same for every node. Rendering a node is then a single join with no format parsing.
+    """
+    parts = []
+    literal = ""
+    for text, field_name, format_spec, conversion in Formatter().parse(template):
+        literal += text
+        if field_name is None:
+            continue
+        if field_name in static_fields:
+            literal += str(static_fields[field_name])
+        else:
+            parts.append((literal, field_name))
+            literal = ""
+    parts.append((literal, None))
+    return tuple(parts)
+
 
+def render(compiled, fields):
+    return "".join(literal + str(fields[field_name]) if field_name else literal for literal, field_name in compiled)
 
-def generate_docker_compose(number_of_nodes, start_udp_port=8081, start_tcp_port=2221, start_socks_port=9091, start_ip="172.18.0.2"):
+
+def compose_file_for_shard(shard_index, shards):
+    if shards == 1:
+        return Path.cwd() / "docker-compose.yml"
+    return Path.cwd() / f"docker-compose.shard{shard_index + 1}.yml"
+
+
+def remove_stale_compose_files(output_files):
     """
-    Generates the docker-compose.yml file for a given number of VPN nodes with correct formatting.
-    Includes placeholders for environment variables and ensures proper indentation and line breaks.
+    Delete compose files left by an earlier run with a different shard count, so
+    `docker compose` is never pointed at nodes that are no longer part of the fleet.
     """
-    services = []
-    ip_segments = start_ip.split(".")
+    for compose_file in [Path.cwd() / "docker-compose.yml", *Path.cwd().glob("docker-compose.shard*.yml")]:
+        if compose_file not in output_files and compose_file.exists():
+            compose_file.unlink()
+            print(f"Removed stale {compose_file.name}.")
 
-    # Resolve the dynamic public_ips folder based on CWD
-    public_ips_dir = Path.cwd() / "public_ips"
 
-    for i in range(1, number_of_nodes + 1):
-        node_udp_port = start_udp_port + i - 1
-        node_tcp_port = start_tcp_port + i - 1
-        node_socks_port = start_socks_port + i - 1
-        node_ip = f"{ip_segments[0]}.{ip_segments[1]}.{ip_segments[2]}.{int(ip_segments[3]) + i - 1}"
+def write_compose_shard(output_file, project_name, network_name, network, leases, reports_dir, squid_logs_dir):
+    """
+    Stream one compose file to disk a service block at a time.
+    The file is written under a temporary name and moved into place once complete.
+    """
+    compiled = compile_template(NODE_TEMPLATE, fleet_label=FLEET_LABEL_FILTER, reports_dir=reports_dir,
+                                container_reports_dir=CONTAINER_REPORTS_DIR,
+                                report_socket=f"{CONTAINER_REPORTS_DIR}/{REPORT_SOCKET.name}",
+                                squid_logs_dir=squid_logs_dir, network_name=network_name)
+    tmp_file = output_file.with_suffix(".yml.tmp")
 
-        # Generate the VPN node configuration
-        vpn_node_config = generate_vpn_node_config(i, node_udp_port, node_tcp_port, node_socks_port, node_ip, public_ips_dir)
+    with open(tmp_file, 'w') as yaml_file:
+        yaml_file.write(f"version: '3'\nname: {project_name}\nservices:\n")
+        for node_number, lease in leases:
+            yaml_file.write(render(compiled, {
+                "node_number": node_number,
+                "udp_port": lease["open_port"],
+                "tcp_port": lease["ssh_port"],
+                "socks_port": lease["socks5_port"],
+                "ip_address": lease["ip"],
+            }))
+        yaml_file.write(NETWORK_TEMPLATE.format(network_name=network_name, fleet_label=FLEET_LABEL_FILTER, subnet=network))
 
-        # Add the VPN node configuration to the services list
-        services.append(vpn_node_config)
+    os.replace(tmp_file, output_file)
 
-    # Compose the final docker-compose configuration
-    docker_compose_content = f"version: '3'\nservices:\n{''.join(services)}"
 
-    # Add the networks section at the bottom
-    docker_compose_content += """
-networks:
-  vpn_network:
-    driver: bridge
-    ipam:
-      config:
-        - subnet: 172.18.0.0/16
-"""
+def write_compose_env(number_of_nodes, catalog, max_per_region=MAX_PER_REGION):
+    """
+    Write the VPN_FILE_<n>/VPN_TYPE_<n> variables the compose services reference to .env.
+    Odd nodes get the UDP file and even nodes the TCP file of the same location, as in build_vpn_nodes.
+    Locations are taken in the cached latency order, fastest first, with the same region cap as build_vpn_nodes.
+    """
+    lines = []
+    ranked_pairs = ServerSelector(catalog).rank_pairs(max_per_region)
+    for i, (udp_entry, tcp_entry) in enumerate(ranked_pairs):
+        for node_number, entry in ((2 * i + 1, udp_entry), (2 * i + 2, tcp_entry)):
+            if node_number <= number_of_nodes:
+                lines.append(f"VPN_FILE_{node_number}={entry['file']}\nVPN_TYPE_{node_number}={entry['proto']}\n")
+
+    env_file = Path.cwd() / ".env"
+    with open(env_file, 'w') as f:
+        f.writelines(lines)
+    print(f".env has been generated with VPN files for {len(lines)} nodes.")
+
+
+def generate_docker_compose(number_of_nodes, shards=1, max_per_region=MAX_PER_REGION):
+    """
+    Generates the docker-compose file(s) for a given number of VPN nodes.
+    Ports and addresses come from the shared lease table. With shards > 1 the fleet is split into
+    that many compose projects, each on its own network, so they can be started in parallel.
+    Compose files from a previous run with a different shard count are removed.
+    Returns the list of files written.
+    """
+    shards = max(1, min(shards, number_of_nodes))
+    allocator = PortAllocator()
+
+    # Resolve the report socket and squid_logs folders based on CWD
+    reports_dir = REPORTS_DIR.resolve()
+    squid_logs_dir = Path.cwd() / "squid_logs"
+
+    # Shard sizes differ by at most one node, so no shard is left empty
+    shard_size, larger_shards = divmod(number_of_nodes, shards)
+    output_files = []
+    first_node = 1
+    for shard_index in range(shards):
+        node_numbers = range(first_node, first_node + shard_size + (shard_index < larger_shards))
+        first_node = node_numbers.stop
+        output_file = compose_file_for_shard(shard_index, shards)
+
+        if shards == 1:
+            project_name, network_name = "vpn_fleet", "vpn_network"
+        else:
+            project_name, network_name = f"vpn_fleet_shard{shard_index + 1}", f"vpn_network_shard{shard_index + 1}"
 
-    # Write the configuration to docker-compose.yml in the current working directory
-    output_file = Path.cwd() / "docker-compose.yml"
-    with open(output_file, 'w') as yaml_file:
-        yaml_file.write(docker_compose_content)
+        # The lease records the shard, so port_leases.json holds the address the compose file assigns
+        leases = allocator.lease_many((f"vpn_node_{i}" for i in node_numbers), shard=shard_index)
+        write_compose_shard(output_file, project_name, network_name, shard_network(shard_index, allocator.network),
+                            zip(node_numbers, leases), reports_dir, squid_logs_dir)
+        output_files.append(output_file)
+        print(f"{output_file.name} has been generated with {len(node_numbers)} nodes and saved to {output_file}.")
 
-    print(f"docker-compose.yml has been generated and saved to {output_file}.")
+    remove_stale_compose_files(output_files)
+    write_compose_env(number_of_nodes, load_catalog(), max_per_region)
+    return output_files
 
 if __name__ == "__main__":
     # Set up argument parser
-    parser = argparse.ArgumentParser(description="Generate a docker-compose.yml file for VPN nodes.")
+    parser = argparse.ArgumentParser(description="Generate docker-compose file(s) for VPN nodes.")
     parser.add_argument("--nodes", type=int, default=1, help="Number of VPN nodes to generate.")
+    parser.add_argument("--shards", type=int, default=1, help="Split the fleet into this many compose projects.")
+    parser.add_argument("--max-per-region", type=int, default=MAX_PER_REGION, help="Take at most this many locations per region before repeating a region")
     args = parser.parse_args()
 
-    # Generate the docker-compose.yml file with the specified number of nodes
-    generate_docker_compose(args.nodes)
+    # Generate the docker-compose file(s) with the specified number of nodes
+    generate_docker_compose(args.nodes, args.shards, args.max_per_region)
 
@@ -1,140 +1,176 @@
 #!/home/idontloveyou/miniconda/bin/python3.11
+import atexit
 import os
 import subprocess
+import threading
 import time
 import docker
 from pathlib import Path
-import traceback
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from node_state import NodeStateStore
+from squid_logs import start_log_ingestion
+from port_allocator import PortAllocator
+from port_inspector import bound_ports
+from fleet_teardown import list_fleet_containers, teardown_fleet
+from ovpn_catalog import load_catalog
+from server_selection import ServerSelector
+from bringup import load_report, wait_until_ready, BRINGUP_FAILED_EXIT
+from supervisor import NodeSupervisor
+from spare_pool import SparePool, SPARE_COUNT
+from build_vpn_nodes import build_and_run_container
+from async_monitor import run_async_monitor, MONITOR_INTERVAL
+from fleet_snapshot import FleetSnapshot
+from docker_client import get_client, get_container_ids as list_node_container_ids, api_stats, format_api_stats
+from metrics import emitter
+from node_history import NodeHistory
+from update_vpn_info import ExpiryQueue, remove_nodes as remove_expired_nodes, store as csv_store, update_csv
+from fleet_hosts import FleetHosts, FleetAggregator
+from node_reports import ReportInbox
+from tracing import tracer
+from vpn_logging import get_logger
+
+log = get_logger("manage_vpns")
 
 
 # Constants
-DELETE_TEXT_FILES = False  # Toggle for deleting text files after processing
-SHARED_DIR = Path.cwd() / 'public_ips'
-PYTHON_SCRIPT = Path.cwd() / 'update_vpn_info.py'
 # New Constants for UDP/TCP Nodes
 DEFAULT_UDP_NODES = '1' # Set a default number of UDP nodes (can be adjusted)
 DEFAULT_TCP_NODES = '1'  # Set a default number of TCP nodes (can be adjusted)
+ASYNC_MONITOR = True  # Event-loop monitor (async_monitor.py); False uses the threaded polling loop below
+COMPOSE_SHARDS = 1  # Split docker-compose into this many projects/networks for very large fleets
+MAX_PER_REGION = None  # Region diversity cap, passed alike to generateyml.py, build_vpn_nodes.py and the spare pool
+MAX_PER_REGION_ARGS = ["--max-per-region", str(MAX_PER_REGION)] if MAX_PER_REGION else []
 
 delete_csv_flag = False # Global flag to ensure CSV is deleted only once
 
 
 MAX_ATTEMPTS = 10
-SOCKS5_START_PORT = 9090
-UDP_START_PORT = 8080
+STOP_TIMEOUT = 10  # Seconds each node gets to exit during cleanup (all nodes are stopped in parallel)
 
 
-processed_files = {}  # Global dictionary to track processed public IP files
+processed_reports = {}  # Container id -> revision of the last status report processed
 public_ip_cache = {}  # Global dictionary to cache public IP info
+node_state_store = NodeStateStore()  # Per-node state shared with the dashboard (traffic counters, etc.)
+port_allocator = PortAllocator()  # Shared port/IP lease table (see port_allocator.py)
+node_history = NodeHistory()  # Status/IP transition history for uptime and MTBF (see node_history.py)
+atexit.register(node_history.close)  # Flush queued transitions on exit
+exited_expiry = ExpiryQueue()  # Exited nodes, keyed on last update, removed from the CSV after EXITED_NODE_TTL
+
+# Shared, connection-pooled Docker client (see docker_client.py)
+client = get_client()
+fleet_snapshot = FleetSnapshot(client, watch_events=not ASYNC_MONITOR)  # Per-pass node states (see fleet_snapshot.py)
+fleet_hosts = FleetHosts()  # Docker hosts and node placements (see fleet_hosts.py)
+observation_lock = threading.Lock()  # Serializes observations from the local monitor and remote host reporters
+monitoring = threading.Event()  # Set after bring-up; before that, remote observations only feed the report inbox
+remote_backlog = {}  # Node name -> latest remote observation received before monitoring started
+report_inbox = ReportInbox()  # Status reports nodes POST over the ingest socket (see node_reports.py)
+
+
+def record_report(container_id, report):
+    """
+    Report inbox subscriber: put the node's reported public IP into the state store as soon as it arrives.
+    """
+    node_state_store.update(report.get("Name") or container_id, container_id=container_id, public_ip=report.get("Public IP"),
+                            vpn_file=report.get("VPN File"), vpn_type=report.get("VPN_TYPE"), proxy_port=report.get("Proxy Info"),
+                            reported_at=time.time())
 
-# Initialize Docker client
-client = docker.from_env()
 
-def cleanup_vpn_nodes():
-    print("Cleaning up existing VPN node containers...")
+report_inbox.subscribe(record_report)
 
-    # Delete all text files in the shared directory
-    for text_file in SHARED_DIR.glob("*.txt"):
-        try:
-            print(f"[DEBUG] Deleting {text_file} as part of initial cleanup...")
-            text_file.unlink()
-            print(f"[DEBUG] Successfully deleted {text_file}.")
-        except Exception as e:
-            print(f"[ERROR] Failed to delete {text_file}: {str(e)}")
-            traceback.print_exc()
+def forget_nodes(node_names):
+    """
+    Close the history and drop the metric series of nodes that left the fleet
+    (expired from the CSV or removed by a cleanup).
+    """
+    node_names = list(node_names)
+    node_history.remove(node_names)
+    for node_name in node_names:
+        emitter.remove("node", node_name)
+
+
+def cleanup_vpn_nodes():
+    log.info("Cleaning up existing VPN node containers...")
 
-    # Stop and remove containers using subprocess
+    # Stop and remove the fleet's containers through the Docker SDK
     try:
         # Get container IDs before stopping/removing them to update the CSV
-        result = subprocess.run(
-            "docker ps -aq --filter 'name=vpn_node_'",
-            shell=True, capture_output=True, text=True, check=True
-        )
-        container_ids = result.stdout.strip().split('\n')
-        container_ids = [container_id[:12] for container_id in container_ids if container_id]
-        
+        containers = list_fleet_containers(client)
+        container_ids = [container.id[:12] for container in containers]
+
         for container_id in container_ids:
-            public_ip_file = SHARED_DIR / f"{container_id}-ip.txt"
+            report = report_inbox.get(container_id)
             container_name = f"vpn_node_{container_id[:4]}"  # Use part of the container ID for the name
-            print(f"[DEBUG] Updating CSV with 'Exited' status for {container_name} (ID: {container_id}) before cleanup.")
+            log.debug("Updating CSV with 'Exited' status for %s (ID: %s) before cleanup.", container_name, container_id)
 
-            # If the IP file exists, update the VPN info to mark as 'Exited'
-            if public_ip_file.exists():
-                node, vpn_file, vpn_type, public_ip, proxy_info = extract_info_from_file(public_ip_file)
+            # If the node has reported, update the VPN info to mark as 'Exited'
+            if report is not None:
+                node, vpn_file, vpn_type, public_ip, proxy_info = extract_info(report)
                 update_vpn_info(container_name, vpn_file or "N/A", vpn_type or "N/A", public_ip or "VPN failed to start", "Exited", "Not Connected", container_id, "N/A", proxy_info or "No Proxy", "N/A")
-
-                if DELETE_TEXT_FILES:
-                    delete_text_file(public_ip_file)
             else:
-                print(f"[ERROR] No public IP file found for exited container {container_name} (ID: {container_id}).")
-
-        # Stop and remove all containers with names starting with 'vpn_node_'
-        subprocess.run(
-            "docker ps -aq --filter 'name=vpn_node_' | xargs -r docker stop | xargs -r docker rm",
-            shell=True, check=True
-        )
-        print("All VPN node containers stopped and removed.")
+                log.error("No status report found for exited container %s (ID: %s).", container_name, container_id)
 
-        # Prune Docker resources (volumes, networks, and unused containers)
-        subprocess.run("docker system prune -f --volumes", shell=True, check=True)
+        # Stop all nodes in parallel, remove them, and prune only fleet-labelled resources
+        removed = set(teardown_fleet(client, stop_timeout=STOP_TIMEOUT, containers=containers))
+        forget_nodes(container.name for container in containers if container.id in removed)
 
-        print("Docker system pruned successfully, including volumes and unused images.")
+        # Nodes on the other fleet hosts
+        for host_name, host_client in fleet_hosts.clients():
+            if not fleet_hosts.is_local(host_name):
+                host_containers = list_fleet_containers(host_client)
+                removed = set(teardown_fleet(host_client, stop_timeout=STOP_TIMEOUT, containers=host_containers))
+                forget_nodes(container.name for container in host_containers if container.id in removed)
+        report_inbox.clear()
+        processed_reports.clear()
+        log.info("All VPN node containers stopped and removed.")
 
-        # Check and clear any open ports after pruning
-        for port in range(SOCKS5_START_PORT, SOCKS5_START_PORT + MAX_ATTEMPTS):
-            if check_port_in_use(port):
-                print(f"[DEBUG] Port {port} is still in use. Clearing it...")
-                clear_port(port)
+        # Check the fleet's ports with a single read of the kernel socket tables
+        report_bound_fleet_ports()
 
-    except subprocess.CalledProcessError as e:
-        print(f"[ERROR] Failed to clean up VPN nodes: {e}")
-        traceback.print_exc()
+    except docker.errors.APIError as e:
+        log.exception("Failed to clean up VPN nodes: %s", e)
 
 
 def build_vpn_nodes(udp_node_count, tcp_node_count):
     """
     Build and start VPN nodes with the specified UDP and TCP node counts.
+    build_vpn_nodes.py brings nodes up in parallel and retries only the nodes that fail,
+    so it is run once. Returns False only if the build itself failed.
     """
-    print(f"Building and starting {udp_node_count} UDP nodes and {tcp_node_count} TCP nodes...")
-
-    # Adjust the subprocess call to pass node counts and types
-    retries = 0
-    while retries < 5:
-        result = subprocess.run(
-            ["./build_vpn_nodes.py", str(udp_node_count), str(tcp_node_count)], 
-            text=True  # This will ensure the output is printed directly
-        )
-        if result.returncode == 99:
-            print("VPN public IP retrieval failed. Retrying...")
-            time.sleep(2)
-            retries += 1
-        else:
-            break
-    if retries == 5:
-        print("Failed to build VPN nodes after maximum retries.")
+    log.info("Building and starting %s UDP nodes and %s TCP nodes...", udp_node_count, tcp_node_count)
+
+    result = subprocess.run(
+        ["./build_vpn_nodes.py", str(udp_node_count), str(tcp_node_count)] + MAX_PER_REGION_ARGS,
+        text=True  # This will ensure the output is printed directly
+    )
+    if result.returncode == BRINGUP_FAILED_EXIT:
+        log.warning("Some VPN nodes did not become ready; continuing with the rest of the fleet.")
+    elif result.returncode != 0:
+        log.error("Failed to build VPN nodes.")
         return False
     return True
 
 
+def report_bringup():
+    """
+    Print the per-node bring-up results recorded by build_vpn_nodes.py.
+    """
+    report = load_report()
+    if report["first_ready"] is not None:
+        log.info("First proxy was usable %.1f seconds into bring-up.", report['first_ready'])
+    for node_name, result in sorted(report["nodes"].items()):
+        log.info("%s: %s after %s attempt(s) (%s).", node_name, result['status'], result['attempts'], result['reason'])
 
 
 def get_container_ids():
     try:
-        result = subprocess.run(
-            ["docker", "ps", "-aq", "--filter", "name=vpn_node_"],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        container_ids = result.stdout.strip().split('\n')
-        container_ids = [container_id[:12] for container_id in container_ids if container_id]
+        # One sparse list call through the shared client instead of spawning `docker ps`
+        container_ids = list_node_container_ids(client=client)
         for container_id in container_ids:
-            print(f"Node: {container_id}")
+            log.debug("Node: %s", container_id)
         return container_ids
-    except subprocess.CalledProcessError as e:
-        print(f"Error retrieving container IDs: {str(e)}")
-        traceback.print_exc()
+    except docker.errors.APIError as e:
+        log.exception("Error retrieving container IDs: %s", e)
         return []
 
 
@@ -149,12 +185,13 @@ def determine_connectivity(public_ip, proxy_info, socks5_port):
         return "Connected"
 
 
-def restart_container(container_id, container_name):
+def restart_container(container_name, container_id):
     """
     Restart the container with the given ID and update its status to 'Restarting'.
-    After restart, update the status to 'Running' in the CSV file.
+    Waits for the node's own readiness signal, then updates the status to 'Running' in the CSV file.
+    Called by the supervisor on its restart pool; returns True once the node is ready.
     """
-    print(f"[DEBUG] Restarting container {container_name} (ID: {container_id})...")
+    log.debug("Restarting container %s (ID: %s)...", container_name, container_id)
 
     # Use the cached public IP info to update the node data
     if container_id in public_ip_cache:
@@ -173,96 +210,141 @@ def restart_container(container_id, container_name):
         proxy_info = "Connected" if connectivity == "Connected" else "Disconnected"
 
         # Log the restart with the cached port information
-        update_vpn_info(container_name, vpn_file or "N/A", vpn_type or "N/A", public_ip or "VPN failed to start", 
+        update_vpn_info(container_name, vpn_file or "N/A", vpn_type or "N/A", public_ip or "VPN failed to start",
                         "Restarting", "Not Connected", container_id, open_port, proxy_info, socks5_port)
     else:
-        print(f"[ERROR] No cached public IP info found for {container_name} (ID: {container_id}). Using defaults.")
-        return
+        log.error("No cached public IP info found for %s (ID: %s). Using defaults.", container_name, container_id, extra={"node": container_name})
+        return False
 
     try:
-        container = client.containers.get(container_id)
-        container.restart()
+        container = fleet_hosts.client_for(container_name).containers.get(container_id)
+
+        # start_vpn.sh reports once per run, so drop the old report before restarting
+        report_inbox.discard(container_id)
+        processed_reports.pop(container_id, None)
+
+        tracer.rearm(container_name)  # Time the recovery like a cold start
+        with tracer.span("restart", container_name, container_id=container_id):
+            container.restart()
+
+        # Wait for the node's status report instead of re-entering wait_for_container
+        ready, reason = wait_until_ready(container, report_inbox)
+        if ready:
+            log.debug("Successfully restarted container %s (ID: %s).", container_name, container_id)
+            node, vpn_file, vpn_type, public_ip, proxy_info = extract_info(report_inbox.get(container_id))
+            update_vpn_info(container_name, vpn_file, vpn_type, public_ip, "running", "Connected", container_id, open_port, proxy_info, socks5_port)
+            return True
 
-        # Wait for the container to fully restart
-        if wait_for_container(container_id, container_name):
-            print(f"[DEBUG] Successfully restarted container {container_name} (ID: {container_id}).")
-            
-            # Check for the public IP file after restart and update the CSV
-            public_ip_file = SHARED_DIR / f"{container_id}-ip.txt"
-            if public_ip_file.exists():
-                node, vpn_file, vpn_type, public_ip, proxy_info = extract_info_from_file(public_ip_file)
-                update_vpn_info(container_name, vpn_file, vpn_type, public_ip, "running", "Connected", container_id, open_port, proxy_info, socks5_port)
-            else:
-                print(f"[DEBUG] No new public IP file found for {container_name}. Using cached data.")
-        else:
-            print(f"[ERROR] Failed to restart container {container_name} (ID: {container_id}).")
+        log.error("Failed to restart container %s (ID: %s): %s.", container_name, container_id, reason, extra={"node": container_name})
+        if reason == "Auth Failed":
+            update_vpn_info(container_name, vpn_file or "N/A", vpn_type or "N/A", "Auth Failed",
+                            "Exited", "Auth Failed", container_id, open_port, "Disconnected", socks5_port)
     except docker.errors.NotFound:
-        print(f"[ERROR] Container {container_id} not found.")
+        log.error("Container %s not found.", container_id)
     except Exception as e:
-        print(f"[ERROR] Exception during restart of {container_name}: {str(e)}")
+        log.error("Exception during restart of %s: %s", container_name, str(e))
+    return False
 
 
+def launch_spare(spare_name, entry, lease):
+    return build_and_run_container(spare_name, entry["path"], lease["open_port"], lease["socks5_port"], entry["proto"])
 
 
+def spare_ready(container):
+    return wait_until_ready(container, report_inbox)
 
 
-def wait_for_container(container_id, container_name):
+spare_pool = None  # Created in main() when SPARE_COUNT > 0
+
+
+def promote_spare(container_name, container_id):
     """
-    Waits for the container to start, checks its health, and logs its status. 
-    Restarts if necessary. Returns True if container is running successfully.
+    Swap a ready spare into the failed node's slot. Returns True if a spare took over.
     """
-    timeout = 45  # Set timeout to 30 seconds for container status check
-    file_wait_timeout = 60  # Set additional timeout for the public IP file
+    if spare_pool is None:
+        return False
 
-    public_ip_file = SHARED_DIR / f"{container_id}-ip.txt"
-    container = None
+    vpn_type = public_ip_cache.get(container_id, {}).get("vpn_type", "N/A").lower()
+    promoted = spare_pool.promote(container_name, container_id, vpn_type)
+    if promoted is None:
+        log.info("No ready spare for %s; restarting it in place.", container_name)
+        return False
 
-    print(f"[INFO] Waiting for container {container_name} (ID: {container_id}) to reach 'running' status...")
+    # The promoted container keeps its spare name in its reports and Squid log directory
+    node_state_store.alias(promoted["spare_name"], container_name)
+    container = promoted["container"]
+    new_container_id = container.id[:12]
+    lease = promoted["lease"]
+    node, vpn_file, vpn_type, public_ip, proxy_info = extract_info(report_inbox.get(new_container_id))
+    update_vpn_info(container_name, vpn_file or promoted["entry"]["file"], vpn_type or promoted["entry"]["proto"].upper(),
+                    public_ip, "running", "Connected", new_container_id, lease["open_port"], proxy_info, lease["socks5_port"])
+    return True
 
-    # First, wait for the container to start or exit
-    for _ in range(timeout):
-        try:
-            container = client.containers.get(container_id)
-        except docker.errors.NotFound:
-            print(f"[ERROR] Container {container_id} not found. Exiting wait.")
-            return False
 
-        status = container.status
+def recover_node(container_name, container_id):
+    """
+    Supervisor restart callback: promote a warm spare if one is ready, otherwise restart in place.
+    """
+    return promote_spare(container_name, container_id) or restart_container(container_name, container_id)
 
-        if status == "running":
-            print(f"[INFO] Container {container_name} (ID: {container_id}) is now running.")
-            
-            # Update the CSV immediately with "running" status
-            if public_ip_file.exists():
-                node, vpn_file, vpn_type, public_ip, proxy_info = extract_info_from_file(public_ip_file)
-                update_vpn_info(container_name, vpn_file, vpn_type, public_ip, "running", "Connected", 
-                                container_id, "N/A", proxy_info, "N/A")
-            else:
-                # Fallback to cached data if public_ip_file doesn't exist
-                if container_id in public_ip_cache:
-                    cache_data = public_ip_cache[container_id]
-                    update_vpn_info(container_name, cache_data['vpn_file'], cache_data['vpn_type'], 
-                                    cache_data['public_ip'], "running", "Connected", 
-                                    container_id, "N/A", cache_data['proxy_info'], "N/A")
-            break
-        elif status == "exited":
-            print(f"[WARNING] Container {container_name} (ID: {container_id}) has exited.")
-            restart_container(container_id, container_name)
-            return False  # Restart initiated, exit this check
-        time.sleep(1)
-    else:
-        print(f"[ERROR] Container {container_name} (ID: {container_id}) did not reach 'running' status within {timeout} seconds.")
+
+def record_supervisor_state(node_name, old_state, new_state):
+    node_state_store.update(node_name, supervisor_state=new_state)
+
+
+# Restarts run on the supervisor's bounded pool with backoff and an Auth Failed circuit breaker
+supervisor = NodeSupervisor(recover_node, on_transition=record_supervisor_state)
+
+
+
+
+def wait_for_container(container_id, container_name):
+    """
+    Checks the container's status in this pass's fleet snapshot and logs it.
+    Returns True if container is running successfully, or "exited" if it has exited;
+    restarting an exited node is left to the supervisor. Nodes that are still starting
+    are picked up again on the next pass instead of being polled here.
+    """
+    report_wait_timeout = 60  # Set additional timeout for the node's status report
+
+    # Status comes from the snapshot taken once per pass, not from an inspect per node
+    node_state = fleet_snapshot.get(container_id)
+    if node_state is None:
+        log.error("Container %s not found. Exiting wait.", container_id)
         return False
 
-    # Check for public IP file once the container is running
-    print(f"[INFO] Waiting for public IP file for {container_name} (ID: {container_id})...")
-    for _ in range(file_wait_timeout):
-        if public_ip_file.exists():
-            print(f"[INFO] Public IP file found for {container_name} (ID: {container_id}). Proceeding with further checks.")
-            return True
-        time.sleep(1)
+    status = node_state["state"]
+    log.info("Container %s (ID: %s) is %s (restarts: %s).", container_name, container_id,
+             node_state['status_text'], node_state['restart_count'], extra={"node": container_name})
 
-    print(f"[ERROR] Public IP file not found for {container_name} (ID: {container_id}) within {file_wait_timeout} seconds. Using cached data if available.")
+    if status in ("exited", "dead"):
+        log.warning("Container %s (ID: %s) has exited.", container_name, container_id, extra={"node": container_name})
+        return "exited"  # Restarting is left to the supervisor
+    if status != "running":
+        log.info("Container %s (ID: %s) is not running yet. Checking again next pass.", container_name, container_id, extra={"node": container_name})
+        return False
+
+    # Update the CSV immediately with "running" status
+    report = report_inbox.get(container_id)
+    if report is not None:
+        node, vpn_file, vpn_type, public_ip, proxy_info = extract_info(report)
+        update_vpn_info(container_name, vpn_file, vpn_type, public_ip, "running", "Connected",
+                        container_id, "N/A", proxy_info, "N/A")
+    else:
+        # Fallback to cached data if the node has not reported
+        if container_id in public_ip_cache:
+            cache_data = public_ip_cache[container_id]
+            update_vpn_info(container_name, cache_data['vpn_file'], cache_data['vpn_type'],
+                            cache_data['public_ip'], "running", "Connected",
+                            container_id, "N/A", cache_data['proxy_info'], "N/A")
+
+    # Wait for the status report once the container is running; the wait ends as soon as it arrives
+    log.info("Waiting for the status report of %s (ID: %s)...", container_name, container_id)
+    if report_inbox.wait_for(container_id, report_wait_timeout) is not None:
+        log.info("Status report received for %s (ID: %s). Proceeding with further checks.", container_name, container_id)
+        return True
+
+    log.error("No status report from %s (ID: %s) within %s seconds. Using cached data if available.", container_name, container_id, report_wait_timeout, extra={"node": container_name})
     return False
 
 
@@ -281,30 +363,139 @@ def collect_public_ips_and_ports():
     container_info = {}  # Dictionary to store container info, keyed by node name
 
     while True:  # Continuous monitoring
-        print(f"[CHECK {check_counter}] Starting check {check_counter}...")
+        run_check_pass(check_counter, container_info)
+        check_counter += 1
+        time.sleep(120)  # Wait for 5 seconds before the next check to avoid overwhelming the system
 
-        container_ids = get_container_ids()  # Get current container IDs
-        logged_files = set()  # A set to keep track of files that have already been logged
 
-        # Update container info if it's the first time or after restarts
-        update_container_info(container_ids, container_info)
+def run_check_pass(check_counter, container_info):
+    """
+    One pass of the threaded monitor over every node. `container_info` carries node info between passes.
+    """
+    log.info("[CHECK %s] Starting check %s...", check_counter, check_counter)
+    pass_start = time.perf_counter()
+
+    # One list call per pass; every node's status is read from this snapshot
+    fleet_snapshot.refresh()
+    container_ids = fleet_snapshot.container_ids()
+
+    # Update container info if it's the first time or after restarts
+    update_container_info(container_ids, container_info)
+
+    for i, (node_name, info) in enumerate(container_info.items(), start=1):
+        container_id = info["container_id"]
+        container_name = f"vpn_node_{i}"
+        open_port = info["open_port"]
+        socks5_port = info["socks5_port"]
+
+        # The supervisor owns nodes that are being restarted
+        if supervisor.is_busy(container_name):
+            log.info("%s is restarting. Skipping this check.", container_name, extra={"node": container_name})
+            continue
+
+        # Process container status even if the report has been processed
+        if report_inbox.get(container_id) is not None or container_id in public_ip_cache:
+            process_container_status(container_id, container_name, open_port, socks5_port, container_info)
+        else:
+            log.error("Neither status report nor cache available for %s. Skipping.", container_name, extra={"node": container_name})
 
-        for i, (node_name, info) in enumerate(container_info.items(), start=1):
-            container_id = info["container_id"]
-            container_name = f"vpn_node_{i}"
-            open_port = info["open_port"]
-            socks5_port = info["socks5_port"]
-            public_ip_file = SHARED_DIR / f"{container_id}-ip.txt"
+    expire_exited_nodes()
+    emitter.observe("vpn_monitor_pass_duration_seconds", time.perf_counter() - pass_start, {"engine": "threaded"})
+    log.info("Completed check %s. All containers have been checked.", check_counter)
+    pass_stats = api_stats.reset()
+    calls = sum(entry["count"] for entry in pass_stats.values())
+    seconds = sum(entry["seconds"] for entry in pass_stats.values())
+    log.info("Check %s made %s Docker API calls taking %.2f seconds:\n%s", check_counter, calls, seconds, format_api_stats(pass_stats))
 
-            # Process container status even if the file has been processed
-            if public_ip_file.exists() or container_id in public_ip_cache:
-                process_container_status(container_id, container_name, open_port, socks5_port, public_ip_file, container_info)
-            else:
-                print(f"[ERROR] Neither public IP file nor cache available for {container_name}. Skipping.")
-        
-        print(f"[INFO] Completed check {check_counter}. All containers have been checked.")
-        check_counter += 1
-        time.sleep(120)  # Wait for 5 seconds before the next check to avoid overwhelming the system
+
+def expire_exited_nodes():
+    """
+    Remove exited nodes whose last update is older than EXITED_NODE_TTL from the CSV.
+    Costs one heap peek when nothing is due.
+    """
+    try:
+        forget_nodes(remove_expired_nodes(exited_expiry))
+    except Exception as e:
+        log.exception("Failed to remove expired nodes from the CSV: %s", e)
+
+
+def handle_remote_observation(node):
+    """
+    Apply an observation pushed by another host's reporter. Its status report goes into the local
+    inbox, so bring-up and restarts wait on remote nodes the same way as on local ones.
+    Until bring-up is done, the latest observation per node is held back, as local nodes are not monitored yet.
+    """
+    if node["changed"] and node["public_ip_info"]:
+        report_inbox.put(dict(node["public_ip_info"], Node=node["container_id"]))
+    if not monitoring.is_set():
+        previous = remote_backlog.get(node["name"])
+        if previous is not None and previous["changed"] and not node["changed"]:
+            node = dict(node, changed=True, public_ip_info=node["public_ip_info"] or previous["public_ip_info"])
+        remote_backlog[node["name"]] = node
+        return
+    handle_node_observation(node)
+
+
+def start_monitoring():
+    """
+    Apply the remote observations held back during bring-up, then apply new ones as they arrive.
+    """
+    with observation_lock:
+        monitoring.set()
+        for node in remote_backlog.values():
+            handle_node_observation(node)
+        remote_backlog.clear()
+
+
+def report_attempt(container_id):
+    """
+    The start a node's current status report came from, or None if it has not reported since it (re)started.
+    """
+    revision = report_inbox.revision_of(container_id)
+    return (container_id, revision) if revision else None
+
+
+def handle_fleet_observation(node):
+    with observation_lock:
+        handle_node_observation(node)
+
+
+def handle_node_observation(node):
+    """
+    Apply one async monitor observation: update the CSV when the node's status or status report
+    changed, and report the node to the supervisor on every pass. Observations pushed by other
+    hosts' reporters (fleet_hosts.py) have the same shape.
+    """
+    expire_exited_nodes()
+    container_name = node["name"]
+    container_id = node["container_id"]
+    if supervisor.is_busy(container_name):
+        return
+
+    lease = port_allocator.lease(container_name)
+    open_port, socks5_port = lease["open_port"], lease["socks5_port"]
+    info = node["public_ip_info"] or {}
+    cached = public_ip_cache.get(container_id, {})
+    public_ip = info.get("Public IP") or cached.get("public_ip")
+    if public_ip and "Auth Failed" in public_ip:
+        public_ip = "Auth Failed"
+
+    if node["status"] in ("exited", "dead"):
+        if node["changed"]:
+            update_vpn_info(container_name, info.get("VPN File") or cached.get("vpn_file", "N/A"),
+                            info.get("VPN_TYPE") or cached.get("vpn_type", "N/A"), public_ip or "VPN failed to start",
+                            "Exited", "Not Connected", container_id, open_port, "Disconnected", socks5_port)
+        supervisor.observe(container_name, "exited", public_ip, container_id, report_attempt(container_id))
+        return
+
+    if node["status"] != "running":
+        return  # Created, restarting or paused: wait for the next pass
+
+    if node["changed"] and info:
+        connectivity = determine_connectivity(public_ip, info.get("Proxy Info") or "", socks5_port)
+        update_vpn_info(container_name, info.get("VPN File") or "N/A", info.get("VPN_TYPE") or "N/A", public_ip,
+                        "running", connectivity, container_id, open_port, connectivity, socks5_port)
+    supervisor.observe(container_name, "running", public_ip, container_id, report_attempt(container_id))
 
 
 def cache_public_ip(container_id, node, vpn_file, vpn_type, public_ip, connectivity, open_port, socks5_port):
@@ -323,7 +514,7 @@ def cache_public_ip(container_id, node, vpn_file, vpn_type, public_ip, connectiv
         "open_port": open_port if open_port != "N/A" else public_ip_cache.get(container_id, {}).get("open_port", "N/A"),
         "socks5_port": socks5_port if socks5_port != "N/A" else public_ip_cache.get(container_id, {}).get("socks5_port", "N/A")
     }
-    print(f"[DEBUG] Cached public IP and connectivity data for container {container_id}.")
+    log.debug("Cached public IP and connectivity data for container %s.", container_id)
 
 
 
@@ -336,8 +527,9 @@ def update_container_info(container_ids, container_info):
     """
     for i, container_id in enumerate(container_ids, start=1):
         node_name = f"vpn_node_{i}"
-        open_port = UDP_START_PORT + (i - 1)  # Assign open port starting from 8080
-        socks5_port = SOCKS5_START_PORT + (i - 1)  # Assign SOCKS5 port starting from 9090
+        lease = port_allocator.lease(node_name)  # Same ports build_vpn_nodes published for this node
+        open_port = lease["open_port"]
+        socks5_port = lease["socks5_port"]
         
         if node_name not in container_info:
             container_info[node_name] = {
@@ -348,7 +540,7 @@ def update_container_info(container_ids, container_info):
         else:
             # Check if the container ID has changed (in case of restarts)
             if container_info[node_name]["container_id"] != container_id:
-                print(f"[INFO] Container ID for {node_name} changed from {container_info[node_name]['container_id']} to {container_id}. Updating...")
+                log.info("Container ID for %s changed from %s to %s. Updating...", node_name, container_info[node_name]['container_id'], container_id)
                 container_info[node_name]["container_id"] = container_id
                 container_info[node_name]["open_port"] = open_port  # Update the open port if container changes
                 container_info[node_name]["socks5_port"] = socks5_port  # Update the SOCKS5 port if container changes
@@ -357,119 +549,91 @@ def update_container_info(container_ids, container_info):
 
 
 
-def process_container_status(container_id, container_name, open_port, socks5_port, public_ip_file, container_info):
+def process_container_status(container_id, container_name, open_port, socks5_port, container_info):
     """
-    Handles the status of a single container: checks if it exited, waits for the public IP file, and processes the file.
+    Handles the status of a single container: checks if it exited, waits for its status report, and processes the report.
     Restarts the container and updates the container ID if necessary.
     """
     # Check the container status first
     container_status = wait_for_container(container_id, container_name)
+    report = report_inbox.get(container_id)
 
     # Restart the container if it has exited
     if container_status == "exited":
-        if public_ip_file.exists():
-            print(f"[DEBUG] Updating exited container {container_name} (ID: {container_id}) with 'Exited' status.")
-            node, vpn_file, vpn_type, public_ip, proxy_info = extract_info_from_file(public_ip_file)
+        if report is not None:
+            log.debug("Updating exited container %s (ID: %s) with 'Exited' status.", container_name, container_id)
+            node, vpn_file, vpn_type, public_ip, proxy_info = extract_info(report)
 
             # Update CSV with the exited status
             update_vpn_info(container_name, vpn_file or "N/A", vpn_type or "N/A", 
                             public_ip or "VPN failed to start", "Exited", "Not Connected", 
                             container_id, open_port, proxy_info or "No Proxy", socks5_port)
-
-            # Keep the old public IP file until the new container is fully ready
-            print(f"[DEBUG] Retaining old public IP file for {container_name} (ID: {container_id}) until the new one is fully ready.")
-            return  # Exit early, avoiding deletion of the old file until the new one is available
+            supervisor.observe(container_name, "exited", public_ip, container_id, report_attempt(container_id))
+            return
 
         else:
-            print(f"[ERROR] No public IP file found for exited container {container_name} (ID: {container_id}). Relying on cached data.")
-            # Fall back to cache if no public IP file is found
+            log.error("No status report found for exited container %s (ID: %s). Relying on cached data.", container_name, container_id, extra={"node": container_name})
+            # Fall back to cache if the node never reported
             if container_id in public_ip_cache:
                 cache_data = public_ip_cache[container_id]
                 update_vpn_info(container_name, cache_data['vpn_file'], cache_data['vpn_type'], 
                                 cache_data['public_ip'], "Exited", "Not Connected", 
                                 container_id, open_port, cache_data['proxy_info'], socks5_port)
+        supervisor.observe(container_name, "exited", public_ip_cache.get(container_id, {}).get("public_ip"), container_id, report_attempt(container_id))
         return
 
-    # If the container is running, ensure the public IP file is processed
-    if public_ip_file.exists():
-        if public_ip_file in processed_files:
-            print(f"[INFO] Public IP file for {container_name} (ID: {container_id}) has already been processed. Skipping reprocessing.")
+    # If the container is running, ensure its latest report is processed once
+    if report is not None:
+        revision = report_inbox.revision_of(container_id)
+        if processed_reports.get(container_id) == revision:
+            log.info("Status report for %s (ID: %s) has already been processed. Skipping reprocessing.", container_name, container_id, extra={"node": container_name})
         else:
-            fully_formatted = False
-            attempt = 0
-
-            print(f"[DEBUG] Waiting for {public_ip_file} to be fully formatted...")
-
-            while attempt < MAX_ATTEMPTS:
-                node, vpn_file, vpn_type, public_ip, proxy_info = extract_info_from_file(public_ip_file)
-
-                if node and vpn_file and public_ip and proxy_info:
-                    fully_formatted = True
-                    print(f"[DEBUG] {public_ip_file} is fully formatted. Proceeding with data extraction.")
-                    break
-                else:
-                    print(f"[DEBUG] {public_ip_file} is not fully formatted yet. Waiting for it...")
-                    time.sleep(2)
-                    attempt += 1
-
-            if fully_formatted:
-                process_public_ip_file(container_name, container_id, public_ip_file, open_port, socks5_port)
-                processed_files[public_ip_file] = "processed"  # Mark the file as processed
-
-                # Now we can safely delete the old file
-                if DELETE_TEXT_FILES:
-                    print(f"[DEBUG] Deleting processed file {public_ip_file}...")
-                    delete_text_file(public_ip_file)
-            else:
-                print(f"[ERROR] {public_ip_file} was not fully formatted after {MAX_ATTEMPTS} attempts. Skipping.")
+            process_report(container_name, container_id, report, open_port, socks5_port)
+            processed_reports[container_id] = revision
     else:
-        print(f"[ERROR] Public IP file {public_ip_file} does not exist for {container_name}. Using cache for data.")
-        # Fall back to cached data if the public IP file does not exist
+        log.error("No status report from %s. Using cache for data.", container_name, extra={"node": container_name})
+        # Fall back to cached data if the node has not reported
         if container_id in public_ip_cache:
             cache_data = public_ip_cache[container_id]
             update_vpn_info(container_name, cache_data['vpn_file'], cache_data['vpn_type'], 
                             cache_data['public_ip'], "running", "Connected", 
                             container_id, open_port, cache_data['proxy_info'], socks5_port)
 
+    # Running but without a public IP counts as degraded; the supervisor restarts it if that persists
+    public_ip = public_ip_cache.get(container_id, {}).get("public_ip") if container_status else None
+    supervisor.observe(container_name, "running", public_ip, container_id, report_attempt(container_id))
 
 
 
 
 
 
-def extract_info_from_file(public_ip_file):
-    with open(public_ip_file) as f:
-        lines = f.readlines()
-    node = extract_value("Node", lines)
-    vpn_file = extract_value("VPN File", lines)
-    vpn_type = extract_value("VPN_TYPE", lines)  # Added to extract VPN_TYPE from the text file
-    public_ip = extract_value("Public IP", lines)
-    proxy_info = extract_value("Proxy Info", lines)
-    return node, vpn_file, vpn_type, public_ip, proxy_info
 
+def extract_info(report):
+    """
+    Return (node, vpn_file, vpn_type, public_ip, proxy_info) from a node's status report (None when missing).
+    """
+    report = report or {}
+    return (report.get("Node"), report.get("VPN File"), report.get("VPN_TYPE"),
+            report.get("Public IP"), report.get("Proxy Info"))
 
-def extract_value(label, lines):
-    for line in lines:
-        if line.startswith(f"{label}: "):
-            return line.split(f"{label}: ")[1].strip()
-    return None
 
-def process_public_ip_file(container_name, container_id, public_ip_file, open_port, socks5_port):
-    node, vpn_file, vpn_type, public_ip, proxy_info = extract_info_from_file(public_ip_file)
+def process_report(container_name, container_id, report, open_port, socks5_port):
+    node, vpn_file, vpn_type, public_ip, proxy_info = extract_info(report)
 
-    if "Auth Failed" in public_ip:
+    if public_ip and "Auth Failed" in public_ip:
         public_ip = "Auth Failed"
-        print(f"[DEBUG] Auth Failed detected for container {container_name}.")
+        log.debug("Auth Failed detected for container %s.", container_name)
     
     # Determine connectivity based on proxy info and valid port
-    connectivity = determine_connectivity(public_ip, proxy_info, socks5_port)
+    connectivity = determine_connectivity(public_ip, proxy_info or "", socks5_port)
     proxy_info = "Connected" if connectivity == "Connected" else "Disconnected"
 
     if not open_port or open_port == "N/A":
-        print(f"[DEBUG] Open port not set for {container_name} (ID: {container_id}). Skipping update.")
+        log.debug("Open port not set for %s (ID: %s). Skipping update.", container_name, container_id)
         return
 
-    print(f"[DEBUG] Determined connectivity: {connectivity}, SOCKS5 Port: {socks5_port}, Open Port: {open_port}")
+    log.debug("Determined connectivity: %s, SOCKS5 Port: %s, Open Port: %s", connectivity, socks5_port, open_port)
 
     # Cache the public IP info, including the valid ports and determined connectivity
     cache_public_ip(container_id, node, vpn_file, vpn_type, public_ip, connectivity, open_port, socks5_port)
@@ -477,8 +641,6 @@ def process_public_ip_file(container_name, container_id, public_ip_file, open_po
     # Update VPN info with the corrected connectivity status and valid ports
     update_vpn_info(container_name, vpn_file or "N/A", vpn_type or "N/A", public_ip, "running", connectivity, container_id, open_port, proxy_info, socks5_port)
 
-    if DELETE_TEXT_FILES:
-        delete_text_file(public_ip_file)
 
 
 
@@ -491,15 +653,28 @@ def process_public_ip_file(container_name, container_id, public_ip_file, open_po
 
 
 
+def report_bound_fleet_ports():
+    """
+    Report fleet ports that are still bound after cleanup. The socket tables are read once
+    for the whole fleet instead of probing each port with lsof.
+    """
+    bound = bound_ports(port_allocator.fleet_port_ranges())
+    if not bound:
+        log.debug("No fleet ports are bound.")
+        return {}
 
-def check_port_in_use(port):
-    return subprocess.run(f"lsof -i :{port}", shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+    for port, protocols in sorted(bound.items()):
+        log.warning("Port %s is still in use (%s). The next node using it will fail to start.", port, ', '.join(sorted(protocols)))
+    return bound
 
 
 def update_vpn_info(container_name, vpn_file, vpn_type, public_ip, status, connectivity, container_id, open_port, proxy_info, socks5_port):
+    # Queue the observation for the history store; only real transitions are kept
+    node_history.record(container_name, status.capitalize(), connectivity, public_ip)
+
     # If either open_port or socks5_port is 'N/A', attempt to update with valid cached or determined values
     if open_port == 'N/A' or socks5_port == 'N/A':
-        print(f"[DEBUG] Missing port information for {container_name} (ID: {container_id}). Attempting to update from cache.")
+        log.debug("Missing port information for %s (ID: %s). Attempting to update from cache.", container_name, container_id)
         
         # Attempt to pull from cache if available
         if container_id in public_ip_cache:
@@ -509,39 +684,36 @@ def update_vpn_info(container_name, vpn_file, vpn_type, public_ip, status, conne
 
         # Log if we still have 'N/A' ports after checking the cache
         if open_port == 'N/A' or socks5_port == 'N/A':
-            print(f"[ERROR] Ports missing for {container_name} (ID: {container_id}). Cannot update CSV or cache without valid port info.")
+            log.error("Ports missing for %s (ID: %s). Cannot update CSV or cache without valid port info.", container_name, container_id, extra={"node": container_name})
             return
 
     # Convert ports to strings if they are integers
     open_port_str = str(open_port)
     socks5_port_str = str(socks5_port)
 
+    # Written in-process (a few ms under the CSV lock) instead of a python3 update_vpn_info.py per change.
     # Pass the connectivity (Connected/Disconnected) instead of proxy_info
-    args = [str(PYTHON_SCRIPT), container_name, vpn_file, public_ip, vpn_type, status, connectivity, container_id, open_port_str, connectivity, socks5_port_str]
-
-    # Use subprocess to run the script and capture both stdout and stderr
     try:
-        result = subprocess.run(["python3"] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        
-        # Output stdout and stderr to the console
-        if result.stdout:
-            print(result.stdout)
-        if result.stderr:
-            print(result.stderr)
-        
-        # Handle non-zero exit codes
-        if result.returncode != 0:
-            print(f"[ERROR] Failed to update VPN info for {container_name} (ID: {container_id})")
+        write_start = time.time()
+        try:
+            update_csv(container_name, vpn_file, public_ip, vpn_type, status, connectivity, container_id, open_port_str,
+                       connectivity, socks5_port_str)
+        except Exception as e:
+            log.exception("Failed to update VPN info for %s (ID: %s): %s", container_name, container_id, e, extra={"node": container_name})
         else:
-            print(f"[DEBUG] Successfully updated VPN info for {container_name} (ID: {container_id})")
+            log.debug("Successfully updated VPN info for %s (ID: %s)", container_name, container_id)
+            tracer.first("first_status_write", container_name, write_start, time.time(), status=status, connectivity=connectivity)
             
             # Cache the updated info, ensuring that connectivity is correctly stored
             cache_public_ip(container_id, container_name, vpn_file, vpn_type, public_ip, connectivity, open_port_str, socks5_port_str)
-    except Exception as e:
-        print(f"[ERROR] An exception occurred while updating VPN info: {str(e)}")
-        traceback.print_exc()
-
 
+            # Exited nodes drop out of the CSV once they go without an update for EXITED_NODE_TTL
+            if status.lower() == "exited":
+                exited_expiry.touch(container_name, time.time())
+            else:
+                exited_expiry.cancel(container_name)
+    except Exception as e:
+        log.exception("An exception occurred while updating VPN info: %s", str(e))
 
 
 
@@ -551,32 +723,21 @@ def update_vpn_info(container_name, vpn_file, vpn_type, public_ip, status, conne
 
 
 
-def delete_text_file(public_ip_file):
-    if public_ip_file.exists():
-        try:
-            print(f"[DEBUG] Deleting public IP file {public_ip_file}...")
-            public_ip_file.unlink()
-            print(f"[DEBUG] Successfully deleted public IP file {public_ip_file}.")
-            processed_files[public_ip_file] = "processed"  # Ensure file is marked as processed
-        except Exception as e:
-            print(f"[ERROR] Failed to delete {public_ip_file}: {str(e)}")
-            traceback.print_exc()
-    else:
-        print(f"[DEBUG] Public IP file {public_ip_file} does not exist, skipping deletion.")
 
 
 def delete_csv_file():
     csv_file = Path.cwd() / "vpn_nodes_info.csv"  # Assuming the CSV file is named vpn_info.csv
     if csv_file.exists():
         try:
-            print(f"[DEBUG] Deleting CSV file {csv_file}...")
+            log.debug("Deleting CSV file %s...", csv_file)
             csv_file.unlink()  # Delete the file
-            print(f"[DEBUG] Successfully deleted CSV file {csv_file}.")
+            log.debug("Successfully deleted CSV file %s.", csv_file)
         except Exception as e:
-            print(f"[ERROR] Failed to delete CSV file {csv_file}: {str(e)}")
-            traceback.print_exc()
+            log.exception("Failed to delete CSV file %s: %s", csv_file, str(e))
     else:
-        print(f"[DEBUG] CSV file {csv_file} does not exist, skipping deletion.")
+        log.debug("CSV file %s does not exist, skipping deletion.", csv_file)
+    if csv_store is not None:
+        csv_store.clear()
 
 
 
@@ -594,7 +755,7 @@ def parse_udp_tcp_node_count(udp_input, tcp_input, available_udp_nodes, availabl
             node_count = int(node_input)  # Ensure we are converting the value to an integer
             return min(node_count, available_nodes)
         except ValueError:
-            print("[ERROR] Invalid node count input. Please specify a valid number or 'all'.")
+            log.error("Invalid node count input. Please specify a valid number or 'all'.")
             return 0
 
     udp_node_count = parse_node_count(udp_input, available_udp_nodes)
@@ -606,31 +767,38 @@ def parse_udp_tcp_node_count(udp_input, tcp_input, available_udp_nodes, availabl
 
 def generate_docker_compose_file(udp_node_count, tcp_node_count):
     total_nodes = udp_node_count + tcp_node_count
-    print(f"[DEBUG] Calling generate_yml.py to create docker-compose.yml with {total_nodes} nodes.")
+    log.debug("Calling generate_yml.py to create docker-compose.yml with %s nodes.", total_nodes)
 
     try:
         # Run the generate_yml.py script with the correct argument format --nodes <number>
         result = subprocess.run(
-            ["python3", "generateyml.py", "--nodes", str(total_nodes)],
+            ["python3", "generateyml.py", "--nodes", str(total_nodes), "--shards", str(COMPOSE_SHARDS)] + MAX_PER_REGION_ARGS,
             capture_output=True,
             text=True,
             check=True
         )
         if result.returncode == 0:
-            print("[DEBUG] Successfully generated docker-compose.yml.")
+            log.debug("Successfully generated docker-compose.yml.")
         else:
-            print(f"[ERROR] Failed to generate docker-compose.yml: {result.stderr.strip()}")
+            log.error("Failed to generate docker-compose.yml: %s", result.stderr.strip())
     except subprocess.CalledProcessError as e:
-        print(f"[ERROR] Exception occurred during docker-compose.yml generation: {str(e)}")
-        traceback.print_exc()
+        log.exception("Exception occurred during docker-compose.yml generation: %s", str(e))
 
 
 
 def main():
-    global delete_csv_flag
+    global delete_csv_flag, spare_pool
     
+    # Nodes post their status reports here from the moment they start, including during bring-up
+    report_inbox.start()
+
+    # With several Docker hosts, every other host's reporter pushes its nodes' states to this process.
+    # Remote nodes' status reports only reach the inbox this way, so it must run before bring-up.
+    if not fleet_hosts.single_host:
+        FleetAggregator(handle_remote_observation, lock=observation_lock, hosts=fleet_hosts.order).start()
+
     # Ensure cleanup before starting the process
-    print("Ensuring cleanup of existing VPN nodes and Docker resources before starting...")
+    log.info("Ensuring cleanup of existing VPN nodes and Docker resources before starting...")
     cleanup_vpn_nodes()  # This will stop, remove, and prune any leftover nodes
 
     # Delete the CSV file only once, if it hasn't been deleted yet
@@ -638,24 +806,21 @@ def main():
         delete_csv_file()  # Delete the CSV file from the current working directory
         delete_csv_flag = True  # Set the flag to avoid re-deleting the CSV file
 
-    # Fetch available .ovpn files for both UDP and TCP
-    cwd = Path.cwd()
-    udp_ovpn_dir = cwd / 'ovpn_files' / 'udp'
-    tcp_ovpn_dir = cwd / 'ovpn_files' / 'tcp'
-
-    udp_ovpn_files = list(udp_ovpn_dir.glob("*.ovpn"))
-    tcp_ovpn_files = list(tcp_ovpn_dir.glob("*.ovpn"))
-
-    available_udp_nodes = len(udp_ovpn_files)
-    available_tcp_nodes = len(tcp_ovpn_files)
+    # Count the available .ovpn files for both UDP and TCP from the catalog index
+    catalog = load_catalog()
+    available_udp_nodes = catalog.count("udp")
+    available_tcp_nodes = catalog.count("tcp")
 
     # Use constants for node count and adjust dynamically for both UDP and TCP nodes
     udp_node_count, tcp_node_count = parse_udp_tcp_node_count(DEFAULT_UDP_NODES, DEFAULT_TCP_NODES, available_udp_nodes, available_tcp_nodes)
 
     if udp_node_count == 0 and tcp_node_count == 0:
-        print("No nodes to build. Exiting.")
+        log.info("No nodes to build. Exiting.")
         return
 
+    # Refresh latency scores so the compose file and the build both launch the fastest locations first
+    ServerSelector(catalog).measure()
+
     # Generate the docker-compose.yml based on the total node count
     generate_docker_compose_file(udp_node_count, tcp_node_count)
 
@@ -664,21 +829,37 @@ def main():
 
     # Build the new VPN nodes
     if not build_vpn_nodes(udp_node_count, tcp_node_count):  # Pass the node counts here
-        print("Failed to build VPN nodes. Exiting.")
+        log.error("Failed to build VPN nodes. Exiting.")
         return
 
-    # Retrieve container IDs after building nodes
-    container_ids = get_container_ids()
+    # Start tailing the Squid access logs for per-node traffic metrics
+    start_log_ingestion(node_state_store)
 
-    # Wait for each container to become ready and restart if exited
-    for i, container_id in enumerate(container_ids, start=1):
-        container_name = f"vpn_node_{i}"  # Generate the container name based on the index
-        print(f"Checking container (ID: {container_id})...")
-        wait_for_container(container_id, container_name)  # Pass both container_id and container_name
+    # Each node was already gated on its own readiness during bring-up
+    report_bringup()
+
+    # Keep warm spares on unused servers so a failed node can be replaced without a reconnect
+    if SPARE_COUNT > 0:
+        spare_pool = SparePool(client, port_allocator, ServerSelector(catalog), launch_spare, spare_ready,
+                               max_per_region=MAX_PER_REGION)
+        spare_pool.fill()
+
+    # With several Docker hosts, the aggregator started above covers the other hosts
+    if not fleet_hosts.single_host:
+        start_monitoring()
+        if any(fleet_hosts.is_local(host_name) for host_name in fleet_hosts.order):
+            run_async_monitor(handle_fleet_observation, report_inbox, MONITOR_INTERVAL)
+        else:
+            threading.Event().wait()
+        return
 
     # Continuous monitoring and updating of VPN nodes and ports
+    if ASYNC_MONITOR:
+        run_async_monitor(handle_node_observation, report_inbox, MONITOR_INTERVAL)
+        return
+
     while True:
-        print("Checking VPN nodes and updating CSV file...")
+        log.info("Checking VPN nodes and updating CSV file...")
         collect_public_ips_and_ports()
         time.sleep(10)
 
@@ -0,0 +1,224 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import json
+import math
+import socket
+import threading
+import time
+from vpn_logging import get_logger
+
+log = get_logger("metrics")
+
+# Producers (monitor, CSV writer, bring-up) send samples to the server over localhost UDP:
+# one small datagram per sample, never blocking and never failing the caller
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 4022
+MAX_DATAGRAM = 65507
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name -> (type, help, label names, buckets)
+METRICS = {
+    "vpn_node_up": ("gauge", "1 if the node's container is running.", ("node",), None),
+    "vpn_node_connected": ("gauge", "1 if the node's tunnel and proxy are connected.", ("node",), None),
+    "vpn_node_info": ("gauge", "Current status, connectivity and VPN type of each node.", ("node", "status", "connectivity", "vpn_type"), None),
+    "vpn_node_last_update_timestamp_seconds": ("gauge", "Unix time of the node's last CSV update.", ("node",), None),
+    "vpn_node_open_port": ("gauge", "Host port published for the node's OpenVPN endpoint.", ("node",), None),
+    "vpn_node_socks5_port": ("gauge", "Host port of the node's proxy.", ("node",), None),
+    "vpn_monitor_pass_duration_seconds": ("histogram", "Duration of one monitor pass over the fleet.", ("engine",), DEFAULT_BUCKETS),
+    "vpn_csv_write_duration_seconds": ("histogram", "Time to update the node CSV for one node.", (), DEFAULT_BUCKETS),
+    "vpn_websocket_clients": ("gauge", "Connected dashboard WebSocket clients.", (), None),
+    "vpn_websocket_broadcast_duration_seconds": ("histogram", "Time to notify every WebSocket client of a CSV change.", (), DEFAULT_BUCKETS),
+    "vpn_docker_api_request_duration_seconds": ("histogram", "Latency of Docker Engine API requests.", ("endpoint",), DEFAULT_BUCKETS),
+}
+
+# Derived at scrape time from another gauge: name -> (source gauge, help)
+AGE_METRICS = {
+    "vpn_node_last_update_age_seconds": ("vpn_node_last_update_timestamp_seconds", "Seconds since the node's last CSV update."),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class MetricsRegistry:
+    """
+    In-process store for the metrics declared in METRICS, rendered in OpenMetrics text format.
+    """
+
+    def __init__(self, metrics=METRICS):
+        self.lock = threading.Lock()
+        self.metrics = metrics
+        self.series = {name: {} for name in metrics}  # name -> {label values: value or histogram state}
+
+    def _labels(self, name, labels):
+        return tuple(str((labels or {}).get(label, "")) for label in self.metrics[name][2])
+
+    def set(self, name, value, labels=None, replace=None):
+        """
+        Set a gauge. With `replace` (a label name), other series sharing that label's value are
+        dropped first, so e.g. a node has only one vpn_node_info series.
+        """
+        key = self._labels(name, labels)
+        with self.lock:
+            series = self.series[name]
+            if replace:
+                index = self.metrics[name][2].index(replace)
+                for other in [other for other in series if other[index] == key[index] and other != key]:
+                    del series[other]
+            series[key] = value
+
+    def inc(self, name, value=1, labels=None):
+        key = self._labels(name, labels)
+        with self.lock:
+            self.series[name][key] = self.series[name].get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = self._labels(name, labels)
+        buckets = self.metrics[name][3]
+        with self.lock:
+            state = self.series[name].get(key)
+            if state is None:
+                state = self.series[name][key] = {"buckets": [0] * len(buckets), "count": 0, "sum": 0.0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["count"] += 1
+            state["sum"] += value
+
+    def remove(self, label, value):
+        """
+        Drop every series whose `label` equals `value` (e.g. a node that no longer exists).
+        """
+        with self.lock:
+            for name, (_, _, label_names, _) in self.metrics.items():
+                if label in label_names:
+                    index = label_names.index(label)
+                    for key in [key for key in self.series[name] if key[index] == str(value)]:
+                        del self.series[name][key]
+
+    def apply(self, sample):
+        """
+        Apply one sample received from a MetricsEmitter.
+        """
+        kind, name = sample.get("t"), sample.get("n")
+        if kind == "x":
+            self.remove(sample["k"], sample["v"])
+            return
+        if name not in self.metrics:
+            return
+        if kind == "g":
+            self.set(name, sample["v"], sample.get("l"), sample.get("r"))
+        elif kind == "c":
+            self.inc(name, sample["v"], sample.get("l"))
+        elif kind == "h":
+            self.observe(name, sample["v"], sample.get("l"))
+
+    def render(self, now=None):
+        now = time.time() if now is None else now
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, label_names, buckets) in self.metrics.items():
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"# HELP {name} {help_text}")
+                for key, value in sorted(self.series[name].items()):
+                    if kind == "histogram":
+                        for bound, count in zip(buckets, value["buckets"]):
+                            bucket_labels = _format_labels(label_names, key, 'le="%s"' % bound)
+                            lines.append(f"{name}_bucket{bucket_labels} {count}")
+                        bucket_labels = _format_labels(label_names, key, 'le="+Inf"')
+                        lines.append(f"{name}_bucket{bucket_labels} {value['count']}")
+                        lines.append(f"{name}_count{_format_labels(label_names, key)} {value['count']}")
+                        lines.append(f"{name}_sum{_format_labels(label_names, key)} {_format_value(value['sum'])}")
+                    elif kind == "counter":
+                        lines.append(f"{name}_total{_format_labels(label_names, key)} {_format_value(value)}")
+                    else:
+                        lines.append(f"{name}{_format_labels(label_names, key)} {_format_value(value)}")
+
+            for name, (source, help_text) in AGE_METRICS.items():
+                label_names = self.metrics[source][2]
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"# HELP {name} {help_text}")
+                for key, timestamp in sorted(self.series[source].items()):
+                    lines.append(f"{name}{_format_labels(label_names, key)} {_format_value(max(0.0, now - timestamp))}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsEmitter:
+    """
+    Fire-and-forget sender for the metrics channel. Safe to use from any process or thread;
+    if the server is not running, samples are simply dropped.
+    """
+
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def _send(self, sample):
+        try:
+            self.sock.sendto(json.dumps(sample, separators=(",", ":")).encode(), self.address)
+        except OSError:
+            pass  # Nobody listening or buffer full: metrics must never slow down the caller
+
+    def gauge(self, name, value, labels=None, replace=None):
+        sample = {"t": "g", "n": name, "v": value, "l": labels or {}}
+        if replace:
+            sample["r"] = replace
+        self._send(sample)
+
+    def inc(self, name, value=1, labels=None):
+        self._send({"t": "c", "n": name, "v": value, "l": labels or {}})
+
+    def observe(self, name, value, labels=None):
+        self._send({"t": "h", "n": name, "v": value, "l": labels or {}})
+
+    def remove(self, label, value):
+        """
+        Drop every series whose `label` equals `value`, e.g. the series of a removed node.
+        """
+        self._send({"t": "x", "k": label, "v": value})
+
+
+def serve_metrics_channel(registry, host=METRICS_HOST, port=METRICS_PORT, stop_event=None):
+    """
+    Receive samples from emitters and apply them to `registry` until `stop_event` is set.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    sock.settimeout(1)
+    log.info("Metrics channel listening on udp://%s:%s", host, port)
+    while stop_event is None or not stop_event.is_set():
+        try:
+            data, _ = sock.recvfrom(MAX_DATAGRAM)
+            registry.apply(json.loads(data))
+        except socket.timeout:
+            continue
+        except Exception as e:
+            log.error("Bad metrics sample: %s", e)
+    sock.close()
+
+
+def start_metrics_channel(registry, stop_event=None):
+    thread = threading.Thread(target=serve_metrics_channel, args=(registry,), kwargs={"stop_event": stop_event},
+                              name="metrics-channel", daemon=True)
+    thread.start()
+    return thread
+
+
+registry = MetricsRegistry()  # The server's registry
+emitter = MetricsEmitter()  # Shared sender for producers in this process
@@ -0,0 +1,450 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import ipaddress
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from node_index import node_sort_key
+from vpn_logging import get_logger
+
+log = get_logger("node_history")
+
+# Append-only history of node state transitions (SQLite in WAL mode)
+HISTORY_DB = Path("./node_history.db")
+
+WRITE_BATCH = 500  # Transitions committed per transaction at most
+RAW_RETENTION = 7 * 86400  # Raw transitions older than this are folded into daily rollups
+DAILY_RETENTION = 365 * 86400  # Daily rollups older than this are dropped
+COMPACT_INTERVAL = 3600  # Seconds between compaction runs on the writer thread
+DAY = 86400
+
+# Minute/hour rollups for the dashboard charts, advanced incrementally by the writer thread
+ROLLUP_FLUSH_INTERVAL = 60  # Seconds between accounting the time nodes spent in their current state
+REMOVED = "Removed"  # Status recorded when a node leaves the fleet; it accrues no time until seen again
+NOT_OBSERVED = -1  # `up` of a Removed transition
+MINUTE_RETENTION = 2 * 86400
+HOURLY_RETENTION = 30 * 86400
+MINUTE = 60
+HOUR = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transitions (
+    node TEXT NOT NULL, ts REAL NOT NULL, status TEXT, connectivity TEXT, public_ip TEXT, up INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transitions_node_ts ON transitions (node, ts);
+CREATE TABLE IF NOT EXISTS daily (
+    node TEXT NOT NULL, day INTEGER NOT NULL, up_seconds REAL NOT NULL, observed_seconds REAL NOT NULL,
+    failures INTEGER NOT NULL, ip_changes INTEGER NOT NULL, PRIMARY KEY (node, day)
+);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+CREATE TABLE IF NOT EXISTS node_hourly (
+    node TEXT NOT NULL, hour INTEGER NOT NULL, up_seconds REAL NOT NULL, observed_seconds REAL NOT NULL, PRIMARY KEY (node, hour)
+);
+CREATE TABLE IF NOT EXISTS fleet_minutely (
+    minute INTEGER PRIMARY KEY, up_seconds REAL NOT NULL, observed_seconds REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fleet_hourly (
+    hour INTEGER PRIMARY KEY, up_seconds REAL NOT NULL, observed_seconds REAL NOT NULL
+);
+"""
+
+ROLLUP_UPSERTS = {
+    "node_hourly": "INSERT INTO node_hourly VALUES (?, ?, ?, ?) ON CONFLICT (node, hour) DO UPDATE SET "
+                   "up_seconds = up_seconds + excluded.up_seconds, observed_seconds = observed_seconds + excluded.observed_seconds",
+    "fleet_minutely": "INSERT INTO fleet_minutely VALUES (?, ?, ?) ON CONFLICT (minute) DO UPDATE SET "
+                      "up_seconds = up_seconds + excluded.up_seconds, observed_seconds = observed_seconds + excluded.observed_seconds",
+    "fleet_hourly": "INSERT INTO fleet_hourly VALUES (?, ?, ?) ON CONFLICT (hour) DO UPDATE SET "
+                    "up_seconds = up_seconds + excluded.up_seconds, observed_seconds = observed_seconds + excluded.observed_seconds",
+}
+
+
+def is_up(status, connectivity):
+    return (status or "").lower() == "running" and (connectivity or "").lower() == "connected"
+
+
+def valid_ip(value):
+    try:
+        ipaddress.ip_address(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def interval_stats(prior, transitions, start, end):
+    """
+    Uptime, failures and IP changes over [start, end) from the state in effect at `start`
+    (`prior`, a (ts, up, public_ip) tuple or None) and the transitions inside the interval.
+    """
+    up_seconds = observed_seconds = 0.0
+    failures = ip_changes = 0
+    state_since, up = (start, prior[1]) if prior else (None, False)
+    last_ip = prior[2] if prior and valid_ip(prior[2]) else None
+
+    for ts, new_up, public_ip in transitions:
+        if state_since is not None and up != NOT_OBSERVED:
+            observed_seconds += ts - state_since
+            if up:
+                up_seconds += ts - state_since
+        if up and up != NOT_OBSERVED and not new_up:
+            failures += 1
+        if valid_ip(public_ip):
+            if last_ip is not None and public_ip != last_ip:
+                ip_changes += 1
+            last_ip = public_ip
+        state_since, up = ts, new_up
+
+    if state_since is not None and end > state_since and up != NOT_OBSERVED:
+        observed_seconds += end - state_since
+        if up:
+            up_seconds += end - state_since
+    return {"up_seconds": up_seconds, "observed_seconds": observed_seconds, "failures": failures, "ip_changes": ip_changes}
+
+
+def split_buckets(start, end, width):
+    """
+    Yield (bucket start, seconds of [start, end) inside that bucket) for fixed-width buckets.
+    """
+    bucket = int(start) // width * width
+    while bucket < end:
+        overlap = min(end, bucket + width) - max(start, bucket)
+        if overlap > 0:
+            yield bucket, overlap
+        bucket += width
+
+
+class Rollups:
+    """
+    Per-node hourly and fleet-wide minute/hour totals of up and observed seconds.
+    Each node's current state is an open interval; advance() accounts the time since it was
+    last accounted, so the totals only ever grow and are never recomputed from raw transitions.
+    Observations only arrive on changes, so an interval stays open until the node's Removed transition.
+    """
+
+    def __init__(self):
+        self.open = {}  # node -> [accounted until, up]
+        self.deltas = {"node_hourly": {}, "fleet_minutely": {}, "fleet_hourly": {}}
+
+    def _account(self, node, start, end, up):
+        for table, width, key in (("node_hourly", HOUR, node), ("fleet_minutely", MINUTE, None), ("fleet_hourly", HOUR, None)):
+            deltas = self.deltas[table]
+            for bucket, seconds in split_buckets(start, end, width):
+                totals = deltas.setdefault((key, bucket) if key else (bucket,), [0.0, 0.0])
+                totals[0] += seconds if up else 0.0
+                totals[1] += seconds
+
+    def observe(self, node, ts, up=None):
+        """
+        Note that a node was seen at `ts`; with `up`, its state changed at `ts`.
+        """
+        interval = self.open.get(node)
+        if interval is None:
+            if up is not None:
+                self.open[node] = [ts, up]
+            return
+        if up is not None:
+            if ts > interval[0]:
+                self._account(node, interval[0], ts, interval[1])
+            interval[0], interval[1] = max(ts, interval[0]), up
+
+    def close(self, node, ts):
+        """
+        Account a removed node's open interval up to `ts` and stop accruing its time.
+        """
+        interval = self.open.pop(node, None)
+        if interval is not None and ts > interval[0]:
+            self._account(node, interval[0], ts, interval[1])
+
+    def advance(self, now):
+        """
+        Account every open interval up to `now`.
+        """
+        for node, interval in self.open.items():
+            if now > interval[0]:
+                self._account(node, interval[0], now, interval[1])
+                interval[0] = now
+
+    def flush(self, conn):
+        """
+        Add the accumulated totals to the rollup tables (inside the caller's transaction).
+        """
+        for table, deltas in self.deltas.items():
+            if deltas:
+                conn.executemany(ROLLUP_UPSERTS[table], [(*key, up, observed) for key, (up, observed) in deltas.items()])
+                deltas.clear()
+
+
+def summarize(node, stats):
+    observed, up = stats["observed_seconds"], stats["up_seconds"]
+    return {
+        "node": node,
+        "uptime_percent": round(100 * up / observed, 2) if observed else None,
+        "mtbf_seconds": round(up / stats["failures"], 1) if stats["failures"] else None,
+        "failures": stats["failures"],
+        "ip_changes": stats["ip_changes"],
+        "observed_seconds": round(observed, 1),
+    }
+
+
+class NodeHistory:
+    """
+    Time series of node status, connectivity and public IP. record() only puts the
+    observation on a queue; a single writer thread keeps the rows that are real transitions and
+    appends them in batches, and periodically folds old transitions into daily rollups.
+    Readers open their own connections, which WAL mode lets run alongside the writer.
+    """
+
+    def __init__(self, path=HISTORY_DB, raw_retention=RAW_RETENTION, daily_retention=DAILY_RETENTION,
+                 compact_interval=COMPACT_INTERVAL):
+        self.path = Path(path)
+        self.raw_retention = raw_retention
+        self.daily_retention = daily_retention
+        self.compact_interval = compact_interval
+        self.queue = queue.Queue()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # Writer side
+
+    def record(self, node, status, connectivity, public_ip, ts=None):
+        """
+        Queue one observation of a node. Never blocks; unchanged states are dropped by the writer.
+        """
+        if self.writer is None:
+            self._start_writer()
+        self.queue.put_nowait((node, time.time() if ts is None else ts, status, connectivity, public_ip))
+
+    def remove(self, nodes, ts=None):
+        """
+        Record that nodes left the fleet, so their uptime stops at `ts` instead of running on.
+        """
+        ts = time.time() if ts is None else ts
+        for node in nodes:
+            self.record(node, REMOVED, None, None, ts)
+
+    def _start_writer(self):
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+                self.writer.start()
+
+    def _write_loop(self):
+        conn = self._connect()
+        last_state = {node: (status, connectivity, public_ip) for node, status, connectivity, public_ip in conn.execute(
+            "SELECT node, status, connectivity, public_ip FROM transitions t "
+            "WHERE ts = (SELECT MAX(ts) FROM transitions WHERE node = t.node)")}
+        rollups = Rollups()
+        next_compaction = time.time()
+        next_flush = time.time() + ROLLUP_FLUSH_INTERVAL
+        while True:
+            batch = []
+            try:
+                batch.append(self.queue.get(timeout=max(0.1, next_flush - time.time())))
+                while len(batch) < WRITE_BATCH:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = False
+            rows = []
+            for item in batch:
+                if item is None:
+                    stop = True
+                    continue
+                node, ts, status, connectivity, public_ip = item
+                if last_state.get(node) == (status, connectivity, public_ip):
+                    # Unchanged since before a restart of the writer: reopen its interval
+                    if status != REMOVED:
+                        rollups.observe(node, ts, None if node in rollups.open else is_up(status, connectivity))
+                    continue
+                if node not in last_state and status == REMOVED:
+                    continue  # Never observed, nothing to close
+                last_state[node] = (status, connectivity, public_ip)
+                if status == REMOVED:
+                    rollups.close(node, ts)
+                    up = NOT_OBSERVED
+                else:
+                    up = int(is_up(status, connectivity))
+                    rollups.observe(node, ts, bool(up))
+                rows.append((node, ts, status, connectivity, public_ip, up))
+
+            try:
+                flush = stop or time.time() >= next_flush
+                if flush:
+                    rollups.advance(time.time())
+                    next_flush = time.time() + ROLLUP_FLUSH_INTERVAL
+                if rows or flush:
+                    with conn:
+                        conn.executemany("INSERT INTO transitions VALUES (?, ?, ?, ?, ?, ?)", rows)
+                        rollups.flush(conn)
+                if time.time() >= next_compaction:
+                    self.compact(conn)
+                    next_compaction = time.time() + self.compact_interval
+            except Exception as e:
+                log.exception("Failed to write node history: %s", e)
+            if stop:
+                conn.close()
+                return
+
+    def close(self):
+        """
+        Flush queued observations and stop the writer thread.
+        """
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+
+    def compact(self, conn=None, now=None):
+        """
+        Fold raw transitions older than the raw retention into daily rollups, keeping the last one
+        per node as the state in effect at the cutoff, and drop rollups past the daily retention.
+        """
+        now = time.time() if now is None else now
+        own_conn = conn is None
+        conn = conn or self._connect()
+        cutoff = int(now - self.raw_retention) // DAY * DAY
+        compacted_until = self._compacted_until(conn)
+        if cutoff <= compacted_until:
+            if own_conn:
+                conn.close()
+            return 0
+
+        folded = 0
+        with conn:
+            for (node,) in conn.execute("SELECT DISTINCT node FROM transitions WHERE ts < ?", (cutoff,)).fetchall():
+                prior = conn.execute("SELECT ts, up, public_ip FROM transitions WHERE node = ? AND ts <= ? "
+                                     "ORDER BY ts DESC LIMIT 1", (node, compacted_until)).fetchone()
+                transitions = conn.execute("SELECT ts, up, public_ip FROM transitions WHERE node = ? AND ts > ? AND ts < ? "
+                                           "ORDER BY ts", (node, compacted_until, cutoff)).fetchall()
+                if not transitions and prior is None:
+                    continue
+                first_day = compacted_until if prior else int(transitions[0][0]) // DAY * DAY
+                for day in range(first_day, cutoff, DAY):
+                    in_day = [t for t in transitions if day <= t[0] < day + DAY]
+                    stats = interval_stats(prior, in_day, day, day + DAY)
+                    if stats["observed_seconds"]:
+                        conn.execute("INSERT OR REPLACE INTO daily VALUES (?, ?, ?, ?, ?, ?)",
+                                     (node, day, stats["up_seconds"], stats["observed_seconds"], stats["failures"], stats["ip_changes"]))
+                    if in_day:
+                        prior = in_day[-1]
+                # Keep only the newest transition before the cutoff as the baseline for later queries
+                latest = conn.execute("SELECT MAX(ts) FROM transitions WHERE node = ? AND ts < ?", (node, cutoff)).fetchone()[0]
+                folded += conn.execute("DELETE FROM transitions WHERE node = ? AND ts < ?", (node, latest)).rowcount
+            conn.execute("DELETE FROM daily WHERE day < ?", (int(now - self.daily_retention),))
+            conn.execute("DELETE FROM fleet_minutely WHERE minute < ?", (int(now - MINUTE_RETENTION),))
+            conn.execute("DELETE FROM node_hourly WHERE hour < ?", (int(now - HOURLY_RETENTION),))
+            conn.execute("DELETE FROM fleet_hourly WHERE hour < ?", (int(now - HOURLY_RETENTION),))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('compacted_until', ?)", (cutoff,))
+        if own_conn:
+            conn.close()
+        log.info("Compacted node history up to %s (%s transitions folded).", time.strftime('%Y-%m-%d', time.localtime(cutoff)), folded)
+        return folded
+
+    # Reader side
+
+    def _compacted_until(self, conn):
+        row = conn.execute("SELECT value FROM meta WHERE key = 'compacted_until'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _node_stats(self, conn, node, since, until, compacted_until):
+        stats = {"up_seconds": 0.0, "observed_seconds": 0.0, "failures": 0, "ip_changes": 0}
+        if since < compacted_until:
+            for row in conn.execute("SELECT SUM(up_seconds), SUM(observed_seconds), SUM(failures), SUM(ip_changes) "
+                                    "FROM daily WHERE node = ? AND day >= ? AND day < ?",
+                                    (node, since // DAY * DAY, min(until, compacted_until))):
+                if row[1]:
+                    stats = {"up_seconds": row[0], "observed_seconds": row[1], "failures": row[2], "ip_changes": row[3]}
+
+        start = max(since, compacted_until)
+        if until > start:
+            prior = conn.execute("SELECT ts, up, public_ip FROM transitions WHERE node = ? AND ts <= ? "
+                                 "ORDER BY ts DESC LIMIT 1", (node, start)).fetchone()
+            transitions = conn.execute("SELECT ts, up, public_ip FROM transitions WHERE node = ? AND ts > ? AND ts < ? "
+                                       "ORDER BY ts", (node, start, until)).fetchall()
+            raw = interval_stats(prior, transitions, start, until)
+            stats = {key: stats[key] + raw[key] for key in stats}
+        return stats
+
+    def node_stats(self, node, since=None, until=None):
+        """
+        Uptime %, mean time between failures and IP-change count for one node over [since, until).
+        `since` defaults to everything still retained.
+        """
+        until = time.time() if until is None else until
+        conn = self._connect()
+        try:
+            since = 0 if since is None else since
+            return summarize(node, self._node_stats(conn, node, since, until, self._compacted_until(conn)))
+        finally:
+            conn.close()
+
+    def fleet_stats(self, since=None, until=None):
+        """
+        node_stats() for every node with history, in node order.
+        """
+        until = time.time() if until is None else until
+        since = 0 if since is None else since
+        conn = self._connect()
+        try:
+            compacted_until = self._compacted_until(conn)
+            nodes = {node for (node,) in conn.execute("SELECT DISTINCT node FROM transitions")}
+            nodes |= {node for (node,) in conn.execute("SELECT DISTINCT node FROM daily")}
+            return [summarize(node, self._node_stats(conn, node, since, until, compacted_until))
+                    for node in sorted(nodes, key=node_sort_key)]
+        finally:
+            conn.close()
+
+    def transitions(self, node, since=None, until=None):
+        """
+        Raw transitions of one node, oldest first, as dicts.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT ts, status, connectivity, public_ip, up FROM transitions "
+                                "WHERE node = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                                (node, since or 0, time.time() if until is None else until)).fetchall()
+        finally:
+            conn.close()
+        return [{"ts": ts, "status": status, "connectivity": connectivity, "public_ip": public_ip, "up": up == 1}
+                for ts, status, connectivity, public_ip, up in rows]
+
+    def node_uptime_series(self, since, until=None):
+        """
+        Hourly uptime fraction per node from the rollups: {node: [(hour start, fraction up)]}.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT node, hour, up_seconds, observed_seconds FROM node_hourly "
+                                "WHERE hour >= ? AND hour < ? AND observed_seconds > 0 ORDER BY hour",
+                                (int(since) // HOUR * HOUR, time.time() if until is None else until)).fetchall()
+        finally:
+            conn.close()
+        series = {}
+        for node, hour, up_seconds, observed_seconds in rows:
+            series.setdefault(node, []).append((hour, up_seconds / observed_seconds))
+        return dict(sorted(series.items(), key=lambda item: node_sort_key(item[0])))
+
+    def fleet_healthy_series(self, since, until=None, resolution="hour"):
+        """
+        Average number of healthy and observed nodes per minute or hour: [(bucket start, healthy, observed)].
+        """
+        table, width = ("fleet_minutely", MINUTE) if resolution == "minute" else ("fleet_hourly", HOUR)
+        column = "minute" if resolution == "minute" else "hour"
+        conn = self._connect()
+        try:
+            rows = conn.execute(f"SELECT {column}, up_seconds, observed_seconds FROM {table} "
+                                f"WHERE {column} >= ? AND {column} < ? ORDER BY {column}",
+                                (int(since) // width * width, time.time() if until is None else until)).fetchall()
+        finally:
+            conn.close()
+        return [(bucket, up_seconds / width, observed_seconds / width) for bucket, up_seconds, observed_seconds in rows]
@@ -0,0 +1,238 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import csv
+import io
+import json
+import threading
+import time
+from pathlib import Path
+
+from ovpn_catalog import OvpnCatalog
+from server_selection import default_region
+from vpn_logging import get_logger
+
+log = get_logger("node_index")
+
+# CSV column -> field name in API responses
+COLUMNS = {
+    "Node Name": "name",
+    "Personal IP": "personal_ip",
+    "VPN File": "vpn_file",
+    "Public IP": "public_ip",
+    "VPN_TYPE": "vpn_type",
+    "Status": "status",
+    "Connectivity": "connectivity",
+    "Container ID": "container_id",
+    "Open Port": "open_port",
+    "Proxy Info": "proxy_info",
+    "SOCKS5 Port": "socks5_port",
+    "Last Updated": "updated_at",  # Epoch seconds
+}
+INTEGER_FIELDS = ("open_port", "socks5_port")
+FLOAT_FIELDS = ("updated_at",)
+FILTER_FIELDS = ("status", "connectivity", "vpn_type", "region")  # Fields with a secondary index
+HEALTHY_STATUS = "running"
+HEALTHY_CONNECTIVITY = "connected"
+MAX_CACHED_RESPONSES = 256  # Rendered responses kept per generation
+
+
+def node_sort_key(name):
+    try:
+        return (0, int(name.rsplit("_", 1)[-1]), name)
+    except ValueError:
+        return (1, 0, name)
+
+
+def with_ages(records, now=None):
+    """
+    Copies of the records with `age_seconds` computed from `updated_at` at read time.
+    """
+    now = time.time() if now is None else now
+    return [dict(record, age_seconds=round(now - record["updated_at"], 1) if record.get("updated_at") else None)
+            for record in records]
+
+
+def record_from_row(header, row, region_of):
+    """
+    Build an API record from one CSV row. Ports become integers, missing values None.
+    """
+    record = {}
+    for column, value in zip(header, row):
+        field = COLUMNS.get(column)
+        if field is None:
+            continue
+        value = value.strip()
+        if value in ("", "N/A", "NaN"):
+            value = None
+        elif field in INTEGER_FIELDS or field in FLOAT_FIELDS:
+            try:
+                value = int(float(value)) if field in INTEGER_FIELDS else float(value)
+            except ValueError:
+                value = None
+        record[field] = value
+    record["region"] = region_of(record.get("vpn_file"))
+    return record
+
+
+class NodeIndex:
+    """
+    In-memory table of every node with secondary indexes on status, connectivity, VPN type
+    and region, so filtered queries are set intersections instead of CSV scans.
+
+    apply_rows() diffs a fresh copy of the table against the index and only touches rows that
+    changed. Every change bumps `generation`; each node also remembers the generation it last
+    changed in, which the API uses as its ETag. Rendered responses are cached until the next
+    change; they hold `updated_at` but no ages, so a cached or 304'd body never goes stale.
+    """
+
+    def __init__(self, catalog=None):
+        self.lock = threading.Lock()
+        self.catalog = catalog
+        self.nodes = {}  # name -> record
+        self.revisions = {}  # name -> generation the node last changed in
+        self.indexes = {field: {} for field in FILTER_FIELDS}  # field -> lowercased value -> set of names
+        self.generation = 0
+        self.pick_cursor = 0
+        self.cache = {}  # (kind, args) -> JSON bytes, valid for the current generation
+        self.regions = {}  # VPN file -> region
+        self.shards = {}  # name -> shard the node was last applied from (None for the single CSV)
+
+    def _region_of(self, vpn_file):
+        if not vpn_file:
+            return None
+        region = self.regions.get(vpn_file)
+        if region is None:
+            if self.catalog is None:
+                self.catalog = OvpnCatalog()
+            location = self.catalog.location_of(vpn_file) or Path(vpn_file).stem.replace("-tcp", "").replace("-udp", "")
+            region = self.regions[vpn_file] = default_region(location)
+        return region
+
+    def _unindex(self, name, record):
+        for field in FILTER_FIELDS:
+            value = record.get(field)
+            if value is not None:
+                names = self.indexes[field].get(value.lower())
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del self.indexes[field][value.lower()]
+
+    def _index(self, name, record):
+        for field in FILTER_FIELDS:
+            value = record.get(field)
+            if value is not None:
+                self.indexes[field].setdefault(value.lower(), set()).add(name)
+
+    def _changed(self):
+        self.generation += 1
+        self.cache.clear()
+
+    def upsert(self, record):
+        """
+        Insert or replace one node. Returns True if anything changed.
+        """
+        name = record["name"]
+        with self.lock:
+            old = self.nodes.get(name)
+            if old == record:
+                return False
+            if old is not None:
+                self._unindex(name, old)
+            self.nodes[name] = record
+            self._index(name, record)
+            self._changed()
+            self.revisions[name] = self.generation
+            return True
+
+    def remove(self, name):
+        with self.lock:
+            old = self.nodes.pop(name, None)
+            if old is None:
+                return False
+            self._unindex(name, old)
+            self.revisions.pop(name, None)
+            self.shards.pop(name, None)
+            self._changed()
+            return True
+
+    def apply_rows(self, rows, shard=None):
+        """
+        Bring the index in line with a full table (header row first), or with one shard of a
+        sharded store (sharded_store.py), in which case only nodes last seen in that shard are
+        removed. Returns the number of nodes changed.
+        """
+        if not rows and shard is None:
+            return 0
+        header, changed, seen = rows[0] if rows else [], 0, set()
+        for row in rows[1:]:
+            if not row or not row[0].strip():
+                continue
+            record = record_from_row(header, row, self._region_of)
+            seen.add(record["name"])
+            changed += self.upsert(record)
+            self.shards[record["name"]] = shard
+        for name in [name for name in self.nodes if self.shards.get(name) == shard and name not in seen]:
+            changed += self.remove(name)
+        return changed
+
+    def apply_csv_text(self, text):
+        return self.apply_rows(list(csv.reader(io.StringIO(text))))
+
+    def etag(self, name=None):
+        """
+        Weak ETag for the whole table, or for one node when `name` is given (None if unknown).
+        """
+        if name is None:
+            return f'W/"{self.generation}"'
+        revision = self.revisions.get(name)
+        return f'W/"{name}-{revision}"' if revision is not None else None
+
+    def get(self, name):
+        return self.nodes.get(name)
+
+    def query(self, **filters):
+        """
+        Records matching every given filter (case-insensitive), in node order.
+        """
+        with self.lock:
+            selected = None
+            for field, value in filters.items():
+                if value is None:
+                    continue
+                names = self.indexes[field].get(str(value).lower(), set())
+                selected = set(names) if selected is None else selected & names
+                if not selected:
+                    return []
+            names = self.nodes.keys() if selected is None else selected
+            return [self.nodes[name] for name in sorted(names, key=node_sort_key)]
+
+    def healthy(self, vpn_type=None, region=None):
+        return self.query(status=HEALTHY_STATUS, connectivity=HEALTHY_CONNECTIVITY, vpn_type=vpn_type, region=region)
+
+    def pick(self, count, vpn_type=None, region=None):
+        """
+        Up to `count` healthy nodes, rotating through the healthy set across calls to spread load.
+        """
+        candidates = self.healthy(vpn_type=vpn_type, region=region)
+        if not candidates or count <= 0:
+            return []
+        with self.lock:
+            start = self.pick_cursor % len(candidates)
+            self.pick_cursor = start + min(count, len(candidates))
+        return (candidates[start:] + candidates[:start])[:count]
+
+    def render(self, kind, args, build):
+        """
+        Return the JSON body for a query, built at most once per generation.
+        `build()` returns the response object.
+        """
+        key = (kind, args)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        generation = self.generation
+        body = json.dumps(build(), separators=(",", ":")).encode()
+        with self.lock:
+            if generation == self.generation and (key in self.cache or len(self.cache) < MAX_CACHED_RESPONSES):
+                self.cache[key] = body
+        return body
@@ -0,0 +1,261 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import http.client
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+from tracing import tracer
+from vpn_logging import get_logger
+
+log = get_logger("node_reports")
+
+# Nodes POST their status report to an HTTP endpoint on a unix socket. The socket's directory is
+# bind-mounted into every node, so reports never touch a shared or network filesystem.
+REPORTS_DIR = Path("./node_reports")
+REPORT_SOCKET = REPORTS_DIR / "ingest.sock"
+CONTAINER_REPORTS_DIR = "/run/vpn_reports"  # Where nodes see REPORTS_DIR (start_vpn.sh posts to ingest.sock in it)
+
+# Labels of a report, as sent by start_vpn.sh. "Node" is the container's short ID, "Name" its container name.
+REPORT_FIELDS = ("Node", "Name", "VPN File", "VPN_TYPE", "Public IP", "Proxy Info")
+MAX_REPORT_BYTES = 4096
+MAX_WAIT = 30  # Longest a GET may wait for a report that has not arrived yet
+CLIENT_TIMEOUT = 5  # Seconds added to a GET's wait before the client gives up
+
+
+def normalize_report(report):
+    """
+    Keep the known labels of a posted report as stripped strings. Raises ValueError for malformed reports.
+    """
+    if not isinstance(report, dict):
+        raise ValueError("report must be a JSON object")
+    cleaned = {label: str(report[label]).strip() for label in REPORT_FIELDS if report.get(label) is not None}
+    if not cleaned.get("Node"):
+        raise ValueError("report has no Node")
+    return cleaned
+
+
+class ReportInbox:
+    """
+    Latest status report of every node, keyed by short container ID.
+    put() replaces a node's report, bumps its revision and calls every subscriber; wait_for()
+    blocks until a node has reported, so nothing needs to poll for reports.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.reports = {}  # container id -> report
+        self.revisions = {}  # container id -> revision of its current report
+        self.revision = 0
+        self.subscribers = []
+        self.server = None
+
+    def subscribe(self, callback):
+        """
+        Register a callback(container_id, report) invoked after every report.
+        """
+        self.subscribers.append(callback)
+
+    def put(self, report):
+        report = normalize_report(report)
+        container_id = report["Node"][:12]
+        with self.condition:
+            self.revision += 1
+            self.reports[container_id] = report
+            self.revisions[container_id] = self.revision
+            self.condition.notify_all()
+        tracer.event("report_received", report.get("Name") or container_id, container_id=container_id,
+                     public_ip=report.get("Public IP"))
+        for callback in self.subscribers:
+            try:
+                callback(container_id, report)
+            except Exception as e:
+                log.exception("Report subscriber failed for %s: %s", container_id, e)
+        return container_id
+
+    def get(self, container_id):
+        return self.reports.get(container_id[:12])
+
+    def revision_of(self, container_id):
+        """
+        Revision of the node's current report (0 if it has none); changes whenever the node reports.
+        """
+        return self.revisions.get(container_id[:12], 0)
+
+    def wait_for(self, container_id, timeout):
+        """
+        The node's report, waiting up to `timeout` seconds for it to arrive. None if it did not.
+        """
+        container_id = container_id[:12]
+        with self.condition:
+            self.condition.wait_for(lambda: container_id in self.reports, timeout)
+            return self.reports.get(container_id)
+
+    def discard(self, container_id):
+        """
+        Forget a node's report, e.g. before restarting it so the next report is a fresh one.
+        """
+        with self.condition:
+            self.reports.pop(container_id[:12], None)
+            self.revisions.pop(container_id[:12], None)
+
+    def clear(self):
+        with self.condition:
+            self.reports.clear()
+            self.revisions.clear()
+
+    def serve(self, path=REPORT_SOCKET, stop_event=None):
+        """
+        Accept reports on the unix socket at `path` until `stop_event` is set.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.unlink(missing_ok=True)  # Left behind by a previous run
+        self.server = ReportServer(str(path), ReportHandler)
+        self.server.inbox = self
+        self.server.timeout = 1
+        os.chmod(path, 0o666)
+        log.info("Report ingest listening on unix:%s", path)
+        try:
+            while stop_event is None or not stop_event.is_set():
+                self.server.handle_request()
+        finally:
+            self.server.server_close()
+            path.unlink(missing_ok=True)
+
+    def start(self, path=REPORT_SOCKET, stop_event=None):
+        thread = threading.Thread(target=self.serve, args=(path, stop_event), name="report-ingest", daemon=True)
+        thread.start()
+        deadline = time.time() + CLIENT_TIMEOUT
+        while self.server is None and thread.is_alive() and time.time() < deadline:
+            time.sleep(0.01)  # Callers start containers right away; the socket must exist first
+        return thread
+
+
+class ReportServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ReportHandler(BaseHTTPRequestHandler):
+    """
+    POST /reports               store a report (JSON object with REPORT_FIELDS)
+    GET /reports/<id>?wait=<s>  a node's report, waiting up to `s` seconds for it
+    """
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status, body=None):
+        payload = json.dumps(body, separators=(",", ":")).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/reports":
+            return self._reply(404, {"error": "not found"})
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REPORT_BYTES:
+            return self._reply(413, {"error": "report too large"})
+        try:
+            container_id = self.server.inbox.put(json.loads(self.rfile.read(length)))
+        except ValueError as e:
+            log.error("Rejected node report: %s", e)
+            return self._reply(400, {"error": str(e)})
+        self._reply(200, {"node": container_id})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        prefix = "/reports/"
+        if not url.path.startswith(prefix) or len(url.path) == len(prefix):
+            return self._reply(404, {"error": "not found"})
+        container_id = url.path[len(prefix):]
+        try:
+            wait = min(float(parse_qs(url.query).get("wait", ["0"])[0]), MAX_WAIT)
+        except ValueError:
+            return self._reply(400, {"error": "wait must be a number"})
+        inbox = self.server.inbox
+        report = inbox.wait_for(container_id, wait) if wait > 0 else inbox.get(container_id)
+        if report is None:
+            return self._reply(404, {"error": f"no report for {container_id}"})
+        self._reply(200, report)
+
+    def log_message(self, format, *args):
+        pass  # Unix socket peers have no address, and every request would otherwise print a line
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=CLIENT_TIMEOUT):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = str(path)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ReportClient:
+    """
+    Reads reports from the inbox served by another process (manage_vpns) through its socket.
+    Same get()/wait_for()/put() interface as ReportInbox.
+    """
+
+    def __init__(self, path=REPORT_SOCKET):
+        self.path = Path(path)
+
+    def _request(self, method, url, body=None, timeout=CLIENT_TIMEOUT):
+        conn = UnixHTTPConnection(self.path, timeout=timeout)
+        try:
+            payload = json.dumps(body).encode() if body is not None else None
+            conn.request(method, url, body=payload, headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            data = response.read()
+            return response.status, json.loads(data) if data else None
+        finally:
+            conn.close()
+
+    def get(self, container_id):
+        return self.wait_for(container_id, 0)
+
+    def wait_for(self, container_id, timeout):
+        wait = min(max(0, timeout), MAX_WAIT)
+        try:
+            status, report = self._request("GET", f"/reports/{container_id[:12]}?wait={wait}", timeout=wait + CLIENT_TIMEOUT)
+        except OSError as e:
+            log.error("Report ingest at %s unreachable: %s", self.path, e)
+            time.sleep(wait)  # Keep the caller's pacing
+            return None
+        return report if status == 200 else None
+
+    def put(self, report):
+        status, body = self._request("POST", "/reports", report)
+        if status != 200:
+            raise ValueError(body.get("error") if isinstance(body, dict) else f"ingest returned {status}")
+        return body["node"]
+
+
+def inbox_is_served(path=REPORT_SOCKET):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+            return True
+        except OSError:
+            return False
+
+
+def open_reports(path=REPORT_SOCKET):
+    """
+    A client for the inbox another process already serves at `path`, or a new inbox served
+    from this process when nobody is listening (e.g. build_vpn_nodes.py run on its own).
+    """
+    if inbox_is_served(path):
+        return ReportClient(path)
+    inbox = ReportInbox()
+    inbox.start(path)
+    return inbox
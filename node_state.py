@@ -0,0 +1,179 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from vpn_logging import get_logger
+
+log = get_logger("node_state")
+
+# Node state file shared with the dashboard and WebSocket server
+STATE_FILE = Path("./node_state.json")
+
+# Traffic counters are kept in fixed-width time buckets
+BUCKET_SECONDS = 10
+TRAFFIC_RETENTION_BUCKETS = 360  # Keep one hour of 10 second buckets per node
+TRAFFIC_WINDOW = 60  # Window used for the requests/sec and error rate summary
+
+
+class NodeStateStore:
+    """
+    In-memory store of per-node state, keyed by node name.
+    Writers update fields or traffic counters, subscribers are called on every change,
+    and the whole store is persisted to STATE_FILE for readers in other processes.
+    """
+
+    def __init__(self, path=STATE_FILE):
+        self.path = Path(path)
+        self.lock = threading.Lock()
+        self.nodes = {}
+        self.aliases = {}  # name a container reports and logs under -> node name
+        self.generation = 0
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        """
+        Register a callback(node_name, node_state) invoked after every change.
+        """
+        self.subscribers.append(callback)
+
+    def _notify(self, node_name, node_state):
+        for callback in self.subscribers:
+            try:
+                callback(node_name, node_state)
+            except Exception as e:
+                log.exception("Node state subscriber failed for %s: %s", node_name, e)
+
+    def _node(self, node_name):
+        node = self.nodes.get(node_name)
+        if node is None:
+            node = {"traffic": {}}
+            self.nodes[node_name] = node
+        return node
+
+    def alias(self, name, node_name):
+        """
+        File everything written for `name` under `node_name` from now on, e.g. a promoted spare that
+        still reports and logs under its spare name. State already kept under `name` moves too.
+        """
+        with self.lock:
+            self.aliases[name] = node_name
+            moved = self.nodes.pop(name, None)
+        if moved is not None:
+            traffic = moved.pop("traffic", {})
+            moved.pop("updated_at", None)
+            if moved:
+                self.update(node_name, **moved)
+            self.record_traffic(node_name, traffic)
+
+    def update(self, node_name, **fields):
+        """
+        Set one or more fields for a node.
+        """
+        node_name = self.aliases.get(node_name, node_name)
+        with self.lock:
+            node = self._node(node_name)
+            node.update(fields)
+            node["updated_at"] = time.time()
+            self.generation += 1
+            node_state = dict(node)
+        self._notify(node_name, node_state)
+
+    def record_traffic(self, node_name, buckets):
+        """
+        Merge per-bucket traffic counters {bucket_start: [requests, bytes, errors]} into a node.
+        Buckets older than TRAFFIC_RETENTION_BUCKETS are dropped.
+        """
+        if not buckets:
+            return
+        node_name = self.aliases.get(node_name, node_name)
+        with self.lock:
+            node = self._node(node_name)
+            traffic = node["traffic"]
+            for bucket_start, (requests, nbytes, errors) in buckets.items():
+                key = str(bucket_start)
+                counters = traffic.get(key)
+                if counters is None:
+                    traffic[key] = [requests, nbytes, errors]
+                else:
+                    counters[0] += requests
+                    counters[1] += nbytes
+                    counters[2] += errors
+
+            if len(traffic) > TRAFFIC_RETENTION_BUCKETS:
+                for key in sorted(traffic, key=int)[:-TRAFFIC_RETENTION_BUCKETS]:
+                    del traffic[key]
+
+            node["updated_at"] = time.time()
+            self.generation += 1
+            node_state = dict(node)
+        self._notify(node_name, node_state)
+
+    def get(self, node_name):
+        with self.lock:
+            node = self.nodes.get(node_name)
+            return dict(node) if node is not None else None
+
+    def snapshot(self):
+        """
+        Return a copy of every node's state.
+        """
+        with self.lock:
+            return {node_name: dict(node) for node_name, node in self.nodes.items()}
+
+    def save(self):
+        """
+        Persist the store atomically so readers never see a partially written file.
+        """
+        with self.lock:
+            payload = json.dumps({"generation": self.generation, "nodes": self.nodes})
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(payload)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log.exception("Failed to save node state to %s: %s", self.path, e)
+
+    @classmethod
+    def load(cls, path=STATE_FILE):
+        """
+        Load a store previously written by save(). Returns an empty store if the file is missing.
+        """
+        store = cls(path)
+        try:
+            with open(store.path) as f:
+                data = json.load(f)
+            store.nodes = data.get("nodes", {})
+            store.generation = data.get("generation", 0)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.error("Failed to load node state from %s: %s", store.path, e)
+        return store
+
+
+def traffic_summary(node_state, window=TRAFFIC_WINDOW, now=None):
+    """
+    Summarise a node's traffic buckets over the last `window` seconds.
+    Returns requests/sec, bytes and error rate (0-1) for that window. The bucket that straddles
+    the start of the window counts only for the share of it inside the window.
+    """
+    now = time.time() if now is None else now
+    cutoff = now - window
+    requests = nbytes = errors = 0
+    for bucket_start, counters in node_state.get("traffic", {}).items():
+        bucket_end = int(bucket_start) + BUCKET_SECONDS
+        if bucket_end > cutoff:
+            share = min(1.0, (bucket_end - cutoff) / BUCKET_SECONDS)
+            requests += counters[0] * share
+            nbytes += counters[1] * share
+            errors += counters[2] * share
+
+    return {
+        "requests_per_sec": requests / window if window else 0.0,
+        "bytes": round(nbytes),
+        "error_rate": errors / requests if requests else 0.0,
+    }
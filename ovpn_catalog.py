@@ -0,0 +1,219 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from vpn_logging import get_logger
+
+log = get_logger("ovpn_catalog")
+
+# Provider configs live in OVPN_ROOT/<proto>/*.ovpn
+OVPN_ROOT = Path("./ovpn_files")
+INDEX_FILE = Path("./ovpn_index.json")
+PROTOCOLS = ("udp", "tcp")
+
+# Directives copied from each .ovpn file into its catalog entry
+DIRECTIVES = ("proto", "cipher", "auth")
+
+
+def parse_ovpn(data):
+    """
+    Extract the remote endpoint, proto, cipher and auth from the text of an .ovpn file.
+    Inline blocks (<ca>, <crl-verify>, ...) are skipped without being split into directives.
+    """
+    info = {"remote_host": None, "remote_port": None, "proto": None, "cipher": None, "auth": None}
+    in_block = False
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        if line.startswith("<"):
+            in_block = not line.startswith("</")
+            continue
+        if in_block:
+            continue
+
+        fields = line.split()
+        directive = fields[0]
+        if directive == "remote" and info["remote_host"] is None and len(fields) >= 2:
+            info["remote_host"] = fields[1]
+            if len(fields) >= 3 and fields[2].isdigit():
+                info["remote_port"] = int(fields[2])
+            if len(fields) >= 4:
+                info["proto"] = fields[3]
+        elif directive in DIRECTIVES and len(fields) >= 2 and info[directive] is None:
+            info[directive] = fields[1].lower()
+    return info
+
+
+def location_from_filename(stem, proto, cipher):
+    """
+    Derive the server location from a provider file name, e.g.
+    us_california-aes-128-cbc-udp-ip -> us_california. The proto and cipher come from the
+    parsed file, so UDP and TCP variants of the same server map to the same location.
+    """
+    location = stem
+    for suffix in ("-ip", f"-{proto}", f"-{cipher}" if cipher else None):
+        if suffix and location.endswith(suffix):
+            location = location[:-len(suffix)]
+    return location
+
+
+class OvpnCatalog:
+    """
+    Index of every provider .ovpn file, parsed once and cached in INDEX_FILE keyed by content hash.
+    Files are only re-read when their size or mtime changes. Lookups by file name and location are dict lookups.
+    """
+
+    def __init__(self, root=OVPN_ROOT, index_file=INDEX_FILE):
+        self.root = Path(root)
+        self.index_file = Path(index_file)
+        self.by_hash = {}  # sha1 -> parsed entry
+        self.files = {}  # relative path -> {"sha1", "size", "mtime"}
+        self.by_name = {}  # file name -> entry
+        self.locations = {}  # location -> {proto: entry}
+        self._load_index()
+        self._rebuild_lookups()
+
+    def _load_index(self):
+        try:
+            with open(self.index_file) as f:
+                data = json.load(f)
+            self.by_hash = data.get("entries", {})
+            self.files = data.get("files", {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.error("Failed to load .ovpn index %s: %s", self.index_file, e)
+
+    def _save_index(self):
+        tmp_path = self.index_file.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"entries": self.by_hash, "files": self.files}, f)
+            os.replace(tmp_path, self.index_file)
+        except Exception as e:
+            log.exception("Failed to save .ovpn index %s: %s", self.index_file, e)
+
+    def _parse_file(self, path, proto_dir, sha1, data):
+        info = parse_ovpn(data.decode("utf-8", errors="replace"))
+        proto = (info["proto"] or proto_dir).replace("-client", "")
+        if proto.startswith("tcp"):
+            proto = "tcp"
+        return {
+            "file": path.name,
+            "path": str(path),
+            "sha1": sha1,
+            "proto": proto,
+            "remote_host": info["remote_host"],
+            "remote_port": info["remote_port"],
+            "cipher": info["cipher"],
+            "auth": info["auth"],
+            "location": location_from_filename(path.stem, proto, info["cipher"]),
+        }
+
+    def _rebuild_lookups(self):
+        self.by_name = {}
+        self.locations = {}
+        for rel_path, meta in self.files.items():
+            entry = self.by_hash.get(meta["sha1"])
+            if entry is None:
+                continue
+            # Identical files share a parsed entry, so per-file fields are filled in here
+            path = Path(rel_path)
+            entry = dict(entry, path=rel_path, file=path.name,
+                         location=location_from_filename(path.stem, entry["proto"], entry["cipher"]))
+            self.by_name[entry["file"]] = entry
+            self.locations.setdefault(entry["location"], {})[entry["proto"]] = entry
+
+    def refresh(self):
+        """
+        Scan the provider directories once, re-parsing only new or modified files.
+        Returns {"added": [...], "changed": [...], "removed": [...]} file paths.
+        """
+        changes = {"added": [], "changed": [], "removed": []}
+        seen = set()
+        dirty = False
+
+        for proto_dir in PROTOCOLS:
+            directory = self.root / proto_dir
+            if not directory.is_dir():
+                continue
+            with os.scandir(directory) as it:
+                for dir_entry in it:
+                    if not dir_entry.name.endswith(".ovpn"):
+                        continue
+                    rel_path = str(directory / dir_entry.name)
+                    seen.add(rel_path)
+                    stat_result = dir_entry.stat()
+                    meta = self.files.get(rel_path)
+                    if meta and meta["size"] == stat_result.st_size and meta["mtime"] == stat_result.st_mtime:
+                        continue  # Unchanged since the last scan
+
+                    with open(dir_entry.path, "rb") as f:
+                        data = f.read()
+                    sha1 = hashlib.sha1(data).hexdigest()
+                    if sha1 not in self.by_hash:
+                        self.by_hash[sha1] = self._parse_file(Path(rel_path), proto_dir, sha1, data)
+
+                    if meta is None:
+                        changes["added"].append(rel_path)
+                    elif meta["sha1"] != sha1:
+                        changes["changed"].append(rel_path)
+                    self.files[rel_path] = {"sha1": sha1, "size": stat_result.st_size, "mtime": stat_result.st_mtime}
+                    dirty = True
+
+        for rel_path in list(self.files):
+            if rel_path not in seen:
+                del self.files[rel_path]
+                changes["removed"].append(rel_path)
+
+        if dirty or changes["removed"] or not self.index_file.exists():
+            # Drop parsed entries no file refers to any more
+            live_hashes = {meta["sha1"] for meta in self.files.values()}
+            self.by_hash = {sha1: entry for sha1, entry in self.by_hash.items() if sha1 in live_hashes}
+            self._save_index()
+            log.debug(".ovpn catalog updated: %s added, %s changed, %s removed.",
+                      len(changes['added']), len(changes['changed']), len(changes['removed']))
+
+        self._rebuild_lookups()
+        return changes
+
+    def get(self, file_name):
+        """
+        Return the entry for an .ovpn file name (with or without directory), or None.
+        """
+        return self.by_name.get(Path(file_name).name)
+
+    def location_of(self, file_name):
+        entry = self.get(file_name)
+        return entry["location"] if entry else None
+
+    def entries(self, proto=None):
+        return [entry for entry in self.by_name.values() if proto is None or entry["proto"] == proto]
+
+    def count(self, proto):
+        return sum(1 for entry in self.by_name.values() if entry["proto"] == proto)
+
+    def by_location(self, location):
+        """
+        Return {proto: entry} for one server location.
+        """
+        return self.locations.get(location, {})
+
+    def pairs(self):
+        """
+        Return (udp entry, tcp entry) for every location that has both, sorted by location.
+        """
+        return [(protos["udp"], protos["tcp"]) for location, protos in sorted(self.locations.items())
+                if "udp" in protos and "tcp" in protos]
+
+
+def load_catalog(root=OVPN_ROOT, index_file=INDEX_FILE):
+    """
+    Return an up-to-date catalog.
+    """
+    catalog = OvpnCatalog(root, index_file)
+    catalog.refresh()
+    return catalog
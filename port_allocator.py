@@ -0,0 +1,255 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import fcntl
+import ipaddress
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from port_inspector import bound_ports
+from vpn_logging import get_logger
+
+log = get_logger("port_allocator")
+
+# Lease table shared by build_vpn_nodes, generateyml, manage_vpns and update_vpn_info
+LEASES_FILE = Path("./port_leases.json")
+
+# Start of each port range. Slot n of the fleet gets START + n in every range.
+UDP_START_PORT = 8080  # OpenVPN UDP/TCP port published for each node
+SOCKS5_START_PORT = 9090  # Squid/SOCKS5 proxy port
+SSH_START_PORT = 2221  # SSH port published by docker-compose
+NODE_SUBNET = "172.18.0.0/16"  # Subnet of the compose vpn_network
+FIRST_HOST_OFFSET = 2  # .0 is the network address and .1 the bridge gateway
+
+NODE_PREFIX = "vpn_node_"
+
+
+def shard_network(shard, subnet=NODE_SUBNET):
+    """
+    Each compose shard gets its own network the size of the base subnet, stacked after it
+    (172.18.0.0/16, 172.19.0.0/16, ...), so shards can be started independently.
+    """
+    base = ipaddress.ip_network(subnet)
+    return ipaddress.ip_network((int(base.network_address) + shard * base.num_addresses, base.prefixlen))
+
+
+def preferred_slot(node_name):
+    """
+    vpn_node_<n> always prefers slot n-1, so every component derives the same ports
+    even before the lease table exists.
+    """
+    if node_name.startswith(NODE_PREFIX):
+        try:
+            number = int(node_name[len(NODE_PREFIX):])
+            if number >= 1:
+                return number - 1
+        except ValueError:
+            pass
+    return None
+
+
+class PortAllocator:
+    """
+    Hands out conflict-free (open port, SOCKS5 port, SSH port, IP) tuples per node name and
+    persists them in a lease table. Lookups and leases are dictionary operations.
+    """
+
+    def __init__(self, path=LEASES_FILE, udp_start=UDP_START_PORT, socks5_start=SOCKS5_START_PORT,
+                 ssh_start=SSH_START_PORT, subnet=NODE_SUBNET):
+        self.path = Path(path)
+        self.lock_path = self.path.with_suffix(".lock")
+        self.udp_start = udp_start
+        self.socks5_start = socks5_start
+        self.ssh_start = ssh_start
+        self.network = ipaddress.ip_network(subnet)
+
+        # Each range must fit below the next one, and every slot needs an address in the subnet
+        self.max_slots = min(
+            socks5_start - udp_start if socks5_start > udp_start else 65536 - udp_start,
+            udp_start - ssh_start if udp_start > ssh_start else 65536 - ssh_start,
+            65536 - socks5_start,
+            self.network.num_addresses - FIRST_HOST_OFFSET - 1,
+        )
+
+        self.leases = {}  # node name -> lease
+        self.slots = {}  # slot -> node name
+        self.top_slot = self.max_slots - 1  # Highest slot that might be free for names without a preferred slot
+        self.load()
+
+    def _make_lease(self, node_name, slot, shard=0):
+        return {
+            "node_name": node_name,
+            "slot": slot,
+            "open_port": self.udp_start + slot,
+            "socks5_port": self.socks5_start + slot,
+            "ssh_port": self.ssh_start + slot,
+            "shard": shard,
+            "ip": str(shard_network(shard, self.network).network_address + FIRST_HOST_OFFSET + slot),
+        }
+
+    def load(self):
+        """
+        Reload the lease table from disk.
+        """
+        self.leases = {}
+        self.slots = {}
+        self.top_slot = self.max_slots - 1
+        try:
+            with open(self.path) as f:
+                leases = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            log.error("Failed to load port leases from %s: %s", self.path, e)
+            return
+
+        for node_name, lease in leases.items():
+            slot = lease["slot"]
+            # Recompute from the slot so a change of start ports takes effect
+            self.leases[node_name] = self._make_lease(node_name, slot, lease.get("shard", 0))
+            self.slots[slot] = node_name
+
+    def save(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.leases, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            log.exception("Failed to save port leases to %s: %s", self.path, e)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Serialize lease changes between processes and pick up leases written by others.
+        """
+        with open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self.load()
+                yield
+                self.save()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _free_slot(self, node_name):
+        slot = preferred_slot(node_name)
+        if slot is not None and slot < self.max_slots and slot not in self.slots:
+            return slot
+
+        # Other names are packed down from the top of the range so they never take
+        # the slot a vpn_node_<n> would prefer
+        while self.top_slot in self.slots:
+            self.top_slot -= 1
+        if self.top_slot < 0:
+            raise RuntimeError(f"Port allocator exhausted: all {self.max_slots} slots are leased.")
+        return self.top_slot
+
+    def _lease_locked(self, node_name, shard=None):
+        lease = self.leases.get(node_name)
+        if lease is None:
+            slot = self._free_slot(node_name)
+            lease = self._make_lease(node_name, slot, shard or 0)
+            self.leases[node_name] = lease
+            self.slots[slot] = node_name
+            log.debug("Leased slot %s to %s: open port %s, SOCKS5 port %s, IP %s.", slot, node_name,
+                      lease['open_port'], lease['socks5_port'], lease['ip'])
+        elif shard is not None and lease["shard"] != shard:
+            # Same slot and ports; only the address moves to the new shard's network
+            lease = self._make_lease(node_name, lease["slot"], shard)
+            self.leases[node_name] = lease
+            log.debug("Moved %s to shard %s: IP %s.", node_name, shard, lease['ip'])
+        return lease
+
+    def lease(self, node_name):
+        """
+        Return the lease for a node, creating one if it has none yet.
+        """
+        lease = self.leases.get(node_name)
+        if lease is not None:
+            return lease
+
+        with self._locked():
+            return self._lease_locked(node_name)
+
+    def lease_many(self, node_names, shard=None):
+        """
+        Lease several nodes under a single lock and a single write of the lease table.
+        With `shard`, the leases' addresses are taken from that compose shard's network (see shard_network).
+        """
+        node_names = list(node_names)
+        if all(node_name in self.leases and shard in (None, self.leases[node_name]["shard"]) for node_name in node_names):
+            return [self.leases[node_name] for node_name in node_names]
+
+        with self._locked():
+            return [self._lease_locked(node_name, shard) for node_name in node_names]
+
+    def lookup(self, node_name):
+        """
+        Return the existing lease for a node, or None.
+        """
+        return self.leases.get(node_name)
+
+    def rename(self, old_name, new_name):
+        """
+        Move `old_name`'s slot (ports and IP) to `new_name`, releasing any slot `new_name` held,
+        e.g. when a promoted spare's ports come to back a node. Returns the lease of `new_name`.
+        """
+        with self._locked():
+            lease = self._lease_locked(old_name)
+            previous = self.leases.pop(new_name, None)
+            if previous is not None:
+                self.slots.pop(previous["slot"], None)
+                self.top_slot = max(self.top_slot, previous["slot"])
+            del self.leases[old_name]
+            self.leases[new_name] = self._make_lease(new_name, lease["slot"], lease["shard"])
+            self.slots[lease["slot"]] = new_name
+            log.debug("Moved slot %s from %s to %s.", lease['slot'], old_name, new_name)
+            return self.leases[new_name]
+
+    def release(self, node_name):
+        with self._locked():
+            lease = self.leases.pop(node_name, None)
+            if lease is not None:
+                self.slots.pop(lease["slot"], None)
+                self.top_slot = max(self.top_slot, lease["slot"])
+
+    def release_all(self):
+        with self._locked():
+            self.leases = {}
+            self.slots = {}
+            self.top_slot = self.max_slots - 1
+
+    def leased_ports(self):
+        """
+        Return every open and SOCKS5 port currently leased.
+        """
+        ports = set()
+        for lease in self.leases.values():
+            ports.add(lease["open_port"])
+            ports.add(lease["socks5_port"])
+        return ports
+
+    def fleet_port_ranges(self):
+        """
+        Return the host port ranges the fleet can occupy.
+        """
+        return [
+            range(self.udp_start, self.udp_start + self.max_slots),
+            range(self.socks5_start, self.socks5_start + self.max_slots),
+            range(self.ssh_start, self.ssh_start + self.max_slots),
+        ]
+
+    def conflicts(self, bound=None):
+        """
+        Return {node name: [ports]} for leases whose open or SOCKS5 port is already bound on this host.
+        Pass `bound` to reuse an earlier port_inspector.bound_ports() scan.
+        """
+        if bound is None:
+            bound = bound_ports(self.fleet_port_ranges())
+        conflicts = {}
+        for node_name, lease in self.leases.items():
+            ports = [port for port in (lease["open_port"], lease["socks5_port"]) if port in bound]
+            if ports:
+                conflicts[node_name] = ports
+        return conflicts
@@ -0,0 +1,104 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import asyncio
+import threading
+
+from vpn_logging import get_logger
+
+log = get_logger("port_forward")
+
+FORWARD_HOST = "0.0.0.0"  # Same interfaces Docker publishes node ports on
+TARGET_HOST = "127.0.0.1"  # Containers behind a forward publish their ports on this host
+BIND_ATTEMPTS = 20  # A port freed by a removed container can take a moment to become bindable
+BIND_RETRY_DELAY = 0.25  # Seconds between bind attempts
+BUFFER_SIZE = 64 * 1024
+
+
+class PortForwarder:
+    """
+    TCP relays that keep a node's published port stable while the container behind it changes.
+    Each forward listens on a fixed port and relays new connections to its current target port;
+    re-pointing a forward leaves connections that are already relayed on the old target.
+    """
+
+    def __init__(self, host=FORWARD_HOST, target_host=TARGET_HOST):
+        self.host = host
+        self.target_host = target_host
+        self.targets = {}  # listen port -> target port
+        self.servers = {}  # listen port -> asyncio server
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def _run(self, coro):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="port-forward", daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def forward(self, listen_port, target_port):
+        """
+        Relay `listen_port` to `target_port`, starting the listener if the port is not forwarded yet.
+        Raises OSError if the port cannot be bound.
+        """
+        previous = self.targets.get(listen_port)
+        self.targets[listen_port] = target_port
+        if listen_port not in self.servers:
+            try:
+                self._run(self._listen(listen_port))
+            except OSError:
+                self.targets.pop(listen_port, None)
+                raise
+        log.info("Port %s now forwards to %s:%s (was %s).", listen_port, self.target_host, target_port, previous)
+
+    def stop(self, listen_port):
+        self.targets.pop(listen_port, None)
+        server = self.servers.pop(listen_port, None)
+        if server is not None:
+            self._run(self._close(server))
+            log.info("Stopped forwarding port %s.", listen_port)
+
+    def close(self):
+        for listen_port in list(self.servers):
+            self.stop(listen_port)
+
+    async def _listen(self, listen_port):
+        for attempt in range(BIND_ATTEMPTS):
+            try:
+                self.servers[listen_port] = await asyncio.start_server(
+                    lambda reader, writer: self._relay(listen_port, reader, writer), self.host, listen_port)
+                return
+            except OSError as e:
+                if attempt == BIND_ATTEMPTS - 1:
+                    raise
+                log.debug("Port %s is not free yet (%s); retrying.", listen_port, e)
+                await asyncio.sleep(BIND_RETRY_DELAY)
+
+    async def _close(self, server):
+        server.close()
+        await server.wait_closed()
+
+    async def _relay(self, listen_port, reader, writer):
+        target_port = self.targets.get(listen_port)
+        try:
+            target_reader, target_writer = await asyncio.open_connection(self.target_host, target_port)
+        except OSError as e:
+            log.debug("Port %s could not reach %s:%s: %s", listen_port, self.target_host, target_port, e)
+            writer.close()
+            return
+        await asyncio.gather(self._pipe(reader, target_writer, writer), self._pipe(target_reader, writer, target_writer))
+        writer.close()
+        target_writer.close()
+
+    async def _pipe(self, reader, writer, peer):
+        """
+        Copy one direction of a connection, passing on a half-close; an error closes both sides.
+        """
+        try:
+            while data := await reader.read(BUFFER_SIZE):
+                writer.write(data)
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except OSError:
+            writer.close()
+            peer.close()
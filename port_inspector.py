@@ -0,0 +1,58 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+from pathlib import Path
+
+# Socket tables exposed by the kernel for the current network namespace
+PROC_NET_TABLES = ("tcp", "tcp6", "udp", "udp6")
+TCP_LISTEN = "0A"  # st column value for a listening TCP socket
+
+
+def _parse_table(path, proto, port_ranges, ports):
+    """
+    Add every bound local port in one /proc/net table to `ports` ({port: set of protocols}).
+    TCP sockets only count while listening; any UDP socket holds its port.
+    """
+    try:
+        with open(path) as f:
+            next(f, None)  # Skip the header line
+            for line in f:
+                fields = line.split(None, 4)
+                if len(fields) < 4:
+                    continue
+                if proto.startswith("tcp") and fields[3] != TCP_LISTEN:
+                    continue
+
+                port = int(fields[1].rpartition(":")[2], 16)
+                if port_ranges is not None and not any(port in port_range for port_range in port_ranges):
+                    continue
+                ports.setdefault(port, set()).add(proto)
+    except FileNotFoundError:
+        pass  # e.g. IPv6 disabled
+
+
+def bound_ports(port_ranges=None, proc_net=Path("/proc/net")):
+    """
+    Read the TCP/UDP socket tables once and return {port: {"tcp", "udp6", ...}} for every bound port.
+    Pass `port_ranges` (e.g. [range(8080, 9090)]) to keep only the ports of interest.
+    """
+    ports = {}
+    for proto in PROC_NET_TABLES:
+        _parse_table(Path(proc_net) / proto, proto, port_ranges, ports)
+    return ports
+
+
+def ports_in_use(ports, bound=None):
+    """
+    Return the subset of `ports` that is currently bound. Pass `bound` to reuse an earlier scan.
+    """
+    if bound is None:
+        bound = bound_ports()
+    return sorted(port for port in ports if port in bound)
+
+
+def is_listening(port, bound=None, proto="tcp"):
+    """
+    True if `port` has a listening socket of the given protocol family (tcp or udp, v4 or v6).
+    """
+    if bound is None:
+        bound = bound_ports()
+    return any(bound_proto.startswith(proto) for bound_proto in bound.get(port, ()))
@@ -0,0 +1,205 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import json
+import math
+import os
+import re
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from vpn_logging import get_logger
+
+log = get_logger("server_selection")
+
+# Cached latency score per server location
+SCORES_FILE = Path("./latency_scores.json")
+
+PROBE_TIMEOUT = 2.0  # Seconds before a probe counts as failed
+FAILURE_PENALTY = 2 * PROBE_TIMEOUT  # Latency recorded for a failed probe
+SCORE_HALF_LIFE = 3600  # Seconds for an old measurement to lose half its weight
+SCORE_TTL = 900  # Re-measure locations whose score is older than this
+PROBE_WORKERS = 32
+MAX_PER_REGION = None  # Region diversity cap; None ranks purely by latency
+
+# US census regions, keyed on site names without separators (provider cities map to their state)
+US_REGIONS = {
+    "us_northeast": "connecticut maine massachusetts newhampshire newjersey newyork newyorkcity pennsylvania "
+                    "rhodeisland vermont",
+    "us_midwest": "chicago illinois indiana iowa kansas michigan minnesota missouri nebraska northdakota ohio "
+                  "southdakota wisconsin",
+    "us_south": "alabama arkansas atlanta baltimore delaware florida georgia houston kentucky louisiana maryland "
+                "mississippi northcarolina oklahoma southcarolina tennessee texas virginia washingtondc westvirginia "
+                "wilmington",
+    "us_west": "alaska arizona california colorado denver hawaii honolulu idaho lasvegas montana nevada newmexico "
+               "oregon saltlakecity seattle siliconvalley southwest utah washington wyoming",
+}
+US_SITE_REGIONS = {site: region for region, sites in US_REGIONS.items() for site in sites.split()}
+
+
+def tcp_connect_probe(host, port, timeout=PROBE_TIMEOUT):
+    """
+    Time a TCP connect to the endpoint. Returns seconds, or None on failure.
+    """
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return time.perf_counter() - start
+    except OSError:
+        return None
+
+
+# OpenVPN P_CONTROL_HARD_RESET_CLIENT_V2 (opcode 7, key id 0), a session id, an empty ack array
+# and packet id 0. A server without tls-auth answers with P_CONTROL_HARD_RESET_SERVER_V2.
+OPENVPN_HARD_RESET = bytes([7 << 3]) + os.urandom(8) + b"\x00" + b"\x00\x00\x00\x00"
+
+
+def openvpn_udp_probe(host, port, timeout=PROBE_TIMEOUT):
+    """
+    Time the first round trip of an OpenVPN UDP handshake. Returns seconds, or None on failure.
+    """
+    start = time.perf_counter()
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(timeout)
+            sock.sendto(OPENVPN_HARD_RESET, (host, port))
+            sock.recvfrom(1024)
+            return time.perf_counter() - start
+    except OSError:
+        return None
+
+
+def default_probe(entry, timeout=PROBE_TIMEOUT):
+    """
+    Probe a catalog entry's remote endpoint with the handshake that matches its protocol.
+    """
+    if not entry.get("remote_host") or not entry.get("remote_port"):
+        return None
+    if entry["proto"] == "udp":
+        return openvpn_udp_probe(entry["remote_host"], entry["remote_port"], timeout)
+    return tcp_connect_probe(entry["remote_host"], entry["remote_port"], timeout)
+
+
+def default_region(location):
+    """
+    Map a location to its region: the country code from the name's prefix (uk_london -> uk),
+    and for the US its census region (us_alabama-pf -> us_south). US sites that name no place
+    (us3, us-streaming) fall back to "us".
+    """
+    match = re.match(r"([a-z]{2})\d*(?:[-_](.*))?$", location.lower())
+    if match is None:
+        return location
+    country, site = match.groups()
+    if country != "us":
+        return country
+    site = re.sub(r"(-pf|-\d+)+$", "", site or "")
+    return US_SITE_REGIONS.get(re.sub(r"[-_]", "", site), country)
+
+
+class ServerSelector:
+    """
+    Rank .ovpn catalog locations by measured handshake latency.
+    Scores are exponentially weighted across measurements, older measurements lose weight with
+    SCORE_HALF_LIFE, and the cache is persisted so re-runs only probe stale locations.
+    `probe(entry, timeout)` is pluggable, so tests can point it at local stand-in endpoints.
+    """
+
+    def __init__(self, catalog, probe=default_probe, scores_file=SCORES_FILE, half_life=SCORE_HALF_LIFE,
+                 ttl=SCORE_TTL, timeout=PROBE_TIMEOUT, region=default_region):
+        self.catalog = catalog
+        self.probe = probe
+        self.scores_file = Path(scores_file)
+        self.half_life = half_life
+        self.ttl = ttl
+        self.timeout = timeout
+        self.region = region
+        self.scores = self._load_scores()
+
+    def _load_scores(self):
+        try:
+            with open(self.scores_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            log.error("Failed to load latency scores from %s: %s", self.scores_file, e)
+            return {}
+
+    def _save_scores(self):
+        tmp_path = self.scores_file.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.scores, f, indent=2)
+            os.replace(tmp_path, self.scores_file)
+        except Exception as e:
+            log.exception("Failed to save latency scores: %s", e)
+
+    def record(self, location, latency, now=None):
+        """
+        Fold one measurement (seconds, or None for a failure) into a location's score.
+        The previous score's weight decays with its age.
+        """
+        now = time.time() if now is None else now
+        latency = FAILURE_PENALTY if latency is None else latency
+        previous = self.scores.get(location)
+        if previous is None:
+            score = latency
+        else:
+            weight = 0.5 * math.pow(0.5, (now - previous["updated"]) / self.half_life)
+            score = weight * previous["score"] + (1 - weight) * latency
+        self.scores[location] = {"score": score, "updated": now, "last": latency}
+
+    def _probe_pair(self, pair):
+        # The location's latency is the slower of its UDP and TCP endpoints
+        results = [self.probe(entry, self.timeout) for entry in pair]
+        if any(result is None for result in results):
+            return None
+        return max(results)
+
+    def measure(self, max_workers=PROBE_WORKERS, force=False):
+        """
+        Probe every location whose score is missing or older than the TTL, in parallel.
+        """
+        now = time.time()
+        stale = [pair for pair in self.catalog.pairs()
+                 if force or now - self.scores.get(pair[0]["location"], {}).get("updated", 0) > self.ttl]
+        if not stale:
+            return
+
+        log.info("Measuring handshake latency for %s server locations...", len(stale))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for pair, latency in zip(stale, executor.map(self._probe_pair, stale)):
+                self.record(pair[0]["location"], latency)
+        self._save_scores()
+
+    def score(self, location):
+        entry = self.scores.get(location)
+        return entry["score"] if entry else FAILURE_PENALTY
+
+    def rank_pairs(self, max_per_region=None):
+        """
+        Return (udp entry, tcp entry) pairs sorted fastest first.
+        With max_per_region, at most that many locations are taken from each region before
+        the remaining locations are appended, still in latency order.
+        """
+        ranked = sorted(self.catalog.pairs(), key=lambda pair: (self.score(pair[0]["location"]), pair[0]["location"]))
+        if not max_per_region:
+            return ranked
+
+        selected, deferred, per_region = [], [], {}
+        for pair in ranked:
+            region = self.region(pair[0]["location"])
+            if per_region.get(region, 0) < max_per_region:
+                per_region[region] = per_region.get(region, 0) + 1
+                selected.append(pair)
+            else:
+                deferred.append(pair)
+        return selected + deferred
+
+    def select_pairs(self, count, max_per_region=None, measure=True):
+        """
+        Return the `count` fastest pairs, measuring stale locations first.
+        """
+        if measure:
+            self.measure()
+        return self.rank_pairs(max_per_region)[:count]
@@ -0,0 +1,245 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import csv
+import fcntl
+import hashlib
+import io
+import os
+import re
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from node_index import node_sort_key
+from ovpn_catalog import OvpnCatalog
+from server_selection import default_region
+from vpn_logging import get_logger
+
+log = get_logger("sharded_store")
+
+# Optional replacement for the single vpn_nodes_info.csv on large fleets. Node rows are split
+# into CSV segments (same headers) by a shard key, so a write rewrites one shard, not the fleet.
+# Off by default; set VPN_CSV_SHARDS for manage_vpns.py, websocket_server.py and the dashboard alike.
+SHARD_ENV = "VPN_CSV_SHARDS"  # "vpn_type", "region", "hash" or "hash:<number of shards>"
+SHARD_DIR = Path("./vpn_nodes_shards")
+SHARD_KEYS = ("vpn_type", "region", "hash")
+DEFAULT_HASH_SHARDS = 16
+SEGMENT_SUFFIX = ".csv"  # <shard>.csv: the shard's rows
+GENERATION_SUFFIX = ".gen"  # <shard>.gen: bumped after every rewrite of the segment
+LOCK_SUFFIX = ".lock"  # <shard>.lock: serializes writers of the shard across processes
+UNKNOWN_SHARD = "other"  # Nodes without a VPN type or file
+
+
+def shard_name(value):
+    """
+    File-safe shard name for a key value ("UDP" -> "udp", "us_east" -> "us_east").
+    """
+    name = re.sub(r"[^a-z0-9_-]+", "_", str(value).strip().lower()).strip("_")
+    return name or UNKNOWN_SHARD
+
+
+def write_atomic(path, text):
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "w", newline="") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def rows_to_csv(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue()
+
+
+class ShardedStore:
+    """
+    Node rows partitioned into CSV segments by `shard_by` ("vpn_type", "region" or "hash").
+    Writers lock one shard, rewrite its segment and bump its generation, so a write costs the
+    shard's size. Readers merge the segments, or subscribe to shards and poll() for new generations.
+    """
+
+    def __init__(self, shard_by="vpn_type", directory=SHARD_DIR, hash_shards=DEFAULT_HASH_SHARDS, headers=None):
+        if shard_by not in SHARD_KEYS:
+            raise ValueError(f"Unknown shard key {shard_by!r}; expected one of {', '.join(SHARD_KEYS)}.")
+        self.shard_by = shard_by
+        self.directory = Path(directory)
+        self.hash_shards = hash_shards
+        self.headers = list(headers) if headers else None
+        self.lock = threading.Lock()
+        self.subscribers = []  # (callback, set of shards or None for all)
+        self.seen = {}  # shard -> generation last delivered to subscribers
+        self.catalog = None
+        self.regions = {}  # VPN file -> region
+
+    @classmethod
+    def from_env(cls, headers=None, directory=SHARD_DIR):
+        """
+        The store VPN_CSV_SHARDS asks for, or None when the fleet uses the single CSV.
+        """
+        value = os.environ.get(SHARD_ENV, "").strip().lower()
+        if value in ("", "0", "off", "no"):
+            return None
+        shard_by, _, count = value.partition(":")
+        return cls(shard_by, directory, int(count) if count else DEFAULT_HASH_SHARDS, headers)
+
+    def _region_of(self, vpn_file):
+        region = self.regions.get(vpn_file)
+        if region is None:
+            if self.catalog is None:
+                self.catalog = OvpnCatalog()
+            location = self.catalog.location_of(vpn_file) or Path(vpn_file).stem.replace("-tcp", "").replace("-udp", "")
+            region = self.regions[vpn_file] = default_region(location)
+        return region
+
+    def shard_for(self, node_name, vpn_type=None, vpn_file=None):
+        if self.shard_by == "hash":
+            digest = hashlib.sha1(node_name.encode()).digest()
+            return f"hash-{int.from_bytes(digest[:4], 'big') % self.hash_shards:02d}"
+        value = vpn_type if self.shard_by == "vpn_type" else vpn_file
+        if not value or value == "N/A":
+            return UNKNOWN_SHARD
+        return shard_name(value if self.shard_by == "vpn_type" else self._region_of(value))
+
+    def _path(self, shard, suffix):
+        return self.directory / f"{shard}{suffix}"
+
+    @contextmanager
+    def _locked(self, shard):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self._path(shard, LOCK_SUFFIX), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def shards(self):
+        if not self.directory.exists():
+            return []
+        return sorted(path.stem for path in self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def generation(self, shard):
+        try:
+            return int(self._path(shard, GENERATION_SUFFIX).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def read_shard(self, shard):
+        """
+        The shard's rows, header first ([] if the shard does not exist).
+        """
+        try:
+            with open(self._path(shard, SEGMENT_SUFFIX), newline="") as f:
+                return list(csv.reader(f))
+        except FileNotFoundError:
+            return []
+
+    def _write(self, shard, rows):
+        write_atomic(self._path(shard, SEGMENT_SUFFIX), rows_to_csv(rows))
+        generation = self.generation(shard) + 1
+        write_atomic(self._path(shard, GENERATION_SUFFIX), str(generation))
+        return generation
+
+    def modify(self, shard, mutate):
+        """
+        Replace the shard's rows with `mutate(rows)` under the shard's lock. A missing shard starts
+        as just the header. Returns the new generation, or None if `mutate` returned None.
+        """
+        with self._locked(shard):
+            rows = self.read_shard(shard) or ([list(self.headers)] if self.headers else [])
+            rows = mutate(rows)
+            if rows is None:
+                return None
+            return self._write(shard, rows)
+
+    def update_node(self, node_name, mutate, vpn_type=None, vpn_file=None):
+        """
+        Apply `mutate(rows)` to the node's shard and return (shard, generation). A node new to its
+        shard (first write, or a new VPN file moved it to another region) is dropped from any other shard.
+        """
+        shard = self.shard_for(node_name, vpn_type, vpn_file)
+        new_to_shard = []
+
+        def apply(rows):
+            new_to_shard.append(not any(row and row[0] == node_name for row in rows[1:]))
+            return mutate(rows)
+
+        generation = self.modify(shard, apply)
+        if new_to_shard and new_to_shard[0] and self.shard_by != "hash":  # Hash shards never move
+            self.remove([node_name], exclude=shard)
+        return shard, generation
+
+    def remove(self, node_names, exclude=None):
+        """
+        Drop the named nodes from every shard holding them. Returns the names removed.
+        """
+        node_names, removed = set(node_names), set()
+        for shard in self.shards():
+            if shard == exclude:
+                continue
+            with self._locked(shard):
+                rows = self.read_shard(shard)
+                kept = rows[:1] + [row for row in rows[1:] if not row or row[0] not in node_names]
+                if len(kept) != len(rows):
+                    removed.update(row[0] for row in rows[1:] if row and row[0] in node_names)
+                    self._write(shard, kept)
+                    log.debug("Removed %s node(s) from shard %s.", len(rows) - len(kept), shard)
+        return removed
+
+    def clear(self):
+        """
+        Delete every shard, e.g. when the fleet is rebuilt from scratch. Generation files stay,
+        so a shard written again continues from its old generation and no subscriber misses it.
+        """
+        if not self.directory.exists():
+            return
+        for path in self.directory.glob(f"*{SEGMENT_SUFFIX}"):
+            path.unlink(missing_ok=True)
+        log.debug("Cleared the node shards in %s.", self.directory)
+
+    def merged_rows(self):
+        """
+        Read view over every shard: one header, then every node in node order.
+        """
+        header, body = list(self.headers) if self.headers else None, []
+        for shard in self.shards():
+            rows = self.read_shard(shard)
+            if rows:
+                header = header or rows[0]
+                body.extend(row for row in rows[1:] if row)
+        if header is None:
+            return []
+        body.sort(key=lambda row: node_sort_key(row[0]))
+        return [header] + body
+
+    def merged_csv_text(self):
+        return rows_to_csv(self.merged_rows())
+
+    def subscribe(self, callback, shards=None):
+        """
+        Call callback(shard, generation, rows) whenever poll() finds a new generation of one of
+        `shards` (every shard by default). A deleted shard is delivered once with generation 0 and no rows.
+        """
+        self.subscribers.append((callback, set(shards) if shards is not None else None))
+
+    def poll(self):
+        """
+        Deliver every shard whose generation changed since the last poll. Returns the shards delivered.
+        """
+        with self.lock:
+            current = {shard: self.generation(shard) for shard in self.shards()}
+            changed = [shard for shard, generation in current.items() if self.seen.get(shard) != generation]
+            changed += [shard for shard in self.seen if shard not in current]
+            for shard in changed:
+                generation = current.get(shard, 0)
+                wanted = [callback for callback, shards in self.subscribers if shards is None or shard in shards]
+                rows = self.read_shard(shard) if wanted and shard in current else []
+                for callback in wanted:
+                    try:
+                        callback(shard, generation, rows)
+                    except Exception as e:
+                        log.exception("Shard subscriber failed for %s: %s", shard, e)
+                if shard in current:
+                    self.seen[shard] = generation
+                else:
+                    del self.seen[shard]
+            return changed
@@ -0,0 +1,202 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+
+from fleet_teardown import list_fleet_containers
+from port_forward import PortForwarder
+from server_selection import MAX_PER_REGION
+from vpn_logging import get_logger
+
+log = get_logger("spare_pool")
+
+SPARE_COUNT = 0  # Warm spares kept connected; 0 disables the pool
+SPARE_PREFIX = "vpn_spare_"
+RETIRED_PREFIX = "vpn_retired_"  # Failed nodes become vpn_retired_<time>_<id>, outside the vpn_node_ filter, until removed
+BACKING_PREFIX = "vpn_backing_"  # Lease of the ports a promoted spare still publishes behind the node's forward
+SPARE_WORKERS = 2  # Spares built at the same time, kept low so spares never compete with the fleet
+
+
+def fleet_vpn_files(client):
+    """
+    Return the .ovpn file names used by every fleet container, read from their VPN_FILE variables.
+    """
+    files = set()
+    for container in list_fleet_containers(client):
+        for variable in container.attrs.get("Config", {}).get("Env") or []:
+            if variable.startswith("VPN_FILE="):
+                files.add(variable.split("=", 1)[1])
+    return files
+
+
+class SparePool:
+    """
+    Pool of pre-connected spare containers, each on a different .ovpn server.
+    When a node fails, a ready spare takes over its name and CSV row at once, the failed container
+    is removed and a new spare is built in the background.
+
+    Docker cannot change the published ports of a running container, so the node keeps its lease
+    and its SOCKS5 port is forwarded (port_forward.py) to the port the promoted spare publishes;
+    that port stays leased as vpn_backing_<node> until the node is promoted again.
+
+    `launch(spare_name, entry, lease)` starts a container for a catalog entry and returns it (or None).
+    `ready(container)` returns (ready, reason).
+    """
+
+    def __init__(self, client, allocator, selector, launch, ready, size=SPARE_COUNT, in_use=None, forwarder=None,
+                 max_per_region=MAX_PER_REGION):
+        self.client = client
+        self.allocator = allocator
+        self.selector = selector
+        self.launch = launch
+        self.ready = ready
+        self.size = size
+        self.in_use = in_use or (lambda: fleet_vpn_files(client))
+        self.forwarder = forwarder or PortForwarder()
+        self.max_per_region = max_per_region
+        self.executor = ThreadPoolExecutor(max_workers=SPARE_WORKERS, thread_name_prefix="spare")
+        self.lock = threading.Lock()
+        self.spares = {}  # spare name -> {"name", "entry", "container", "state"}
+        # Spare names are never reused: a promoted container keeps reporting and logging under its spare name
+        self.serials = itertools.count(1)
+        self.failed_files = set()  # Servers whose spare never came up
+
+    def _candidates(self):
+        """
+        Yield catalog entries not used by the fleet or another spare, fastest location first,
+        skipping locations that already have a spare.
+        """
+        used_files = set(self.in_use()) | self.failed_files
+        used_locations = {spare["entry"]["location"] for spare in self.spares.values()}
+        for pair in self.selector.rank_pairs(self.max_per_region):
+            for entry in pair:
+                if entry["file"] in used_files or entry["location"] in used_locations:
+                    continue
+                used_locations.add(entry["location"])
+                yield entry
+                break
+
+    def _new_name(self):
+        return f"{SPARE_PREFIX}{next(self.serials)}"
+
+    def fill(self):
+        """
+        Start building spares until the pool is back to its configured size.
+        """
+        if self.size <= 0:
+            return
+        with self.lock:
+            needed = self.size - len(self.spares)
+            candidates = self._candidates()
+            for _ in range(max(0, needed)):
+                entry = next(candidates, None)
+                if entry is None:
+                    log.warning("No unused .ovpn servers left for spare nodes.")
+                    break
+                spare_name = self._new_name()
+                self.spares[spare_name] = {"name": spare_name, "entry": entry, "container": None, "state": "starting"}
+                self.executor.submit(self._start, spare_name)
+
+    def _start(self, spare_name):
+        spare = self.spares[spare_name]
+        entry = spare["entry"]
+        log.info("Starting spare %s on %s...", spare_name, entry['file'])
+        try:
+            lease = self.allocator.lease(spare_name)
+            container = self.launch(spare_name, entry, lease)
+            ok, reason = self.ready(container) if container is not None else (False, "launch failed")
+        except Exception as e:
+            log.exception("Spare %s failed to start: %s", spare_name, e)
+            container, ok, reason = None, False, str(e)
+
+        with self.lock:
+            if ok:
+                spare.update(container=container, state="ready")
+                log.info("Spare %s is ready (%s).", spare_name, reason)
+                return
+            log.warning("Spare %s on %s did not come up: %s.", spare_name, entry['file'], reason)
+            self.failed_files.add(entry["file"])
+            del self.spares[spare_name]
+        self.allocator.release(spare_name)
+        if container is not None:
+            self._remove(container)
+
+    def ready_count(self):
+        with self.lock:
+            return sum(1 for spare in self.spares.values() if spare["state"] == "ready")
+
+    def _take(self, proto):
+        """
+        Remove and return a ready spare, preferring one with the failed node's protocol.
+        """
+        with self.lock:
+            ready = [spare for spare in self.spares.values() if spare["state"] == "ready"]
+            ready.sort(key=lambda spare: spare["entry"]["proto"] != proto)
+            for spare in ready:
+                del self.spares[spare["name"]]
+                return spare
+        return None
+
+    def promote(self, node_name, failed_container_id, proto=None):
+        """
+        Move a ready spare into `node_name`'s slot. Returns {"container", "entry", "lease", "spare_name"}
+        for the promoted spare, or None if no spare was available. The lease is the node's own: its ports
+        do not change. The container still reports and logs as `spare_name`.
+        """
+        while True:
+            spare = self._take(proto)
+            if spare is None:
+                return None
+            container = spare["container"]
+            try:
+                container.reload()
+                if container.status == "running":
+                    break
+            except docker.errors.NotFound:
+                pass
+            log.warning("Spare %s is no longer running; discarding it.", spare['name'])
+            self.allocator.release(spare["name"])
+            self.executor.submit(self._remove, container)
+
+        start_time = time.time()
+        failed_container = None
+        try:
+            failed_container = self.client.containers.get(failed_container_id)
+            failed_container.rename(f"{RETIRED_PREFIX}{int(start_time)}_{failed_container_id[:12]}")
+        except docker.errors.NotFound:
+            pass
+        except Exception as e:
+            log.error("Failed to retire %s (ID: %s): %s", node_name, failed_container_id, e)
+
+        container.rename(node_name)
+
+        # The failed container holds the node's ports (or a previous spare's) until it is removed
+        if failed_container is not None:
+            self._remove(failed_container)
+        lease = self.allocator.lease(node_name)
+        backing = self.allocator.rename(spare["name"], f"{BACKING_PREFIX}{node_name}")  # Frees the previous backing ports
+        try:
+            self.forwarder.forward(lease["socks5_port"], backing["socks5_port"])
+        except OSError as e:
+            log.error("Failed to forward SOCKS5 port %s of %s to %s: %s", lease['socks5_port'], node_name,
+                      backing['socks5_port'], e, extra={"node": node_name})
+        log.info("Promoted %s (%s) to %s in %.2f seconds; SOCKS5 port %s now reaches it.", spare['name'], spare['entry']['file'],
+                 node_name, time.time() - start_time, lease['socks5_port'], extra={"node": node_name})
+
+        self.executor.submit(self.fill)  # Build a replacement spare in the background
+        return {"container": container, "entry": spare["entry"], "lease": lease, "spare_name": spare["name"]}
+
+    def _remove(self, container):
+        try:
+            container.remove(v=True, force=True)
+        except docker.errors.NotFound:
+            pass
+        except Exception as e:
+            log.error("Failed to remove container %s: %s", container.name, e)
+
+    def shutdown(self, wait=False):
+        self.executor.shutdown(wait=wait)
+        self.forwarder.close()
@@ -0,0 +1,214 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import json
+import os
+import threading
+from pathlib import Path
+
+from node_state import BUCKET_SECONDS
+from vpn_logging import get_logger
+
+log = get_logger("squid_logs")
+
+# Each container bind-mounts SQUID_LOGS_DIR/<node name> to /var/log/squid
+SQUID_LOGS_DIR = Path.cwd() / 'squid_logs'
+ACCESS_LOG_NAME = "access.log"
+OFFSETS_FILE = SQUID_LOGS_DIR / "offsets.json"
+
+READ_CHUNK_SIZE = 256 * 1024  # Read access logs in large batches instead of line by line
+LOG_POLL_INTERVAL = 5  # Seconds between ingestion passes
+
+
+def parse_access_log_lines(data, counters, bucket_seconds=BUCKET_SECONDS):
+    """
+    Parse complete lines of a Squid native access.log and add them to `counters`,
+    a dict of {bucket_start: [requests, bytes, errors]}.
+
+    Native format: time elapsed client code/status bytes method URL user hierarchy type
+    Only the first five fields are split out, the rest of the line is never touched.
+    """
+    for line in data.split(b"\n"):
+        fields = line.split(None, 5)
+        if len(fields) < 5:
+            continue
+        try:
+            bucket_start = int(float(fields[0])) // bucket_seconds * bucket_seconds
+            nbytes = int(fields[4])
+            status = int(fields[3].rpartition(b"/")[2])
+        except ValueError:
+            continue
+
+        bucket = counters.get(bucket_start)
+        if bucket is None:
+            bucket = counters[bucket_start] = [0, 0, 0]
+        bucket[0] += 1
+        bucket[1] += nbytes
+        if status == 0 or status >= 400:
+            bucket[2] += 1
+    return counters
+
+
+class AccessLogTailer:
+    """
+    Incrementally read one node's access.log, remembering the byte offset and inode
+    so rotated or truncated logs are followed without re-reading or losing lines.
+    """
+
+    def __init__(self, node_name, path, inode=None, offset=0):
+        self.node_name = node_name
+        self.path = Path(path)
+        self.file = None
+        self.inode = inode
+        self.offset = offset
+        self.partial = b""
+
+    def _open(self, stat_result):
+        self.file = open(self.path, "rb")
+        # Resume from a saved offset only if it still refers to the same file
+        if self.inode == stat_result.st_ino and self.offset <= stat_result.st_size:
+            self.file.seek(self.offset)
+        else:
+            self.offset = 0
+        self.inode = stat_result.st_ino
+        self.partial = b""
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _read_available(self, counters):
+        while True:
+            chunk = self.file.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            self.offset += len(chunk)
+            end = chunk.rfind(b"\n")
+            if end == -1:
+                self.partial += chunk
+                continue
+            parse_access_log_lines(self.partial + chunk[:end], counters)
+            self.partial = chunk[end + 1:]
+
+    def poll(self):
+        """
+        Read every complete line written since the last poll.
+        Returns {bucket_start: [requests, bytes, errors]} for the new lines.
+        """
+        counters = {}
+        try:
+            stat_result = os.stat(self.path)
+        except FileNotFoundError:
+            return counters
+
+        if self.file is not None:
+            if stat_result.st_ino != self.inode:
+                # Log was rotated: finish the old file, then follow the new one from the start
+                self._read_available(counters)
+                self._close()
+                self.inode = None
+            elif stat_result.st_size < self.offset:
+                log.debug("%s was truncated. Reading from the start.", self.path)
+                self.file.seek(0)
+                self.offset = 0
+                self.partial = b""
+
+        if self.file is None:
+            self._open(stat_result)
+
+        self._read_available(counters)
+        return counters
+
+    def resume_offset(self):
+        """
+        Offset just past the last complete line read, where a restarted tailer should resume.
+        """
+        return self.offset - len(self.partial)
+
+    def close(self):
+        self._close()
+
+
+class SquidLogIngestor:
+    """
+    Tail every node's access.log under SQUID_LOGS_DIR and feed the counters into a NodeStateStore.
+    Offsets are persisted to OFFSETS_FILE so a restart does not count old lines twice.
+    """
+
+    def __init__(self, store, logs_dir=SQUID_LOGS_DIR, offsets_file=OFFSETS_FILE):
+        self.store = store
+        self.logs_dir = Path(logs_dir)
+        self.offsets_file = Path(offsets_file)
+        self.tailers = {}
+        self.saved_offsets = self._load_offsets()
+        self.stop_event = threading.Event()
+
+    def _load_offsets(self):
+        try:
+            with open(self.offsets_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            log.error("Failed to load access log offsets from %s: %s", self.offsets_file, e)
+            return {}
+
+    def _save_offsets(self):
+        offsets = {node_name: [tailer.inode, tailer.resume_offset()] for node_name, tailer in self.tailers.items()}
+        tmp_path = self.offsets_file.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(offsets, f)
+            os.replace(tmp_path, self.offsets_file)
+        except Exception as e:
+            log.error("Failed to save access log offsets: %s", e)
+
+    def discover(self):
+        """
+        Start tailing any node log directory that appeared since the last pass.
+        """
+        if not self.logs_dir.exists():
+            return
+        for node_dir in self.logs_dir.iterdir():
+            if node_dir.is_dir() and node_dir.name not in self.tailers:
+                inode, offset = self.saved_offsets.get(node_dir.name, (None, 0))
+                self.tailers[node_dir.name] = AccessLogTailer(node_dir.name, node_dir / ACCESS_LOG_NAME, inode, offset)
+                log.debug("Tailing Squid access log for %s.", node_dir.name)
+
+    def poll(self):
+        """
+        Run one ingestion pass over every node and persist the results.
+        """
+        self.discover()
+        changed = False
+        for node_name, tailer in self.tailers.items():
+            try:
+                counters = tailer.poll()
+            except Exception as e:
+                log.exception("Failed to read access log for %s: %s", node_name, e)
+                continue
+            if counters:
+                self.store.record_traffic(node_name, counters)
+                changed = True
+
+        if changed:
+            self.store.save()
+            self._save_offsets()
+
+    def run(self, interval=LOG_POLL_INTERVAL):
+        while not self.stop_event.is_set():
+            self.poll()
+            self.stop_event.wait(interval)
+        for tailer in self.tailers.values():
+            tailer.close()
+
+
+def start_log_ingestion(store, interval=LOG_POLL_INTERVAL):
+    """
+    Start a SquidLogIngestor on a daemon thread and return it.
+    """
+    SQUID_LOGS_DIR.mkdir(exist_ok=True)
+    ingestor = SquidLogIngestor(store)
+    thread = threading.Thread(target=ingestor.run, args=(interval,), daemon=True)
+    thread.start()
+    log.info("Squid access log ingestion started on %s.", SQUID_LOGS_DIR)
+    return ingestor
@@ -91,16 +91,20 @@ cleanup() {
 find_vpn_file
 
 
-save_public_ip_file() {
+# Escape a value for a JSON string
+json_escape() {
+  printf '%s' "$1" | sed -e 's/\\/\\\\/g' -e 's/"/\\"/g'
+}
+
+post_status_report() {
   local node="$1"
   local vpn_file_name="$2"
   local public_ip="$3"
   local proxy_info="$4"
-  local output_file="$SHARED_DIR/$node-ip.txt"
 
-  # Prevent multiple writes to the file
-  if [ -f "$output_file" ]; then
-    echo "[INFO] File $output_file already exists. Skipping file write." | tee -a "$LOG_FILE"
+  # Only the first report of a run counts
+  if [ "$REPORT_SENT" = true ]; then
+    echo "[INFO] Status report already sent. Skipping." | tee -a "$LOG_FILE"
     return 0
   fi
 
@@ -110,26 +114,26 @@ save_public_ip_file() {
   # Convert VPN_TYPE to uppercase
   local vpn_type_upper=$(echo "$VPN_TYPE" | tr '[:lower:]' '[:upper:]')
 
-  # Save the file only when both VPN and Proxy setup succeeded
-  if [ "$AUTH_FAILED_DETECTED" = false ] && [ "$PROXY_STARTED" = true ]; then
-    # Append VPN_TYPE (uppercase) and proxy port information to the file content
-    echo -e "Node: $node\nVPN File: $vpn_file_name\nVPN_TYPE: $vpn_type_upper\nPublic IP: $public_ip\nProxy Info: $proxy_port" > "$output_file"
-    echo "[INFO] Public IP, VPN_TYPE, and Proxy Port written to $output_file successfully." | tee -a "$LOG_FILE"
-  else
-    echo -e "Node: $node\nVPN File: $vpn_file_name\nVPN_TYPE: $vpn_type_upper\nPublic IP: $public_ip\nProxy Info: $proxy_port" > "$output_file"
-    echo "[INFO] Public IP, VPN_TYPE, and Proxy Port written to $output_file with failure status." | tee -a "$LOG_FILE"
-  fi
+  local report="{\"Node\": \"$(json_escape "$node")\", \"Name\": \"$(json_escape "${NODE_NAME:-$node}")\", \"VPN File\": \"$(json_escape "$vpn_file_name")\", \"VPN_TYPE\": \"$vpn_type_upper\", \"Public IP\": \"$(json_escape "$public_ip")\", \"Proxy Info\": \"$proxy_port\"}"
 
-  # Force sync to ensure the file is written to disk and visible on the host system
-  sync
-  sleep 1  # A small delay to ensure the sync completes
+  # POST to the manager's report ingest over the mounted unix socket, retrying while it restarts
+  for attempt in $(seq 1 $REPORT_ATTEMPTS); do
+    if curl -sf --max-time 5 --unix-socket "$REPORT_SOCKET" -X POST -H "Content-Type: application/json" -d "$report" http://localhost/reports > /dev/null; then
+      REPORT_SENT=true
+      if [ "$AUTH_FAILED_DETECTED" = false ] && [ "$PROXY_STARTED" = true ]; then
+        echo "[INFO] Public IP, VPN_TYPE, and Proxy Port reported successfully." | tee -a "$LOG_FILE"
+      else
+        echo "[INFO] Public IP, VPN_TYPE, and Proxy Port reported with failure status." | tee -a "$LOG_FILE"
+      fi
+      return 0
+    fi
+    echo "[WARNING] Report ingest at $REPORT_SOCKET not reachable (attempt $attempt/$REPORT_ATTEMPTS)." | tee -a "$LOG_FILE"
+    sleep 1
+  done
+  echo "[ERROR] Could not send the status report." | tee -a "$LOG_FILE"
 }
 
 
-
-
-
-
 # Print start time and basic info
 echo "[INFO] Script started at $(date)" | tee -a "$LOG_FILE"
 
@@ -205,9 +209,10 @@ else
   exit 1
 fi
 
-# Set the absolute path for the shared directory on the host machine
-SHARED_DIR="/home/idontloveyou/Desktop/LinuxServer1/freedomdata/storage/docker/public_ips"
-PUBLIC_IP_FILE="$SHARED_DIR/$HOSTNAME-ip.txt"
+# Status reports go to the report ingest socket mounted from the host (see node_reports.py)
+REPORT_SOCKET=${REPORT_SOCKET:-"/run/vpn_reports/ingest.sock"}
+REPORT_ATTEMPTS=10
+REPORT_SENT=false
 VPN_FILE_NAME=$(basename "$OVPN_FILE")
 
 
@@ -250,8 +255,8 @@ tail_openvpn_log() {
       # Set AUTH_FAILED flag to true
       AUTH_FAILED_DETECTED=true
 
-      # Save public IP as "Auth Failed" and exit immediately
-      save_public_ip_file "$HOSTNAME" "$VPN_FILE_NAME" "Auth Failed" "Proxy setup failed"
+      # Report the public IP as "Auth Failed" and exit immediately
+      post_status_report "$HOSTNAME" "$VPN_FILE_NAME" "Auth Failed" "Proxy setup failed"
 
       # Kill OpenVPN process if running
       if kill -0 $OPENVPN_PID 2>/dev/null; then
@@ -278,14 +283,13 @@ tail_openvpn_log() {
 handle_vpn_failure() {
   if [ "$AUTH_FAILED_DETECTED" = true ]; then
     echo "[ERROR] OpenVPN failed due to AUTH_FAILED. Skipping further steps." | tee -a "$LOG_FILE"
-    # Save public IP as "Auth Failed" when saving to the file
-    save_public_ip_file "$HOSTNAME" "$VPN_FILE_NAME" "Auth Failed" "Proxy setup failed"
+    # Report the public IP as "Auth Failed"
+    post_status_report "$HOSTNAME" "$VPN_FILE_NAME" "Auth Failed" "Proxy setup failed"
     cleanup  # Trigger cleanup immediately to stop further processes
     exit 1  # Exit after handling failure
   else
     echo "[ERROR] OpenVPN failed to start. Check the log file for details." | tee -a "$LOG_FILE"
-    save_public_ip_file "$HOSTNAME" "$VPN_FILE_NAME" "VPN failed to start" "Proxy setup failed"
-    sync
+    post_status_report "$HOSTNAME" "$VPN_FILE_NAME" "VPN failed to start" "Proxy setup failed"
     cleanup
     exit 1
   fi
@@ -293,9 +297,6 @@ handle_vpn_failure() {
 
 
 
-# Ensure the shared directory exists
-mkdir -p "$SHARED_DIR"
-
 # Start OpenVPN and monitor the logs
 start_openvpn
 
@@ -344,7 +345,7 @@ start_proxy() {
   if kill -0 $PROXY_PID > /dev/null 2>&1; then
     echo "[INFO] Squid proxy is running on 0.0.0.0:$PROXY_PORT with PID: $PROXY_PID" | tee -a "$LOG_FILE"
     PROXY_STARTED=true
-    save_public_ip_file "$HOSTNAME" "$VPN_FILE_NAME" "$IP" "Squid proxy running on 0.0.0.0:$PROXY_PORT"
+    post_status_report "$HOSTNAME" "$VPN_FILE_NAME" "$IP" "Squid proxy running on 0.0.0.0:$PROXY_PORT"
   else
     echo "[ERROR] Failed to start the Squid proxy!" | tee -a "$LOG_FILE"
     cleanup
@@ -383,17 +384,17 @@ if [ "$AUTH_FAILED_DETECTED" = false ]; then
     # Check if the proxy setup was successful
     if [ "$PROXY_STARTED" = true ]; then
       echo "[INFO] Proxy setup successful." | tee -a "$LOG_FILE"
-      save_public_ip_file "$HOSTNAME" "$VPN_FILE_NAME" "$IP" "Proxy running on 0.0.0.0:$PROXY_PORT"
+      post_status_report "$HOSTNAME" "$VPN_FILE_NAME" "$IP" "Proxy running on 0.0.0.0:$PROXY_PORT"
     else
-      echo "[ERROR] Proxy setup failed. Saving file with failure info." | tee -a "$LOG_FILE"
-      save_public_ip_file "$HOSTNAME" "$VPN_FILE_NAME" "$IP" "Proxy setup failed"
+      echo "[ERROR] Proxy setup failed. Reporting failure info." | tee -a "$LOG_FILE"
+      post_status_report "$HOSTNAME" "$VPN_FILE_NAME" "$IP" "Proxy setup failed"
       cleanup
       exit 1
     fi
 
   else
-    echo "[ERROR] Failed to retrieve public IP after VPN setup. Saving failure info." | tee -a "$LOG_FILE"
-    save_public_ip_file "$HOSTNAME" "$VPN_FILE_NAME" "Public IP fetch failed" "Proxy setup failed"
+    echo "[ERROR] Failed to retrieve public IP after VPN setup. Reporting failure info." | tee -a "$LOG_FILE"
+    post_status_report "$HOSTNAME" "$VPN_FILE_NAME" "Public IP fetch failed" "Proxy setup failed"
     cleanup
     exit 1
   fi
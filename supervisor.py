@@ -0,0 +1,176 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from vpn_logging import get_logger
+
+log = get_logger("supervisor")
+
+# Supervisor states
+HEALTHY = "healthy"
+DEGRADED = "degraded"  # Running, but without a working tunnel/proxy
+RESTARTING = "restarting"
+BACKING_OFF = "backing-off"
+QUARANTINED = "quarantined"  # Circuit open after repeated Auth Failed; no restarts until it half-opens
+
+RESTART_WORKERS = 4  # Concurrent restarts; a flapping node holds at most one
+BACKOFF_BASE = 5  # Seconds before the first retry
+BACKOFF_MAX = 600
+AUTH_FAILURE_THRESHOLD = 2  # Consecutive Auth Failed results that open the circuit
+QUARANTINE_SECONDS = 1800  # Circuit stays open this long, doubling each time it re-opens
+QUARANTINE_MAX = 6 * 3600
+DEGRADED_RESTART_CHECKS = 3  # Consecutive degraded checks before a running node is restarted
+
+
+def backoff_delay(failures, base=BACKOFF_BASE, maximum=BACKOFF_MAX, rng=random.random):
+    """
+    Exponential backoff with jitter: half the delay is fixed, the other half random,
+    so nodes that failed together do not retry together.
+    """
+    delay = min(maximum, base * 2 ** max(0, failures - 1))
+    return delay / 2 + rng() * delay / 2
+
+
+class NodeSupervisor:
+    """
+    Per-node restart state machine: healthy, degraded, restarting, backing-off, quarantined.
+    The monitor reports what it observes with observe(); restarts run on a bounded pool and a
+    node is never restarted again while one of its restarts is in flight.
+
+    `restart(node_name, container_id)` restarts a node and returns True once it is ready.
+    `on_transition(node_name, old_state, new_state)` is called on every state change.
+    """
+
+    def __init__(self, restart, max_workers=RESTART_WORKERS, backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 auth_threshold=AUTH_FAILURE_THRESHOLD, quarantine_seconds=QUARANTINE_SECONDS,
+                 on_transition=None, clock=time.time, rng=random.random):
+        self.restart = restart
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="node-restart")
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.auth_threshold = auth_threshold
+        self.quarantine_seconds = quarantine_seconds
+        self.on_transition = on_transition
+        self.clock = clock
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.nodes = {}
+
+    def _node(self, node_name):
+        return self.nodes.setdefault(node_name, {
+            "state": HEALTHY, "failures": 0, "auth_failures": 0, "degraded_checks": 0,
+            "next_attempt": 0, "quarantines": 0, "container_id": None, "restarts": 0, "auth_attempt": None,
+        })
+
+    def _set_state(self, node_name, node, state):
+        old_state = node["state"]
+        if old_state == state:
+            return
+        node["state"] = state
+        log.info("Supervisor: %s %s -> %s.", node_name, old_state, state)
+        if self.on_transition:
+            try:
+                self.on_transition(node_name, old_state, state)
+            except Exception as e:
+                log.error("Supervisor transition callback failed for %s: %s", node_name, e)
+
+    def state(self, node_name):
+        with self.lock:
+            return self.nodes[node_name]["state"] if node_name in self.nodes else None
+
+    def is_busy(self, node_name):
+        """
+        True while a restart is in flight; the monitor should skip the node until it finishes.
+        """
+        return self.state(node_name) == RESTARTING
+
+    def snapshot(self):
+        with self.lock:
+            return {node_name: dict(node) for node_name, node in self.nodes.items()}
+
+    def observe(self, node_name, status, public_ip=None, container_id=None, attempt=None):
+        """
+        Feed one observation of a node (container status plus the public IP it reported)
+        into its state machine, scheduling a restart if one is due. Returns the new state.
+        `attempt` identifies the start the public IP was reported by (e.g. container ID and report
+        revision): an Auth Failed result counts once per attempt, and never without one (a cached result).
+        """
+        now = self.clock()
+        with self.lock:
+            node = self._node(node_name)
+            if container_id:
+                node["container_id"] = container_id
+            if node["state"] == RESTARTING:
+                return RESTARTING
+
+            if node["state"] == QUARANTINED:
+                if now < node["next_attempt"]:
+                    return QUARANTINED
+                # Half-open: the Auth Failed result on file is the one that opened the circuit, so allow one trial restart
+                public_ip = None
+
+            auth_failed = bool(public_ip) and "Auth Failed" in public_ip
+            if auth_failed:
+                if attempt is not None and attempt != node["auth_attempt"]:
+                    node["auth_attempt"] = attempt
+                    node["auth_failures"] += 1
+            elif status == "running" and public_ip:
+                node["auth_failures"] = 0
+
+            if node["auth_failures"] >= self.auth_threshold:
+                # Circuit breaker: stop logging in with credentials the provider keeps rejecting
+                node["quarantines"] += 1
+                hold = min(QUARANTINE_MAX, self.quarantine_seconds * 2 ** (node["quarantines"] - 1))
+                node["next_attempt"] = now + hold
+                node["auth_failures"] = self.auth_threshold - 1  # Half-open: one more failure re-opens it
+                log.warning("Supervisor: %s failed authentication %s times; quarantined for %.0f seconds.", node_name, self.auth_threshold, hold)
+                self._set_state(node_name, node, QUARANTINED)
+                return QUARANTINED
+
+            if status == "running" and not auth_failed:
+                if public_ip and "failed" not in public_ip.lower():
+                    node["failures"] = 0
+                    node["degraded_checks"] = 0
+                    self._set_state(node_name, node, HEALTHY)
+                    return HEALTHY
+                node["degraded_checks"] += 1
+                if node["degraded_checks"] < DEGRADED_RESTART_CHECKS:
+                    self._set_state(node_name, node, DEGRADED)
+                    return DEGRADED
+
+            # Exited, dead, auth failed or degraded for too long: restart, respecting the backoff
+            if now < node["next_attempt"]:
+                self._set_state(node_name, node, BACKING_OFF)
+                return BACKING_OFF
+
+            node["degraded_checks"] = 0
+            node["restarts"] += 1
+            self._set_state(node_name, node, RESTARTING)
+            container_id = node["container_id"]
+
+        self.executor.submit(self._run_restart, node_name, container_id)
+        return RESTARTING
+
+    def _run_restart(self, node_name, container_id):
+        try:
+            ok = self.restart(node_name, container_id)
+        except Exception as e:
+            log.exception("Supervisor: restart of %s raised: %s", node_name, e)
+            ok = False
+
+        with self.lock:
+            node = self._node(node_name)
+            if ok:
+                node["failures"] = 0
+                self._set_state(node_name, node, HEALTHY)
+            else:
+                node["failures"] += 1
+                delay = backoff_delay(node["failures"], self.backoff_base, self.backoff_max, self.rng)
+                node["next_attempt"] = self.clock() + delay
+                log.warning("Supervisor: restart of %s failed (%s in a row); next attempt in %.0f seconds.", node_name, node['failures'], delay)
+                self._set_state(node_name, node, BACKING_OFF)
+
+    def shutdown(self, wait=False):
+        self.executor.shutdown(wait=wait)
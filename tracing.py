@@ -0,0 +1,278 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from vpn_logging import get_logger
+
+log = get_logger("tracing")
+
+# Per-node lifecycle spans. Off by default: every call returns at once. Set VPN_TRACE=1 (or to a
+# directory) before starting manage_vpns.py and websocket_server.py; child processes inherit it.
+# Each process appends its spans to <dir>/<process>-<pid>.jsonl; export merges them.
+TRACE_ENV = "VPN_TRACE"
+TRACE_DIR = Path("./traces")
+TRACE_SCOPE = "vpn_fleet"
+
+# Lifecycle phases, in order. "first_*" phases are recorded once per node until the node restarts.
+PHASES = (
+    "image_build",  # client.images.build in build_vpn_nodes.py
+    "container_create",  # client.containers.run
+    "restart",  # container.restart() by the supervisor
+    "tunnel_up",  # Container start until the node's status report arrives (bringup.wait_until_ready)
+    "report_received",  # The status report reached the ingest inbox (instant)
+    "first_status_write",  # First CSV write for the node (manage_vpns.update_vpn_info)
+    "first_dashboard_push",  # First WebSocket push carrying the node's new status (websocket_server.py)
+)
+
+
+def trace_dir_from_env():
+    value = os.environ.get(TRACE_ENV, "").strip()
+    if value in ("", "0", "false", "no"):
+        return None
+    return TRACE_DIR.resolve() if value in ("1", "true", "yes") else Path(value).resolve()
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, node, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.node = node
+        self.attributes = attributes
+        self.start = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attributes["error"] = f"{exc_type.__name__}: {exc}"
+        self.tracer.record(self.name, self.node, self.start, time.time(), **self.attributes)
+        return False
+
+
+class Tracer:
+    """
+    Records spans (name, node, start, end, attributes) to this process's trace file.
+    Disabled tracers (no directory) hand out a shared no-op span and record nothing.
+    """
+
+    def __init__(self, directory=None, process=None):
+        self.directory = Path(directory) if directory else None
+        self.enabled = self.directory is not None
+        self.process = process or Path(sys.argv[0] or "python").stem
+        self.lock = threading.Lock()
+        self.file = None
+        self.recorded = set()  # (phase, node) of "first" phases already recorded
+
+    @classmethod
+    def from_env(cls, process=None):
+        return cls(trace_dir_from_env(), process)
+
+    def span(self, name, node=None, **attributes):
+        """
+        Context manager timing the enclosed block: `with tracer.span("image_build", node_name): ...`
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, node, attributes)
+
+    def record(self, name, node, start, end, **attributes):
+        if not self.enabled:
+            return
+        line = json.dumps({"name": name, "node": node, "start": start, "end": end, "process": self.process,
+                           "pid": os.getpid(), "thread": threading.current_thread().name, "attributes": attributes},
+                          separators=(",", ":"), default=str) + "\n"
+        with self.lock:
+            try:
+                if self.file is None:
+                    self.directory.mkdir(parents=True, exist_ok=True)
+                    self.file = open(self.directory / f"{self.process}-{os.getpid()}.jsonl", "a", buffering=1)
+                self.file.write(line)
+            except OSError as e:
+                log.error("Failed to write trace span, tracing disabled: %s", e)
+                self.enabled = False
+
+    def event(self, name, node, **attributes):
+        """
+        Record an instant (zero-length span).
+        """
+        if self.enabled:
+            now = time.time()
+            self.record(name, node, now, now, **attributes)
+
+    def first(self, name, node, start, end, **attributes):
+        """
+        Record a span only the first time `name` happens to `node` (until rearm(node)).
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            if (name, node) in self.recorded:
+                return
+            self.recorded.add((name, node))
+        self.record(name, node, start, end, **attributes)
+
+    def rearm(self, node):
+        """
+        Start a new lifecycle for `node` (e.g. on restart), so its "first" phases are recorded again.
+        """
+        if self.enabled:
+            with self.lock:
+                self.recorded = {key for key in self.recorded if key[1] != node}
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def load_spans(directory=TRACE_DIR):
+    spans = []
+    for path in sorted(Path(directory).glob("*.jsonl")):
+        with open(path) as f:
+            for line in f:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    continue  # Partly written last line of a process that was killed
+    spans.sort(key=lambda span: span["start"])
+    return spans
+
+
+def chrome_trace(spans):
+    """
+    Chrome trace event JSON (chrome://tracing, Perfetto): one row group per node, one row per process.
+    """
+    events, node_pids, thread_ids = [], {}, {}
+    for span in spans:
+        node = span.get("node") or "(fleet)"
+        if node not in node_pids:
+            node_pids[node] = len(node_pids) + 1
+            events.append({"ph": "M", "name": "process_name", "pid": node_pids[node], "tid": 0, "args": {"name": node}})
+        pid = node_pids[node]
+        if (pid, span["process"]) not in thread_ids:
+            thread_ids[pid, span["process"]] = len(thread_ids) + 1
+            events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": thread_ids[pid, span["process"]],
+                           "args": {"name": span["process"]}})
+        tid = thread_ids[pid, span["process"]]
+        args = dict(span.get("attributes") or {}, pid=span["pid"], thread=span["thread"])
+        start_us = span["start"] * 1e6
+        if span["end"] == span["start"]:
+            events.append({"ph": "i", "s": "t", "name": span["name"], "pid": pid, "tid": tid, "ts": start_us, "args": args})
+        else:
+            events.append({"ph": "X", "name": span["name"], "pid": pid, "tid": tid, "ts": start_us,
+                           "dur": (span["end"] - span["start"]) * 1e6, "args": args})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes):
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+def otlp_trace(spans):
+    """
+    OTLP/JSON (ExportTraceServiceRequest) with one trace per node and one resource per process.
+    """
+    resources = {}
+    for index, span in enumerate(spans):
+        node = span.get("node") or "(fleet)"
+        span_id = hashlib.sha256(f"{span['pid']}:{span['start']}:{index}".encode()).hexdigest()[:16]
+        attributes = dict(span.get("attributes") or {}, **{"vpn.node": node, "thread.name": span["thread"]})
+        resources.setdefault((span["process"], span["pid"]), []).append({
+            "traceId": hashlib.sha256(node.encode()).hexdigest()[:32],
+            "spanId": span_id,
+            "name": span["name"],
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(int(span["start"] * 1e9)),
+            "endTimeUnixNano": str(int(span["end"] * 1e9)),
+            "attributes": _otlp_attributes(attributes),
+        })
+    return {"resourceSpans": [
+        {"resource": {"attributes": _otlp_attributes({"service.name": process, "process.pid": pid})},
+         "scopeSpans": [{"scope": {"name": TRACE_SCOPE}, "spans": process_spans}]}
+        for (process, pid), process_spans in resources.items()
+    ]}
+
+
+def phase_summary(spans):
+    """
+    Count, mean and max seconds per phase, for a quick look without a trace viewer.
+    """
+    phases = {}
+    for span in spans:
+        entry = phases.setdefault(span["name"], [0, 0.0, 0.0])
+        seconds = span["end"] - span["start"]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+    order = {name: i for i, name in enumerate(PHASES)}
+    return [(name, count, total / count, longest)
+            for name, (count, total, longest) in sorted(phases.items(), key=lambda item: order.get(item[0], len(order)))]
+
+
+tracer = Tracer.from_env()  # Shared tracer for this process; a no-op unless VPN_TRACE is set
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export node lifecycle traces recorded with VPN_TRACE set")
+    parser.add_argument("--dir", default=str(trace_dir_from_env() or TRACE_DIR), help="Directory with the recorded *.jsonl spans")
+    parser.add_argument("--format", choices=("chrome", "otlp", "summary"), default="summary",
+                        help="chrome: chrome://tracing / Perfetto JSON, otlp: OTLP/JSON spans, summary: per-phase table")
+    parser.add_argument("--output", help="Output file (default: trace.json or otlp_trace.json)")
+    args = parser.parse_args()
+
+    spans = load_spans(args.dir)
+    if not spans:
+        print(f"[ERROR] No spans found in {args.dir}. Run the fleet with {TRACE_ENV}=1 first.")
+        return
+
+    if args.format == "summary":
+        for name, count, mean, longest in phase_summary(spans):
+            print(f"{name:<22} {count:>6} spans  mean {mean:8.3f}s  max {longest:8.3f}s")
+        return
+
+    trace = chrome_trace(spans) if args.format == "chrome" else otlp_trace(spans)
+    output = Path(args.output or ("trace.json" if args.format == "chrome" else "otlp_trace.json"))
+    tmp_output = output.with_suffix(output.suffix + ".tmp")
+    with open(tmp_output, "w") as f:
+        json.dump(trace, f)
+    os.replace(tmp_output, output)
+    print(f"[INFO] Wrote {len(spans)} spans to {output}")
+
+
+if __name__ == "__main__":
+    main()
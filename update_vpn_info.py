@@ -1,14 +1,40 @@
 #!/home/idontloveyou/miniconda/bin/python3.11
 import csv
+import fcntl
+import heapq
 import os
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 import sys
-import traceback
+import time
 
-from datetime import datetime, timedelta
+from datetime import datetime
+from port_allocator import PortAllocator
+from ovpn_catalog import OvpnCatalog
+from metrics import emitter
+from sharded_store import ShardedStore
+from vpn_logging import get_logger
+
+log = get_logger("update_vpn_info")
 
 # CSV file path
 csv_file = Path("./vpn_nodes_info.csv")
+# Writers (this script, the monitor's writer thread, supervisor restarts, expiry) run concurrently;
+# each read-modify-write holds this lock and replaces the file atomically, so readers never see a partial file
+csv_lock_file = Path("./vpn_nodes_info.lock")
+
+# 'Last Updated' holds Unix epoch seconds; readers turn it into an age when they display it
+EXPECTED_HEADERS = ['Node Name', 'Personal IP', 'VPN File', 'Public IP', 'VPN_TYPE', 'Status',
+                    'Connectivity', 'Container ID', 'Open Port', 'Proxy Info',
+                    'SOCKS5 Port', 'Last Updated']
+# Earlier files stored a human-readable age plus a 'Raw Timestamp' string
+LEGACY_HEADERS = EXPECTED_HEADERS + ['Raw Timestamp']
+LEGACY_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+EXITED_NODE_TTL = 120  # Seconds an exited node stays in the CSV after its last update
+
+# Per-shard segments instead of the single CSV when VPN_CSV_SHARDS is set (see sharded_store.py)
+store = ShardedStore.from_env(EXPECTED_HEADERS)
 
 
 
@@ -18,10 +44,8 @@ def create_csv_with_headers(headers):
     """
     Create a new CSV file with the provided headers.
     """
-    print(f"[DEBUG] CSV file '{csv_file}' does not exist. Creating with headers.")
-    with open(csv_file, mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(headers)
+    log.debug("CSV file '%s' does not exist. Creating with headers.", csv_file)
+    write_csv([headers])
 
 def read_csv():
     """
@@ -33,17 +57,21 @@ def read_csv():
             rows = list(reader)
         return rows
     except Exception as e:
-        print(f"[ERROR] Failed to read CSV file: {e}")
-        traceback.print_exc()
+        log.exception("Failed to read CSV file: %s", e)
         return []
 
 def validate_headers(rows, expected_headers):
     """
     Validate the headers of the CSV file. If headers are missing or incorrect, return the updated rows.
     """
+    # Convert files written with the old time columns in place
+    if rows and rows[0] == LEGACY_HEADERS:
+        log.warning("CSV uses the old 'Last Updated'/'Raw Timestamp' columns. Converting to epoch timestamps.")
+        return migrate_legacy_rows(rows)
+
     # If the file is empty or the first row does not match the expected headers
     if not rows or rows[0] != expected_headers:
-        print(f"[WARNING] CSV headers are missing or incorrect. Adding headers.")
+        log.warning("CSV headers are missing or incorrect. Adding headers.")
         
         # Check if there is any data present in the file and preserve it
         if rows and rows[0] != expected_headers:
@@ -55,7 +83,7 @@ def validate_headers(rows, expected_headers):
 
     # If headers match but the 'Last Updated' column is missing, append it.
     if len(rows[0]) != len(expected_headers):
-        print(f"[WARNING] CSV headers are missing the 'Last Updated' column. Adding it.")
+        log.warning("CSV headers are missing the 'Last Updated' column. Adding it.")
         # Add 'Last Updated' column and update rows accordingly
         for i in range(len(rows)):
             if len(rows[i]) == len(expected_headers) - 1: 
@@ -64,24 +92,51 @@ def validate_headers(rows, expected_headers):
     return rows
 
 
+def migrate_legacy_rows(rows):
+    """
+    Replace the age string and 'Raw Timestamp' columns of an old file with one epoch 'Last Updated' column.
+    """
+    migrated = [list(EXPECTED_HEADERS)]
+    for row in rows[1:]:
+        try:
+            updated_at = str(round(datetime.strptime(row[12], LEGACY_TIME_FORMAT).timestamp()))
+        except (IndexError, ValueError):
+            updated_at = 'N/A'
+        migrated.append(row[:11] + [updated_at])
+    return migrated
+
+
 def write_csv(rows):
     """
     Write the provided rows back to the CSV file.
     """
-    print(f"[DEBUG] Writing data back to CSV file.")
-    with open(csv_file, mode='w', newline='') as file:
+    log.debug("Writing data back to CSV file.")
+    tmp_file = csv_file.with_suffix(".csv.tmp")
+    with open(tmp_file, mode='w', newline='') as file:
         writer = csv.writer(file)
         writer.writerows(rows)
+    os.replace(tmp_file, csv_file)
+
+
+@contextmanager
+def csv_locked():
+    """
+    Hold the CSV's writer lock (shared with every other process updating the CSV).
+    """
+    with open(csv_lock_file, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 
 def ensure_csv_with_headers():
     """
     Ensure the CSV file exists with the correct headers and data integrity,
-    including the new 'Personal IP' column and 'Raw Timestamp'.
+    including the 'Personal IP' column and the epoch 'Last Updated' column.
     """
-    expected_headers = ['Node Name', 'Personal IP', 'VPN File', 'Public IP', 'VPN_TYPE', 'Status', 
-                        'Connectivity', 'Container ID', 'Open Port', 'Proxy Info', 
-                        'SOCKS5 Port', 'Last Updated', 'Raw Timestamp']  # Added Raw Timestamp
+    expected_headers = EXPECTED_HEADERS
 
     if not csv_file.exists():
         create_csv_with_headers(expected_headers)
@@ -94,7 +149,7 @@ def ensure_csv_with_headers():
     if updated_rows != rows:
         write_csv(updated_rows)
     else:
-        print(f"[DEBUG] Headers are already present and correct.")
+        log.debug("Headers are already present and correct.")
 
 
 
@@ -118,7 +173,7 @@ def ensure_correct_row_length(row):
             node_number = int(node_name.split('_')[-1])  # Extract the node number
             row[1] = f"127.0.0.{node_number}"  # Dynamically assign Personal IP based on the node number
         except (ValueError, IndexError):
-            print(f"[ERROR] Invalid node name format: {node_name}")
+            log.error("Invalid node name format: %s", node_name)
             row[1] = "127.0.0.0"  # Default IP in case of error
     else:
         row[1] = "127.0.0.0"  # Default IP if the node name doesn't match the expected format
@@ -153,9 +208,10 @@ def group_nodes_by_vpn_file(rows):
     vpn_file_map = {}
     header = rows[0]
 
-    # Map each row based on its VPN file (normalize the VPN file name by removing '-tcp' and '-udp')
+    # Map each row based on the server location of its VPN file (from the .ovpn catalog index)
+    catalog = OvpnCatalog()
     for row in rows[1:]:
-        vpn_file_base = row[2].replace('-tcp', '').replace('-udp', '')  # VPN file is in column 3 (index 2)
+        vpn_file_base = catalog.location_of(row[2]) or row[2].replace('-tcp', '').replace('-udp', '')  # VPN file is in column 3 (index 2)
         if vpn_file_base not in vpn_file_map:
             vpn_file_map[vpn_file_base] = []
         vpn_file_map[vpn_file_base].append(row)
@@ -173,96 +229,96 @@ def group_nodes_by_vpn_file(rows):
 
 
 
-def remove_inactive_exited_nodes(rows):
+class ExpiryQueue:
     """
-    Removes nodes with "Exited" status if they've been inactive for more than 2 minutes.
+    Min-heap of exited nodes keyed on their last update time, so finding the nodes to expire
+    costs O(log n) per expired node instead of a scan of every row. A node that is updated
+    again or comes back up simply invalidates its older heap entries.
     """
-    updated_rows = []
-    current_time = datetime.now()
-
-    for row in rows[1:]:  # Skip the header row
-        if row[5] == "Exited":  # Check the 'Status' column
-            last_updated_time = datetime.strptime(row[11], '%Y-%m-%d %H:%M:%S')
-            if current_time - last_updated_time > timedelta(minutes=2):
-                print(f"[DEBUG] Node {row[0]} has been inactive for more than 2 minutes. Removing it.")
-                continue  # Skip this row to effectively delete it
-        updated_rows.append(row)
 
-    return [rows[0]] + updated_rows  # Return rows with the header
+    def __init__(self, ttl=EXITED_NODE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.heap = []  # (deadline, node name, last update)
+        self.current = {}  # node name -> last update of its live entry
+
+    def touch(self, node_name, last_update):
+        """
+        Schedule `node_name` to expire `ttl` seconds after `last_update`.
+        """
+        with self.lock:
+            self.current[node_name] = last_update
+            heapq.heappush(self.heap, (last_update + self.ttl, node_name, last_update))
+
+    def cancel(self, node_name):
+        with self.lock:
+            self.current.pop(node_name, None)
+
+    def pop_expired(self, now=None):
+        """
+        Return the nodes whose deadline has passed and forget them.
+        """
+        now = time.time() if now is None else now
+        expired = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                _, node_name, last_update = heapq.heappop(self.heap)
+                if self.current.get(node_name) == last_update:
+                    del self.current[node_name]
+                    expired.append(node_name)
+        return expired
+
+
+def remove_inactive_exited_nodes(rows, expired):
+    """
+    Removes the expired nodes (exited and inactive for EXITED_NODE_TTL seconds) from the rows.
+    """
+    for node_name in sorted(expired):
+        log.debug("Node %s has been inactive for more than %s seconds. Removing it.", node_name, EXITED_NODE_TTL)
+    return [rows[0]] + [row for row in rows[1:] if row[0] not in expired]
 
 
-def format_time_difference(last_updated):
+def remove_nodes(expiry, now=None):
     """
-    Given a timestamp for 'Last Updated', return a human-readable string like:
-    - 'x seconds ago' if less than 60 seconds,
-    - 'x minutes ago' if less than 60 minutes,
-    - 'x hours ago' if less than 24 hours,
-    - 'x days ago' if more than 24 hours.
+    Rewrite the CSV without the nodes that `expiry` says are due. The CSV is only read when
+    something expired. Returns the names removed.
     """
-    current_time = datetime.now()
-    last_updated_time = datetime.strptime(last_updated, '%Y-%m-%d %H:%M:%S')
-    time_diff = current_time - last_updated_time
-    seconds = time_diff.total_seconds()
-
-    if seconds < 60:
-        return f"{int(seconds)} seconds ago"
-    elif seconds < 3600:
-        return f"{int(seconds // 60)} minutes ago"
-    elif seconds < 86400:
-        return f"{int(seconds // 3600)} hours ago"
-    else:
-        return f"{int(seconds // 86400)} days ago"
+    expired = set(expiry.pop_expired(now))
+    if not expired:
+        return expired
+    if store is not None:
+        store.remove(expired)
+        return expired
+    with csv_locked():
+        rows = read_csv()
+        if rows:
+            write_csv(remove_inactive_exited_nodes(rows, expired))
+    return expired
+
+
+def emit_node_metrics(node_name, vpn_type, status, connectivity, open_port, socks5_port, updated_at):
+    """
+    Send the node's current state to the metrics channel (see metrics.py).
+    """
+    labels = {"node": node_name}
+    emitter.gauge("vpn_node_up", 1 if status == "Running" else 0, labels)
+    emitter.gauge("vpn_node_connected", 1 if connectivity == "Connected" else 0, labels)
+    emitter.gauge("vpn_node_info", 1, {"node": node_name, "status": status, "connectivity": connectivity, "vpn_type": vpn_type}, replace="node")
+    emitter.gauge("vpn_node_last_update_timestamp_seconds", updated_at, labels)
+    emitter.gauge("vpn_node_open_port", int(open_port), labels)
+    emitter.gauge("vpn_node_socks5_port", int(socks5_port), labels)
 
 
-def update_csv(node_name, vpn_file, public_ip, vpn_type, status, connectivity, container_id, open_port, proxy_info, socks5_port):
+def update_rows(rows, node_name, vpn_file, public_ip, vpn_type, status, connectivity, container_id, open_port, proxy_info, socks5_port, updated_at):
+    """
+    Update the node's row in `rows` (adding it if missing) and return the rows in display order.
+    """
     updated = False
 
-    # Ensure headers are present in the CSV
-    ensure_csv_with_headers()
-    rows = read_csv()
-
-    print(f"[DEBUG] Values passed in:")
-    print(f"Node Name: {node_name}, VPN File: {vpn_file}, Public IP: {public_ip}, VPN_TYPE: {vpn_type}, Status: {status}, Connectivity: {connectivity}, Container ID: {container_id}, Open Port: {open_port}, Proxy Info: {proxy_info}, SOCKS5 Port: {socks5_port}")
-
-    # Sanitize inputs
-    vpn_file = vpn_file.strip().replace('\n', ' ') if vpn_file else "N/A"
-    public_ip = public_ip.strip().replace('\n', ' ') if public_ip else "N/A"
-    vpn_type = vpn_type.strip().replace('\n', ' ') if vpn_type else "N/A"
-    proxy_info = proxy_info.strip().replace('\n', ' ') if proxy_info else "Disconnected"
-
-    # Initialize port values (first node starts at these values)
-    last_open_port = 8080
-    last_socks5_port = 9090
-
-    # Check the last used port in the CSV file
-    for row in rows[1:]:  # Skip header
-        if row[8].isdigit() and row[10].isdigit():  # Open Port and SOCKS5 Port should be digits
-            last_open_port = max(last_open_port, int(row[8]))
-            last_socks5_port = max(last_socks5_port, int(row[10]))
-
-    # Assign default ports for vpn_node_1 or increment ports for other nodes
-    if node_name == "vpn_node_1":
-        open_port = str(open_port if open_port and open_port != 'NaN' else last_open_port)
-        socks5_port = str(socks5_port if socks5_port and socks5_port != 'NaN' else last_socks5_port)
-        personal_ip = "127.0.0.1"
-    else:
-        last_open_port += 1  # Increment for the next node
-        last_socks5_port += 1
-        open_port = str(open_port if open_port and open_port != 'NaN' else last_open_port)
-        socks5_port = str(socks5_port if socks5_port and socks5_port != 'NaN' else last_socks5_port)
-        personal_ip = f"127.0.0.{len(rows)}"  # Increment Personal IP for subsequent nodes
-
-    # Convert ports to integers to ensure they don't have decimals
-    open_port = str(int(open_port))
-    socks5_port = str(int(socks5_port))
-
-    status = status.capitalize()
-    current_time = datetime.now()
-
     # Search for the node in the existing rows
     for index, row in enumerate(rows):
         if row[0] == node_name:
-            print(f"[DEBUG] Found existing row for node {node_name}. Updating row.")
+            log.debug("Found existing row for node %s. Updating row.", node_name)
             row = ensure_correct_row_length(row)  # Ensure the row length and assign the correct 'Personal IP'
 
             # Update the rest of the row with new values
@@ -275,29 +331,64 @@ def update_csv(node_name, vpn_file, public_ip, vpn_type, status, connectivity, c
             row[8] = open_port  # Ensure port is an integer and no decimals
             row[9] = proxy_info  
             row[10] = socks5_port  # Ensure port is an integer and no decimals
-            row[11] = format_time_difference(current_time.strftime('%Y-%m-%d %H:%M:%S'))  # Human-readable time diff
-            row[12] = current_time.strftime('%Y-%m-%d %H:%M:%S')  # Raw timestamp for future calculations
+            row[11] = str(round(updated_at))  # Epoch seconds; ages are computed by readers
             updated = True
             break
 
 
     # If no matching node was found, append a new row
     if not updated:
-        print(f"[DEBUG] No existing row found for node {node_name}. Adding new row.")
+        log.debug("No existing row found for node %s. Adding new row.", node_name)
         new_row = [node_name, f"127.0.0.{int(node_name.split('_')[-1])}", vpn_file, public_ip, vpn_type, status, 
-                   connectivity, container_id, open_port, proxy_info, socks5_port, 
-                   format_time_difference(current_time.strftime('%Y-%m-%d %H:%M:%S')),  # Human-readable time diff
-                   current_time.strftime('%Y-%m-%d %H:%M:%S')]  # Raw timestamp
+                   connectivity, container_id, open_port, proxy_info, socks5_port,
+                   str(round(updated_at))]  # Epoch seconds
         rows.append(new_row)
 
 
     # Ensure nodes are grouped and ordered correctly
     rows = ensure_all_nodes_present(rows)
-    rows = group_nodes_by_vpn_file(rows)
+    return group_nodes_by_vpn_file(rows)
+
+
+def update_csv(node_name, vpn_file, public_ip, vpn_type, status, connectivity, container_id, open_port, proxy_info, socks5_port):
+    start = time.perf_counter()
 
-    # Write the updated rows back to the CSV
-    write_csv(rows)
-    print(f"[DEBUG] Successfully updated CSV file.")
+    log.debug("Values passed in: node %s, VPN file %s, public IP %s, VPN type %s, status %s, connectivity %s, container %s, "
+              "open port %s, proxy info %s, SOCKS5 port %s", node_name, vpn_file, public_ip, vpn_type, status, connectivity,
+              container_id, open_port, proxy_info, socks5_port)
+
+    # Sanitize inputs
+    vpn_file = vpn_file.strip().replace('\n', ' ') if vpn_file else "N/A"
+    public_ip = public_ip.strip().replace('\n', ' ') if public_ip else "N/A"
+    vpn_type = vpn_type.strip().replace('\n', ' ') if vpn_type else "N/A"
+    proxy_info = proxy_info.strip().replace('\n', ' ') if proxy_info else "Disconnected"
+
+    # Fall back to the node's lease when the caller did not pass a port
+    if not open_port or open_port == 'NaN' or not socks5_port or socks5_port == 'NaN':
+        lease = PortAllocator().lease(node_name)
+        open_port = str(open_port if open_port and open_port != 'NaN' else lease["open_port"])
+        socks5_port = str(socks5_port if socks5_port and socks5_port != 'NaN' else lease["socks5_port"])
+
+    # Convert ports to integers to ensure they don't have decimals
+    open_port = str(int(open_port))
+    socks5_port = str(int(socks5_port))
+
+    status = status.capitalize()
+    updated_at = time.time()
+    values = (node_name, vpn_file, public_ip, vpn_type, status, connectivity, container_id, open_port, proxy_info, socks5_port, updated_at)
+
+    if store is not None:
+        # Only the node's shard is read and rewritten
+        shard, generation = store.update_node(node_name, lambda rows: update_rows(rows, *values), vpn_type, vpn_file)
+        log.debug("Wrote %s to shard %s (generation %s).", node_name, shard, generation)
+    else:
+        # Ensure headers are present in the CSV, then write the updated rows back
+        with csv_locked():
+            ensure_csv_with_headers()
+            write_csv(update_rows(read_csv(), *values))
+    emitter.observe("vpn_csv_write_duration_seconds", time.perf_counter() - start)
+    emit_node_metrics(node_name, vpn_type, status, connectivity, open_port, socks5_port, updated_at)
+    log.debug("Successfully updated CSV file.")
 
 
 
@@ -310,7 +401,7 @@ if __name__ == "__main__":
     try:
         # Parse command-line arguments
         if len(sys.argv) != 11:  # Adjusted to 11 arguments to include VPN_TYPE
-            print(f"[ERROR] Incorrect number of arguments: {len(sys.argv)}")
+            log.error("Incorrect number of arguments: %s", len(sys.argv))
             print("Usage: update_vpn_info.py <Node Name> <VPN File> <Public IP> <VPN_TYPE> <Status> <Connectivity> <Container ID> <Open Port> <Proxy Info> <SOCKS5 Port>")
             sys.exit(1)
 
@@ -326,10 +417,9 @@ if __name__ == "__main__":
         socks5_port = sys.argv[10]
 
         # Update the CSV file
-        print(f"[DEBUG] Updating CSV with node {node_name}.")
+        log.debug("Updating CSV with node %s.", node_name)
         update_csv(node_name, vpn_file, public_ip, vpn_type, status, connectivity, container_id, open_port, proxy_info, socks5_port)
 
     except Exception as e:
-        print(f"[ERROR] Exception occurred in main execution: {e}")
-        traceback.print_exc()
+        log.exception("Exception occurred in main execution: %s", e)
 
@@ -0,0 +1,172 @@
+#!/home/idontloveyou/miniconda/bin/python3.11
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from pathlib import Path
+
+# Shared logging for every process of the fleet. Callers only put records on a queue; a listener
+# thread formats and writes them, so logging never blocks a monitor pass on stdout.
+# Child processes (build_vpn_nodes.py, generateyml.py) inherit these settings through the environment.
+LOG_LEVEL_ENV = "VPN_LOG_LEVEL"  # DEBUG, INFO, WARNING or ERROR
+LOG_FORMAT_ENV = "VPN_LOG_FORMAT"  # "text" ("[INFO] message") or "json" (one object per line)
+DEFAULT_LEVEL = "INFO"
+ROOT_LOGGER = "vpn"
+RATE_LIMIT_SECONDS = 60  # A per-node message (logged with extra={"node": ...}) repeats at most this often
+RATE_LIMIT_MAX_KEYS = 50000  # Forget the oldest keys beyond this many
+PROCESS_NAME = Path(sys.argv[0] or "python").stem
+
+_setup_lock = threading.Lock()
+_listener = None
+
+
+class StdoutHandler(logging.StreamHandler):
+    """
+    Writes to whatever sys.stdout is when the record is written, so contextlib.redirect_stdout applies.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+
+class TextFormatter(logging.Formatter):
+    """
+    The fleet's traditional "[LEVEL] message" lines.
+    """
+
+    def format(self, record):
+        line = f"[{record.levelname}] {record.getMessage()}"
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+    # Attributes every LogRecord has; anything else was passed through `extra`
+    STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {"time": round(record.created, 3), "level": record.levelname, "logger": record.name,
+                 "process": PROCESS_NAME,
+                 "pid": record.process, "thread": record.threadName, "message": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in self.STANDARD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(",", ":"), default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drop repeats of the same per-node message (same logger, template and node) within `interval`
+    seconds. The next one that gets through says how many were dropped. Records without a node pass.
+    """
+
+    def __init__(self, interval=RATE_LIMIT_SECONDS, max_keys=RATE_LIMIT_MAX_KEYS, clock=time.monotonic):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.last = {}  # (logger, template, node) -> [last emitted, suppressed since]
+
+    def filter(self, record):
+        node = getattr(record, "node", None)
+        if node is None or self.interval <= 0:
+            return True
+        key = (record.name, record.msg, node)
+        now = self.clock()
+        with self.lock:
+            entry = self.last.get(key)
+            if entry is not None and now - entry[0] < self.interval:
+                entry[1] += 1
+                return False
+            suppressed = entry[1] if entry else 0
+            self.last.pop(key, None)
+            self.last[key] = [now, 0]
+            if len(self.last) > self.max_keys:
+                del self.last[next(iter(self.last))]
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue with only the message merged in; formatting happens on the listener thread.
+    """
+
+    def prepare(self, record):
+        message = record.getMessage()
+        if getattr(record, "suppressed", 0):
+            message += f" ({record.suppressed} similar messages suppressed)"
+        record.msg, record.args = message, None
+        return record
+
+
+def level_from_env(default=DEFAULT_LEVEL):
+    name = os.environ.get(LOG_LEVEL_ENV, default).strip().upper()
+    return logging.getLevelName(name) if isinstance(logging.getLevelName(name), int) else logging.INFO
+
+
+def setup_logging(level=None, json_format=None, stream=None, rate_limit=RATE_LIMIT_SECONDS, force=False):
+    """
+    Configure the "vpn" logger tree once per process: level and format from the environment
+    unless given, a queue handler for callers and a listener thread writing to `stream` (default: stdout).
+    Modules set it up with the defaults when they are imported; pass force=True to replace that setup.
+    """
+    global _listener
+    if force:
+        shutdown_logging()
+    with _setup_lock:
+        if _listener is not None:
+            return
+        if json_format is None:
+            json_format = os.environ.get(LOG_FORMAT_ENV, "text").strip().lower() == "json"
+        output = StdoutHandler() if stream is None else logging.StreamHandler(stream)
+        output.setFormatter(JSONFormatter() if json_format else TextFormatter())
+
+        log_queue = queue.SimpleQueue()
+        handler = NonBlockingQueueHandler(log_queue)
+        handler.addFilter(RateLimitFilter(rate_limit))
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(level_from_env() if level is None else level)
+        root.handlers[:] = [handler]
+        root.propagate = False
+
+        _listener = logging.handlers.QueueListener(log_queue, output)
+        _listener.start()
+
+
+def shutdown_logging():
+    """
+    Write out everything still queued. Runs at exit; call it before os._exit().
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+            logging.getLogger(ROOT_LOGGER).handlers[:] = []
+
+
+atexit.register(shutdown_logging)
+
+
+def get_logger(name):
+    """
+    Logger for a module, e.g. `log = get_logger("manage_vpns")`. Use %-style arguments
+    (log.debug("Checked %s", node)) so disabled levels cost no formatting.
+    """
+    setup_logging()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
@@ -5,7 +5,8 @@ import time
 import json
 import uvicorn
 import signal
-from fastapi import FastAPI, WebSocket
+from fastapi import FastAPI, WebSocket, Request, Response, HTTPException
+from fastapi.responses import PlainTextResponse
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from threading import Thread, Event
@@ -15,12 +16,26 @@ from pathlib import Path
 from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 
+from metrics import registry, start_metrics_channel
+from node_index import NodeIndex, with_ages
+from node_history import NodeHistory
+from sharded_store import ShardedStore, GENERATION_SUFFIX
+from tracing import tracer
+from vpn_logging import get_logger
+
+log = get_logger("websocket_server")
+
 
 app = FastAPI()
 
 # Store active WebSocket connections
 clients = []
 
+# Live node table served by the /nodes API, kept current by the CSV watcher
+node_index = NodeIndex()
+node_history = NodeHistory()  # Read side of the history written by manage_vpns
+csv_store = ShardedStore.from_env()  # Per-shard segments instead of one CSV when VPN_CSV_SHARDS is set
+
 # Create a global stop event for managing shutdown
 stop_event = Event()
 global_event_loop = None
@@ -55,16 +70,89 @@ def find_csv_file():
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     clients.append(websocket)
-    print(f"[INFO] New WebSocket connection established. Total clients: {len(clients)}")
+    registry.set("vpn_websocket_clients", len(clients))
+    log.info("New WebSocket connection established. Total clients: %s", len(clients))
     
     try:
         while True:
             await websocket.receive_text()  # Keep connection alive by waiting for messages
     except Exception as e:
-        print(f"[ERROR] WebSocket connection error: {e}")
+        log.error("WebSocket connection error: %s", e)
     finally:
-        clients.remove(websocket)
-        print(f"[INFO] WebSocket connection closed. Total clients: {len(clients)}")
+        if websocket in clients:
+            clients.remove(websocket)
+        registry.set("vpn_websocket_clients", len(clients))
+        log.info("WebSocket connection closed. Total clients: %s", len(clients))
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """
+    Prometheus/OpenMetrics scrape endpoint, rendered from the in-process registry.
+    """
+    return PlainTextResponse(registry.render(), media_type="application/openmetrics-text; version=1.0.0; charset=utf-8")
+
+
+def json_response(request, etag, body_factory):
+    """
+    Answer 304 when the client already has `etag`, otherwise the JSON body with the ETag set.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body_factory(), media_type="application/json", headers={"ETag": etag})
+
+
+@app.get("/nodes")
+def list_nodes(request: Request, status: str = None, connectivity: str = None, vpn_type: str = None, region: str = None):
+    """
+    List nodes, optionally filtered by status, connectivity, VPN type and region (case-insensitive).
+    The body is validated by the ETag, so it carries `updated_at` and no `age_seconds`.
+    """
+    filters = {"status": status, "connectivity": connectivity, "vpn_type": vpn_type, "region": region}
+
+    def build():
+        nodes = node_index.query(**filters)
+        return {"generation": node_index.generation, "count": len(nodes), "nodes": nodes}
+
+    return json_response(request, node_index.etag(), lambda: node_index.render("nodes", tuple(filters.items()), build))
+
+
+@app.get("/nodes/pick")
+def pick_nodes(count: int = 1, vpn_type: str = None, region: str = None):
+    """
+    Pick up to `count` running, connected nodes, rotating across calls so load is spread.
+    """
+    nodes = with_ages(node_index.pick(count, vpn_type=vpn_type, region=region))
+    return Response(json.dumps({"count": len(nodes), "nodes": nodes}), media_type="application/json",
+                    headers={"Cache-Control": "no-store"})
+
+
+@app.get("/history")
+def fleet_history(window: float = None):
+    """
+    Uptime %, mean time between failures and IP-change count per node over the last `window` seconds.
+    """
+    since = time.time() - window if window else None
+    return {"nodes": node_history.fleet_stats(since=since)}
+
+
+@app.get("/history/{node_name}")
+def node_history_stats(node_name: str, window: float = None, transitions: bool = False):
+    since = time.time() - window if window else None
+    stats = node_history.node_stats(node_name, since=since)
+    if transitions:
+        stats["transitions"] = node_history.transitions(node_name, since=since)
+    return stats
+
+
+@app.get("/nodes/{node_name}")
+def get_node(request: Request, node_name: str):
+    etag = node_index.etag(node_name)
+    if etag is None:
+        raise HTTPException(status_code=404, detail=f"Unknown node {node_name}")
+    return json_response(request, etag, lambda: node_index.render("node", node_name, lambda: node_index.get(node_name)))
+
 
 class CSVHandler(FileSystemEventHandler):
     def __init__(self, filepath):
@@ -73,8 +161,9 @@ class CSVHandler(FileSystemEventHandler):
         self.last_file_size = os.path.getsize(filepath)
         self.last_checksum = self.get_file_checksum(filepath)
         self.last_file_content = self.get_file_content(filepath)
+        node_index.apply_csv_text(self.last_file_content)
         self.executor = ThreadPoolExecutor(max_workers=16)  # Use 16 workers for concurrency
-        print(f"[DEBUG] Monitoring started on {filepath}. Initial mod time: {self.last_mod_time}, size: {self.last_file_size}, checksum: {self.last_checksum}")
+        log.debug("Monitoring started on %s. Initial mod time: %s, size: %s, checksum: %s", filepath, self.last_mod_time, self.last_file_size, self.last_checksum)
 
     def get_file_checksum(self, filepath):
         """Generate a checksum (MD5) for the file content to detect changes with retries."""
@@ -87,7 +176,7 @@ class CSVHandler(FileSystemEventHandler):
                         md5.update(chunk)
                 return md5.hexdigest()
             except Exception as e:
-                print(f"[ERROR] Failed to calculate file checksum, retrying... Error: {e}")
+                log.error("Failed to calculate file checksum, retrying... Error: %s", e)
                 retries -= 1
                 time.sleep(0.1)
         return ""
@@ -100,7 +189,7 @@ class CSVHandler(FileSystemEventHandler):
                 with open(filepath, 'r') as f:
                     return f.read()
             except Exception as e:
-                print(f"[ERROR] Failed to read file content, retrying... Error: {e}")
+                log.error("Failed to read file content, retrying... Error: %s", e)
                 retries -= 1
                 time.sleep(0.1)
         return ""
@@ -110,6 +199,11 @@ class CSVHandler(FileSystemEventHandler):
         if event.src_path == str(self.filepath):
             self.executor.submit(self.process_file_event)
 
+    def on_moved(self, event):
+        # Writers replace the CSV atomically (temp file + rename)
+        if event.dest_path == str(self.filepath):
+            self.executor.submit(self.process_file_event)
+
     def process_file_event(self):
         try:
             # Introduce a short delay to ensure the file has finished writing
@@ -121,75 +215,143 @@ class CSVHandler(FileSystemEventHandler):
             new_checksum = self.get_file_checksum(self.filepath)
             new_file_content = self.get_file_content(self.filepath)
 
-            print(f"[DEBUG] Detected event on {self.filepath}. New mod time: {new_mod_time}, size: {new_file_size}, checksum: {new_checksum}")
+            log.debug("Detected event on %s. New mod time: %s, size: %s, checksum: %s", self.filepath, new_mod_time, new_file_size, new_checksum)
 
             # Treat all events as significant changes to ensure every modification is handled
             self.last_mod_time = new_mod_time
             self.last_file_size = new_file_size
             self.last_checksum = new_checksum
             self.last_file_content = new_file_content
+            log.info("All changes are treated as significant. Reloading the file and notifying clients...")
+            publish_change(lambda: node_index.apply_csv_text(new_file_content))
 
-            print("[INFO] All changes are treated as significant. Reloading the file and notifying clients...")
+        except Exception as e:
+            log.error("Error during CSV file modification handling: %s", e)
 
-            # Use the global event loop (the one running in the separate thread)
-            asyncio.run_coroutine_threadsafe(notify_clients(), global_event_loop)
 
-        except Exception as e:
-            print(f"[ERROR] Error during CSV file modification handling: {e}")
+class ShardHandler(FileSystemEventHandler):
+    """
+    Watches a sharded store's directory and applies only the shards whose generation moved.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=1)  # poll() is cheap when nothing changed; one at a time keeps shards in order
+        self.started = False
+        store.subscribe(self.apply_shard)
+        store.poll()  # Load every shard without notifying anyone
+        self.started = True
+        log.debug("Monitoring started on %s: %s shards, %s nodes.", store.directory, len(store.shards()), len(node_index.nodes))
+
+    def on_any_event(self, event):
+        # Writers replace <shard>.gen after every segment rewrite, so that is the only event that matters
+        paths = (event.src_path, getattr(event, "dest_path", ""))
+        if any(str(path).endswith(GENERATION_SUFFIX) for path in paths):
+            self.executor.submit(self.store.poll)
+
+    def apply_shard(self, shard, generation, rows):
+        if not self.started:
+            node_index.apply_rows(rows, shard=shard)
+            return
+        log.debug("Shard %s moved to generation %s. Notifying clients...", shard, generation)
+        publish_change(lambda: node_index.apply_rows(rows, shard=shard),
+                       {"update": "CSV Updated", "shard": shard, "generation": generation})
+
 
+def publish_change(apply, message=None):
+    """
+    Apply a change to the node index with `apply()`, then tell every WebSocket client.
+    """
+    detected_at = time.time()
+    before = node_statuses() if tracer.enabled else None
+    changed = apply()
+    log.debug("Node index updated: %s nodes changed (generation %s).", changed, node_index.generation)
 
+    # Use the global event loop (the one running in the separate thread)
+    pushed = asyncio.run_coroutine_threadsafe(notify_clients(message), global_event_loop)
+    if before is not None:
+        after = node_statuses()
+        moved = {name: status for name, status in after.items() if before.get(name) != status}
+        pushed.add_done_callback(lambda future: trace_dashboard_push(moved, detected_at))
 
 
 
 
 
 
+
+
+def node_statuses():
+    return {name: record.get("status") for name, record in list(node_index.nodes.items())}
+
+
+def trace_dashboard_push(moved, detected_at):
+    """
+    Record the push that first shows each node running; a node that leaves running starts a new lifecycle.
+    """
+    delivered_at = time.time()
+    for name, status in moved.items():
+        if (status or "").lower() == "running":
+            tracer.first("first_dashboard_push", name, detected_at, delivered_at, clients=len(clients))
+        else:
+            tracer.rearm(name)
+
+
 # Function to notify WebSocket clients when the CSV file changes
-async def notify_clients():
-    data = {"update": "CSV Updated"}
+async def notify_clients(data=None):
+    data = data or {"update": "CSV Updated"}
     message = json.dumps(data)
-    print(f"[DEBUG] Notifying {len(clients)} clients about the update.")
+    log.debug("Notifying %s clients about the update.", len(clients))
     
     tasks = []
     for client in clients[:]:  # Copy to avoid issues when modifying the list
         try:
             tasks.append(send_to_client(client, message))
         except Exception as e:
-            print(f"[ERROR] Error preparing async task for client notification: {e}")
+            log.error("Error preparing async task for client notification: %s", e)
             clients.remove(client)
     
     if tasks:
+        start = time.perf_counter()
         await asyncio.gather(*tasks)  # Await all tasks to ensure they're handled concurrently
+        registry.observe("vpn_websocket_broadcast_duration_seconds", time.perf_counter() - start)
 
 
 
 # Async function to send messages to clients
 async def send_to_client(client, message):
     try:
-        print(f"[DEBUG] Sending message to client: {message}")
+        log.debug("Sending message to client: %s", message)
         await client.send_text(message)  # Use await to properly handle asynchronous calls
     except Exception as e:
-        print(f"[ERROR] Failed to send message to client. Removing client. Error: {e}")
-        clients.remove(client)
+        log.error("Failed to send message to client. Removing client. Error: %s", e)
+        if client in clients:
+            clients.remove(client)
+        registry.set("vpn_websocket_clients", len(clients))
 
 
 def start_watching_csv():
-    csv_file = find_csv_file()
-    if csv_file is None:
-        print("[ERROR] No CSV file found in the current directory. Please add a CSV file.")
-        return
-
-    print(f"[INFO] Monitoring CSV file: {csv_file}")
-    event_handler = CSVHandler(csv_file)
     observer = Observer()
-    observer.schedule(event_handler, path=csv_file.parent, recursive=False)
+    if csv_store is not None:
+        csv_store.directory.mkdir(parents=True, exist_ok=True)
+        log.info("Monitoring CSV shards in %s (sharded by %s)", csv_store.directory, csv_store.shard_by)
+        observer.schedule(ShardHandler(csv_store), path=csv_store.directory, recursive=False)
+    else:
+        csv_file = find_csv_file()
+        if csv_file is None:
+            log.error("No CSV file found in the current directory. Please add a CSV file.")
+            return
+
+        log.info("Monitoring CSV file: %s", csv_file)
+        event_handler = CSVHandler(csv_file)
+        observer.schedule(event_handler, path=csv_file.parent, recursive=False)
     observer.start()
 
     try:
         while not stop_event.is_set():  # Continue monitoring until stopped
             time.sleep(1)  # Ensure that the observer keeps running
     except KeyboardInterrupt:
-        print("[INFO] Stopping CSV monitoring...")
+        log.info("Stopping CSV monitoring...")
         observer.stop()
     observer.join()
 
@@ -200,17 +362,17 @@ class SignalManager:
         self.cleanup_done = False
 
     def handle_signal(self, signum, frame):
-        print(f"\n[INFO] Received signal {signum}. Initiating graceful shutdown...")
+        log.info("Received signal %s. Initiating graceful shutdown...", signum)
         self.cleanup()
 
     def cleanup(self):
         if not self.cleanup_done:
-            print("[INFO] Cleaning up resources...")
+            log.info("Cleaning up resources...")
             stop_event.set()  # Signal to stop threads
             # Stop the asyncio event loop in the separate thread
             loop = asyncio.get_event_loop()
             loop.call_soon_threadsafe(loop.stop)
-            print("[INFO] WebSocket server and CSV watcher stopping.")
+            log.info("WebSocket server and CSV watcher stopping.")
             self.cleanup_done = True
 
 
@@ -226,13 +388,16 @@ def run_server_and_watcher():
     event_loop_thread.daemon = True
     event_loop_thread.start()
 
+    # Receive samples from the monitor and CSV writer for /metrics
+    start_metrics_channel(registry, stop_event)
+
     # Start monitoring the CSV file in a separate thread
     watcher_thread = Thread(target=start_watching_csv)
     watcher_thread.daemon = True  # Ensure the thread terminates when the main thread ends
     watcher_thread.start()
 
     # Run the WebSocket server in the main thread
-    print("[INFO] Starting WebSocket server on port 4021")
+    log.info("Starting WebSocket server on port 4021 (metrics at /metrics)")
     uvicorn.run(app, host="0.0.0.0", port=4021)
 
 